@@ -14,6 +14,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 load_dotenv(override=True)
 import os
+import tempfile
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -34,6 +35,100 @@ TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
 TWILIO_NUMBER = os.getenv('TWILIO_NUMBER')
 TWILIO_VERIFY_SERVICE_SID = os.getenv('TWILIO_VERIFY_SERVICE_SID')
+TWILIO_API_BASE_URL = os.getenv('TWILIO_API_BASE_URL', 'https://api.twilio.com')
+
+# Outbound WhatsApp replies (see extractor/notifier.py)
+TWILIO_SEND_RATE = float(os.getenv('TWILIO_SEND_RATE', 80))  # messages per second for the sender number; 0 disables
+TWILIO_SEND_BURST = int(os.getenv('TWILIO_SEND_BURST', 80))
+TWILIO_SEND_POOLS = int(os.getenv('TWILIO_SEND_POOLS', 1))  # run_receipt_workers pools, on all hosts, sharing the number's rate
+TWILIO_SEND_MAX_ATTEMPTS = int(os.getenv('TWILIO_SEND_MAX_ATTEMPTS', 5))
+TWILIO_SEND_RETRY_DELAY = float(os.getenv('TWILIO_SEND_RETRY_DELAY', 1))  # seconds, doubled per attempt unless Retry-After is set
+TWILIO_SEND_TIMEOUT = float(os.getenv('TWILIO_SEND_TIMEOUT', 10))
+TWILIO_SENDER_THREADS = int(os.getenv('TWILIO_SENDER_THREADS', 4))
+
+# Gemini clients (see extractor/llm.py)
+GEMINI_VISION_MODEL = os.getenv('GEMINI_VISION_MODEL', 'gemini-pro-vision')
+GEMINI_TEXT_MODEL = os.getenv('GEMINI_TEXT_MODEL', 'gemini-pro')
+# Extraction cascades, tried in order until a result validates (see extractor/cascade.py); one model disables it
+EXTRACTION_VISION_MODELS = os.getenv('EXTRACTION_VISION_MODELS', f'gemini-1.5-flash,{GEMINI_VISION_MODEL}').split(',')
+EXTRACTION_TEXT_MODELS = os.getenv('EXTRACTION_TEXT_MODELS', f'gemini-1.5-flash,{GEMINI_TEXT_MODEL}').split(',')
+EXTRACTION_REQUIRED_FIELDS = os.getenv('EXTRACTION_REQUIRED_FIELDS', 'date,vendor,total_amount').split(',')  # missing ones escalate
+# Concurrent extractions on the same model share one call (see extractor/microbatch.py)
+EXTRACTION_BATCH_MAX_ITEMS = int(os.getenv('EXTRACTION_BATCH_MAX_ITEMS', 8))  # receipts per model call; 1 disables batching
+EXTRACTION_BATCH_WAIT_MS = int(os.getenv('EXTRACTION_BATCH_WAIT_MS', 50))  # how long a call waits for others to join
+# Deadlines, hedging and circuit breakers around Gemini calls (see extractor/resilience.py)
+GEMINI_CALL_TIMEOUT = float(os.getenv('GEMINI_CALL_TIMEOUT', 30))  # seconds per extraction call, client retries included
+GEMINI_AGENT_TIMEOUT = float(os.getenv('GEMINI_AGENT_TIMEOUT', 90))  # seconds for a whole query agent run
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', 16))  # calls in flight per process, abandoned ones included
+GEMINI_HEDGE = os.getenv('GEMINI_HEDGE', 'true').lower() == 'true'  # resend calls still running after the model's p95
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', 20))  # successful calls seen before hedging starts
+GEMINI_BREAKER_FAILURES = int(os.getenv('GEMINI_BREAKER_FAILURES', 5))  # consecutive failures that open the circuit
+GEMINI_BREAKER_RESET = float(os.getenv('GEMINI_BREAKER_RESET', 30))  # seconds before a trial call is let through
+GEMINI_API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT')  # e.g. http://127.0.0.1:8001 for a local fake backend
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT', 'rest' if GEMINI_API_ENDPOINT else None)
+LLM_WARMUP_ON_STARTUP = os.getenv('LLM_WARMUP_ON_STARTUP', 'false').lower() == 'true'
+PRELOAD_ON_STARTUP = os.getenv('PRELOAD_ON_STARTUP', 'false').lower() == 'true'  # import the extraction stack in AppConfig.ready (see extractor/startup.py)
+STARTUP_BUDGET_MS = float(os.getenv('STARTUP_BUDGET_MS', 1500))  # `manage.py benchmark_startup` fails above these
+STARTUP_BUDGET_MB = float(os.getenv('STARTUP_BUDGET_MB', 120))
+VENDOR_MATCH_THRESHOLD = int(os.getenv('VENDOR_MATCH_THRESHOLD', 90))  # rapidfuzz score (0-100) to reuse a vendor
+VENDOR_BLOCK_PREFIX = int(os.getenv('VENDOR_BLOCK_PREFIX', 3))  # leading letters shared by compared names
+QUERY_FRAME_CACHE_SIZE = int(os.getenv('QUERY_FRAME_CACHE_SIZE', 256))  # users whose receipt columns stay in memory; 0 disables
+QUERY_FAST_PATH_ENABLED = os.getenv('QUERY_FAST_PATH_ENABLED', 'true').lower() == 'true'  # see extractor/queries.py
+# Agent-generated pandas code runs in limited worker processes (see extractor/sandbox.py)
+QUERY_SANDBOX_ENABLED = os.getenv('QUERY_SANDBOX_ENABLED', 'true').lower() == 'true'
+QUERY_SANDBOX_WORKERS = int(os.getenv('QUERY_SANDBOX_WORKERS', 2))  # per Django or job worker process
+QUERY_SANDBOX_TIMEOUT = float(os.getenv('QUERY_SANDBOX_TIMEOUT', 10))  # seconds per tool call before the worker is killed
+QUERY_SANDBOX_CPU_SECONDS = int(os.getenv('QUERY_SANDBOX_CPU_SECONDS', 5))  # CPU time per tool call (RLIMIT_CPU)
+QUERY_SANDBOX_MEMORY_MB = int(os.getenv('QUERY_SANDBOX_MEMORY_MB', 1024))  # address space per worker (RLIMIT_AS)
+QUERY_SANDBOX_MAX_TASKS = int(os.getenv('QUERY_SANDBOX_MAX_TASKS', 100))  # queries a worker serves before it is replaced
+
+# Receipt job queue (see extractor/jobs.py and `manage.py run_receipt_workers`)
+RECEIPT_WORKERS = int(os.getenv('RECEIPT_WORKERS', 4))
+RECEIPT_WORKER_MODE = os.getenv('RECEIPT_WORKER_MODE', 'thread')  # 'thread', 'process' or 'async'
+RECEIPT_WORKER_POLL_INTERVAL = float(os.getenv('RECEIPT_WORKER_POLL_INTERVAL', 1.0))
+RECEIPT_JOBS_PER_USER = int(os.getenv('RECEIPT_JOBS_PER_USER', 1))
+RECEIPT_JOB_MAX_ATTEMPTS = int(os.getenv('RECEIPT_JOB_MAX_ATTEMPTS', 3))
+RECEIPT_JOB_RETRY_DELAY = float(os.getenv('RECEIPT_JOB_RETRY_DELAY', 5))  # seconds, doubled per attempt
+RECEIPT_JOB_TIMEOUT = int(os.getenv('RECEIPT_JOB_TIMEOUT', 900))  # running jobs older than this are requeued
+RECEIPT_JOB_RETENTION = int(os.getenv('RECEIPT_JOB_RETENTION', 7 * 24 * 3600))  # seconds done jobs are kept; 0 keeps them
+RECEIPT_QUEUE_MAX_DEPTH = int(os.getenv('RECEIPT_QUEUE_MAX_DEPTH', 1000))
+RECEIPT_WORKER_METRICS_PORT = int(os.getenv('RECEIPT_WORKER_METRICS_PORT', 0))  # 0 disables the workers' /metrics
+MESSAGE_DEDUPE_WINDOW = int(os.getenv('MESSAGE_DEDUPE_WINDOW', 24 * 3600))  # seconds a Twilio MessageSid is remembered
+
+# Streaming media download (see extractor/media.py)
+RECEIPT_MAX_MEDIA_BYTES = int(os.getenv('RECEIPT_MAX_MEDIA_BYTES', 20 * 1024 * 1024))
+MEDIA_DOWNLOAD_CHUNK_SIZE = int(os.getenv('MEDIA_DOWNLOAD_CHUNK_SIZE', 64 * 1024))
+MEDIA_DOWNLOAD_TIMEOUT = float(os.getenv('MEDIA_DOWNLOAD_TIMEOUT', 30))
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv('ASYNC_HTTP_MAX_CONNECTIONS', 100))  # shared by async workers
+
+# PDF loading (see extractor/pdf.py)
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', 10))
+PDF_RENDER_DPI = int(os.getenv('PDF_RENDER_DPI', 150))
+PDF_MIN_TEXT_CHARS = int(os.getenv('PDF_MIN_TEXT_CHARS', 20))  # pages with less text are rasterized
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', os.cpu_count() or 1))
+
+# Image preprocessing before the vision model call (see extractor/preprocess.py)
+IMAGE_PREPROCESS_ENABLED = os.getenv('IMAGE_PREPROCESS_ENABLED', 'true').lower() == 'true'
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 1600))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 80))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG')  # 'JPEG' or 'WEBP'
+IMAGE_GRAYSCALE = os.getenv('IMAGE_GRAYSCALE', 'true').lower() == 'true'
+IMAGE_CROP = os.getenv('IMAGE_CROP', 'true').lower() == 'true'
+
+# Bulk ingestion (see extractor/batch.py)
+BULK_EXTRACTION_WORKERS = int(os.getenv('BULK_EXTRACTION_WORKERS', 4))
+BULK_UPLOAD_MAX_FILES = int(os.getenv('BULK_UPLOAD_MAX_FILES', 100))
+
+# Dashboard
+RECEIPT_PAGE_SIZE = int(os.getenv('RECEIPT_PAGE_SIZE', 25))
+CHART_MAX_POINTS = int(os.getenv('CHART_MAX_POINTS', 365))  # points per chart series after downsampling
+
+# Content-hash cache of extraction results (see extractor/cache.py)
+EXTRACTION_CACHE_ENABLED = os.getenv('EXTRACTION_CACHE_ENABLED', 'true').lower() == 'true'
+EXTRACTION_CACHE_LRU_SIZE = int(os.getenv('EXTRACTION_CACHE_LRU_SIZE', 512))  # in-process entries
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES', 50000))  # database rows
+EXTRACTION_CACHE_TTL = int(os.getenv('EXTRACTION_CACHE_TTL', 60 * 60 * 24 * 30))  # seconds since last hit
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -81,12 +176,71 @@ WSGI_APPLICATION = 'core.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE is 'sqlite' or 'postgres'. Workers keep their connection for
+# DB_CONN_MAX_AGE seconds and check it before reuse instead of reconnecting per job.
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', 600))  # 0 closes the connection after every request/job
+DB_CONN_HEALTH_CHECKS = os.getenv('DB_CONN_HEALTH_CHECKS', 'true').lower() == 'true'
+
+if DB_ENGINE == 'postgres':
+    # Django 4.2 has no built-in pool: each worker thread holds one persistent
+    # connection. To share a smaller pool between many processes run PgBouncer
+    # in transaction mode and set DB_PGBOUNCER=true.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'receipts'),
+            'USER': os.getenv('DB_USER', ''),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': DB_CONN_HEALTH_CHECKS,
+            # Server-side cursors don't survive PgBouncer's transaction pooling
+            'DISABLE_SERVER_SIDE_CURSORS': os.getenv('DB_PGBOUNCER', 'false').lower() == 'true',
+            'OPTIONS': {'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5))},
+        }
     }
-}
+elif DB_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'core.sqlite3',  # WAL and BEGIN IMMEDIATE, see core/sqlite3/base.py
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': DB_CONN_HEALTH_CHECKS,
+            'OPTIONS': {'timeout': float(os.getenv('SQLITE_BUSY_TIMEOUT', 30))},  # seconds to wait for the write lock
+        }
+    }
+else:
+    raise ValueError(f"Unsupported DB_ENGINE: {DB_ENGINE}")
+# WAL rewrites the file header, so the checked-in db.sqlite3 keeps its mode unless asked; set
+# SQLITE_JOURNAL_MODE=WAL (or point DB_NAME at another file) before running several workers on it
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL' if os.getenv('DB_NAME') else '')  # '' leaves it as is
+SQLITE_TRANSACTION_MODE = os.getenv('SQLITE_TRANSACTION_MODE', 'IMMEDIATE')  # or DEFERRED, Django's default
+
+
+# CACHE_BACKEND is 'file' (shared by every process on the host), 'redis' (shared
+# across hosts, needs the redis package) or 'locmem' (one process only).
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'file')
+if CACHE_BACKEND == 'redis':
+    CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('CACHE_LOCATION', 'redis://127.0.0.1:6379/1'),
+    }}
+elif CACHE_BACKEND == 'file':
+    CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'receipt-extractor-cache')),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 10000))},
+    }}
+elif CACHE_BACKEND == 'locmem':
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+else:
+    raise ValueError(f"Unsupported CACHE_BACKEND: {CACHE_BACKEND}")
+DASHBOARD_CACHE = os.getenv('DASHBOARD_CACHE', 'default')  # cache alias for rendered dashboards, see extractor/dashboard.py
+DASHBOARD_CACHE_TIMEOUT = int(os.getenv('DASHBOARD_CACHE_TIMEOUT', 24 * 3600))
+# Sessions are read from the cache and only fall back to the database on a miss
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 
 
 # Password validation
@@ -133,4 +287,27 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media') 
-MEDIA_URL = '/media/' 
\ No newline at end of file
+MEDIA_URL = '/media/' 
+
+
+# Metrics and logging (see extractor/metrics.py)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_ALLOWED_IPS = [net for net in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if net]  # addresses or CIDR ranges
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # scrapers elsewhere send "Authorization: Bearer <token>"
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'correlation_id': {'()': 'extractor.metrics.CorrelationIdFilter'},
+    },
+    'formatters': {
+        'pipeline': {'format': '%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s'},
+    },
+    'handlers': {
+        'pipeline': {'class': 'logging.StreamHandler', 'filters': ['correlation_id'], 'formatter': 'pipeline'},
+    },
+    'loggers': {
+        'extractor': {'handlers': ['pipeline'], 'level': os.getenv('EXTRACTOR_LOG_LEVEL', 'INFO'), 'propagate': False},
+    },
+}
@@ -0,0 +1,26 @@
+"""
+SQLite backend for several concurrent job workers.
+
+Every connection switches the database to ``SQLITE_JOURNAL_MODE``, WAL
+unless it is the checked-in ``db.sqlite3`` (readers no longer block the
+writer), and waits up to ``OPTIONS['timeout']`` seconds for the write lock.
+Transactions start with ``BEGIN IMMEDIATE``: a deferred transaction that reads
+and then writes can't wait for the lock and fails at once with "database is
+locked", while an immediate one queues behind the current writer.
+"""
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        if settings.SQLITE_JOURNAL_MODE:
+            conn.execute(f"PRAGMA journal_mode = {settings.SQLITE_JOURNAL_MODE}")
+        if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == 'wal':
+            # Safe with WAL: a power loss can drop the last commits but never corrupts the file
+            conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f"BEGIN {settings.SQLITE_TRANSACTION_MODE}")
@@ -1,7 +1,10 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import CustomUser, Receipt
+from .models import CustomUser, Receipt, ReceiptJob, Vendor, VendorAlias
 
 admin.site.register(CustomUser)
-admin.site.register(Receipt)
\ No newline at end of file
+admin.site.register(Receipt)
+admin.site.register(ReceiptJob)
+admin.site.register(Vendor)
+admin.site.register(VendorAlias)
\ No newline at end of file
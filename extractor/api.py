@@ -0,0 +1,74 @@
+import zipfile
+
+from django.conf import settings
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .batch import discard_staged, is_supported, stage, to_temporary_upload, unpack_zip
+from .jobs import QueueFull, enqueue
+from .models import ReceiptJob
+
+ZIP_TYPES = ('application/zip', 'application/x-zip-compressed')
+
+
+class BulkReceiptUploadView(APIView):
+    """Upload many receipt files (``files``), or zip archives of them, in one request; they are extracted by a job."""
+    parser_classes = [MultiPartParser]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        files, skipped = [], []
+        try:
+            for upload in request.FILES.getlist('files'):
+                remaining = settings.BULK_UPLOAD_MAX_FILES - len(files)
+                if remaining <= 0:
+                    skipped.append(upload.name)
+                elif upload.content_type in ZIP_TYPES or upload.name.lower().endswith('.zip'):
+                    files.extend(unpack_zip(upload, remaining))
+                elif is_supported(upload.content_type):
+                    files.append(to_temporary_upload(upload))
+                else:
+                    skipped.append(upload.name)
+        except zipfile.BadZipFile:
+            for file, _ in files:
+                file.close()
+            return Response({'error': f'{upload.name} is not a valid zip archive'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if not files:
+            return Response({'error': 'No supported receipt files were uploaded', 'skipped': skipped},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Extraction takes a model call per file, so it runs on the job queue rather than in this request
+        staged = stage(files)
+        try:
+            job = enqueue(ReceiptJob.KIND_RECEIPT_BATCH, request.user, files=staged, skipped=skipped)
+        except QueueFull as e:
+            discard_staged(staged)
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({
+            'job_id': job.pk,
+            'status': job.status,
+            'status_url': reverse('bulk_receipt_job', args=[job.pk]),
+            'files': len(staged),
+            'skipped': skipped,
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class BulkReceiptJobView(APIView):
+    """Status of a bulk upload; ``result`` holds the saved receipts once the job is done."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = get_object_or_404(ReceiptJob, pk=job_id, user=request.user, kind=ReceiptJob.KIND_RECEIPT_BATCH)
+        body = {'job_id': job.pk, 'status': job.status, 'attempts': job.attempts}
+        if job.status == ReceiptJob.STATUS_DONE:
+            body['result'] = job.payload.get('result')
+        elif job.last_error:
+            body['error'] = job.last_error
+        return Response(body)
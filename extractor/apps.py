@@ -4,3 +4,16 @@ from django.apps import AppConfig
 class ExtractorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'extractor'
+
+    def ready(self):
+        from django.conf import settings
+
+        from . import signals  # noqa: F401
+
+        if settings.PRELOAD_ON_STARTUP:
+            from .startup import preload
+            preload()
+
+        if settings.LLM_WARMUP_ON_STARTUP:
+            from .llm import warm_up
+            warm_up()
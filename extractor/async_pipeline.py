@@ -0,0 +1,269 @@
+"""
+Asyncio variant of the receipt pipeline (``run_receipt_workers --mode async``).
+
+Media downloads share one pooled ``httpx.AsyncClient`` and Gemini calls are
+awaited, so a single event loop keeps many jobs in flight while they wait on
+the network. Replies are handed to the notifier's sender threads, which never
+block the loop. Only the ORM goes through ``sync_to_async``;
+CPU-bound steps (PDF parsing, image preprocessing) run on the default
+thread pool.
+"""
+import asyncio
+import hashlib
+import logging
+
+import httpx
+import pandas as pd
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import close_old_connections, connections
+
+from . import jobs, metrics, microbatch, resilience, sandbox
+from .cache import content_hash, extraction_cache
+from .dedupe import async_receipt_flights, find_duplicate
+from .llm import (QUERY_PROMPT, ainvoke_chat, build_query_agent,
+                  get_async_chat_model, get_chat_model, warm_up)
+from .media import MediaTooLarge
+from .metrics import span
+from .models import ReceiptJob
+from .queries import answer_query
+from .tasks import (HANDLERS, MEDIA_TOO_LARGE_MESSAGE, NO_ANSWER_MESSAGE,
+                    media_filename, receipt_reply, save_extracted_receipt, send_whatsapp)
+from .utils import (QUERY_ERROR_MESSAGE, content_size, extractor_version, load_document, receipt_frame,
+                    receipt_request)
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            auth=(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN),
+            timeout=settings.MEDIA_DOWNLOAD_TIMEOUT,
+            limits=httpx.Limits(max_connections=settings.ASYNC_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=settings.ASYNC_HTTP_MAX_CONNECTIONS),
+            # Twilio media URLs redirect to the storage host; httpx drops auth on cross-origin redirects
+            follow_redirects=True,
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def download_media_async(media_url, mime_type, filename):
+    """Async counterpart of ``media.download_media``; returns ``(upload, sha256_hex)``."""
+    max_bytes = settings.RECEIPT_MAX_MEDIA_BYTES
+
+    async with get_client().stream('GET', media_url) as response:
+        response.raise_for_status()
+        declared_size = int(response.headers.get('Content-Length') or 0)
+        if max_bytes and declared_size > max_bytes:
+            raise MediaTooLarge(f"Media is {declared_size} bytes, limit is {max_bytes}")
+
+        upload = TemporaryUploadedFile(filename, mime_type, 0, None)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async for chunk in response.aiter_bytes(settings.MEDIA_DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise MediaTooLarge(f"Media exceeds the {max_bytes} byte limit")
+                digest.update(chunk)
+                upload.write(chunk)
+            upload.flush()
+            upload.seek(0)
+        except BaseException:
+            upload.close()
+            raise
+
+    upload.size = size
+    return upload, digest.hexdigest()
+
+
+async def aprocess_receipt(file_path, mime_type=None):
+    try:
+        with span('load_document', mime_type=mime_type) as fields:
+            content, mime_type = await asyncio.to_thread(load_document, file_path, mime_type)
+            fields['bytes'] = content_size(content)
+
+        with span('cache_lookup') as fields:
+            cache_key = content_hash(content, mime_type, extractor_version(mime_type))
+            cached = await sync_to_async(extraction_cache.get)(cache_key)
+            fields['hit'] = cached is not None
+        if cached is not None:
+            return cached
+
+        models, parts, message = await asyncio.to_thread(receipt_request, content, mime_type)
+        result, problems = await microbatch.aextract(models, parts, message, ainvoke_chat)
+        if not problems:
+            await sync_to_async(extraction_cache.set)(cache_key, result)
+        return result
+
+    except resilience.Unavailable:
+        raise
+    except Exception as e:
+        logger.error("Error extracting receipt: %s", e)
+        return {}
+
+
+async def aprocess_receipt_query(user, query):
+    if settings.QUERY_FAST_PATH_ENABLED:
+        with span('query_fast_path') as fields:
+            answer = await sync_to_async(answer_query)(user, query)
+            fields['hit'] = answer is not None
+        if answer is not None:
+            return answer
+
+    df = await sync_to_async(receipt_frame)(user)
+    prompt = QUERY_PROMPT.format(query=query)
+    # Tool calls reach the sandbox from executor threads, so the loop never waits on a worker
+    session = sandbox.Session(df) if settings.QUERY_SANDBOX_ENABLED else None
+
+    try:
+        # Agents hold REPL state, so each query gets its own on top of the shared model
+        with span('query_agent'):
+            if settings.GEMINI_TRANSPORT == 'rest':
+                agent, python_tool = build_query_agent(get_chat_model(settings.GEMINI_TEXT_MODEL), {"df": df, "pd": pd})
+                run = (asyncio.to_thread, agent.invoke, prompt)
+            else:
+                agent, python_tool = build_query_agent(get_async_chat_model(settings.GEMINI_TEXT_MODEL),
+                                                       {"df": df, "pd": pd})
+                run = (agent.ainvoke, prompt)
+            python_tool.sandbox = session
+            result = await resilience.acall(settings.GEMINI_TEXT_MODEL, *run,
+                                            timeout=settings.GEMINI_AGENT_TIMEOUT, hedge=False)
+        return result.get('output', '')
+
+    except resilience.Unavailable:
+        raise
+    except Exception as e:
+        logger.error("Error answering query: %s", e)
+        return QUERY_ERROR_MESSAGE
+    finally:
+        if session is not None:
+            await asyncio.to_thread(session.close)
+
+
+async def extract_and_save_async(user, upload, media_hash, mime_type):
+    existing = await sync_to_async(find_duplicate)(user, media_hash)
+    if existing is not None:
+        return existing, receipt_reply(existing, duplicate=True)
+
+    extracted_data = await aprocess_receipt(upload.temporary_file_path(), mime_type)
+    logger.info("Extracted %s", extracted_data)
+    return await sync_to_async(save_extracted_receipt)(user, upload, media_hash, extracted_data)
+
+
+async def process_receipt_job_async(job):
+    media_url = job.payload['media_url']
+    mime_type = job.payload['mime_type']
+    user_phone = job.payload['user_phone']
+
+    try:
+        with span('download', mime_type=mime_type) as fields:
+            upload, media_hash = await download_media_async(media_url, mime_type, media_filename(media_url, mime_type))
+            fields['bytes'] = upload.size
+    except MediaTooLarge as e:
+        logger.warning(str(e))
+        send_whatsapp(user_phone, MEDIA_TOO_LARGE_MESSAGE)
+        return
+
+    try:
+        (receipt, reply), shared = await async_receipt_flights.do((job.user_id, media_hash), extract_and_save_async,
+                                                                  job.user, upload, media_hash, mime_type)
+        if shared and receipt is not None:
+            reply = receipt_reply(receipt, duplicate=True)
+    finally:
+        upload.close()
+
+    send_whatsapp(user_phone, reply)
+
+
+async def process_query_job_async(job):
+    user_phone = job.payload['user_phone']
+
+    result = await aprocess_receipt_query(user=job.user, query=job.payload['message'])
+    logger.info("Query answer: %s", result)
+
+    send_whatsapp(user_phone, result or NO_ANSWER_MESSAGE)
+
+
+def _run_sync_handler(job):
+    try:
+        HANDLERS[job.kind](job)
+    finally:
+        connections.close_all()
+
+
+async def process_batch_job_async(job):
+    # Batches already fan out over their own thread pool
+    await asyncio.to_thread(_run_sync_handler, job)
+
+
+ASYNC_HANDLERS = {
+    ReceiptJob.KIND_RECEIPT: process_receipt_job_async,
+    ReceiptJob.KIND_RECEIPT_BATCH: process_batch_job_async,
+    ReceiptJob.KIND_QUERY: process_query_job_async,
+}
+
+
+async def run_job_async(job):
+    # Each task runs in its own context, so the correlation id stays with this job
+    metrics.correlation_id.set(jobs.job_correlation_id(job))
+    metrics.IN_FLIGHT.inc(kind=job.kind)
+    try:
+        with span('job', kind=job.kind, attempt=job.attempts):
+            await ASYNC_HANDLERS[job.kind](job)
+    except Exception as e:
+        await sync_to_async(jobs.job_failed)(job, e)
+    else:
+        await sync_to_async(jobs.job_done)(job)
+    finally:
+        metrics.IN_FLIGHT.dec(kind=job.kind)
+
+
+async def run_async_pool(concurrency, poll_interval):
+    """Claim jobs and run up to ``concurrency`` of them at once on the running event loop."""
+    try:
+        await asyncio.to_thread(warm_up)
+    except Exception as e:
+        logger.warning("Error warming up LLM clients: %s", e)
+
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                await sync_to_async(close_old_connections)()
+                job = await sync_to_async(jobs.claim_next)()
+            except Exception as e:
+                logger.error("Error claiming job: %s", e)
+                job = None
+
+            if job is None:
+                slots.release()
+                try:
+                    await sync_to_async(jobs.purge_done)()
+                except Exception as e:
+                    logger.warning("Error purging done jobs: %s", e)
+                await asyncio.sleep(poll_interval)
+                continue
+
+            task = asyncio.create_task(run_job_async(job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+    finally:
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        await close_client()
@@ -0,0 +1,230 @@
+"""
+Bulk receipt ingestion shared by the REST upload API and multi-media
+WhatsApp messages: extraction fans out over a bounded thread pool and the
+valid results are written with a single ``bulk_create``. Both run on the job
+queue; the API saves its uploads to storage with ``stage`` so the job worker
+can read them back.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import uuid
+import zipfile
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.db import close_old_connections
+
+from . import dashboard, rollups
+from .forms import ReceiptForm
+from .frames import receipt_frames
+from .metrics import propagate, span
+from .models import Receipt
+from .resilience import Unavailable
+from .vendors import assign_vendor
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_TYPES = ('image/', 'application/pdf')
+STAGING_DIR = 'bulk-uploads'
+
+
+def is_supported(mime_type):
+    return bool(mime_type) and mime_type.startswith(SUPPORTED_TYPES)
+
+
+def to_temporary_upload(upload):
+    """Return ``(upload, sha256_hex)`` with the upload backed by a file on disk."""
+    digest = hashlib.sha256()
+    if hasattr(upload, 'temporary_file_path'):
+        for chunk in upload.chunks():
+            digest.update(chunk)
+        upload.seek(0)
+        return upload, digest.hexdigest()
+
+    temporary = TemporaryUploadedFile(upload.name, upload.content_type, upload.size, upload.charset)
+    for chunk in upload.chunks():
+        digest.update(chunk)
+        temporary.write(chunk)
+    temporary.flush()
+    temporary.seek(0)
+    return temporary, digest.hexdigest()
+
+
+def unpack_zip(upload, limit):
+    """
+    Yield ``(TemporaryUploadedFile, sha256_hex)`` for up to ``limit`` supported files in a zip upload.
+
+    Raises ``zipfile.BadZipFile`` if the upload is not a readable zip archive.
+    """
+    max_bytes = settings.RECEIPT_MAX_MEDIA_BYTES
+    with zipfile.ZipFile(upload) as archive:
+        for member in archive.infolist():
+            # Only as many files as one batch ingests ever reach the disk
+            if limit <= 0:
+                return
+            name = os.path.basename(member.filename)
+            mime_type, _ = mimetypes.guess_type(name)
+            if (member.is_dir() or not name or not is_supported(mime_type)
+                    or (max_bytes and member.file_size > max_bytes)):
+                continue
+
+            temporary = TemporaryUploadedFile(name, mime_type, member.file_size, None)
+            digest = hashlib.sha256()
+            try:
+                with archive.open(member) as source:
+                    while chunk := source.read(settings.MEDIA_DOWNLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                        temporary.write(chunk)
+            except (zlib.error, EOFError) as e:
+                temporary.close()
+                raise zipfile.BadZipFile(f"Corrupt member {member.filename}: {e}") from e
+            except BaseException:
+                temporary.close()
+                raise
+            temporary.flush()
+            temporary.seek(0)
+            limit -= 1
+            yield temporary, digest.hexdigest()
+
+
+def stage(files):
+    """
+    Save ``(upload, sha256_hex)`` pairs to storage for a batch job; returns the job's ``files`` payload.
+
+    Every upload is closed afterwards.
+    """
+    batch = uuid.uuid4().hex
+    staged = []
+    try:
+        for upload, media_hash in files:
+            path = default_storage.save(f'{STAGING_DIR}/{batch}-{upload.name}', upload)
+            staged.append({'path': path, 'name': upload.name, 'mime_type': upload.content_type, 'sha256': media_hash})
+    except BaseException:
+        discard_staged(staged)
+        raise
+    finally:
+        for upload, _ in files:
+            upload.close()
+    return staged
+
+
+def unstage(item):
+    """Return ``(upload, sha256_hex)`` for a file saved by ``stage``, copied to a temporary file."""
+    with default_storage.open(item['path']) as source:
+        upload, _ = to_temporary_upload(UploadedFile(source, item['name'], item['mime_type'], source.size))
+    return upload, item['sha256']
+
+
+def discard_staged(staged):
+    for item in staged:
+        default_storage.delete(item['path'])
+
+
+def _extract(upload):
+    # The extraction stack (LLM clients, PDF and image libraries) loads on the first upload
+    from .utils import process_receipt
+
+    try:
+        return process_receipt(upload.temporary_file_path(), upload.content_type)
+    except Unavailable as e:
+        # Reported as failed like an unreadable file, so the rest of the batch is still saved
+        logger.warning("Model unavailable for %s: %s", upload.name, e)
+        return None
+    finally:
+        # Pool threads open their own database connections for the extraction cache
+        close_old_connections()
+
+
+def extract_all(uploads):
+    """Run ``process_receipt`` over the uploads on a bounded pool, preserving order."""
+    if not uploads:
+        return []
+    with ThreadPoolExecutor(max_workers=settings.BULK_EXTRACTION_WORKERS) as pool:
+        return list(pool.map(propagate(_extract), uploads))
+
+
+def ingest(user, files):
+    """
+    Extract and save a batch of ``(upload, sha256_hex)`` pairs for ``user``.
+
+    Returns ``(receipts, failed_names)``. Files past ``BULK_UPLOAD_MAX_FILES`` are
+    ignored; every upload is closed afterwards.
+    """
+    accepted = files[:settings.BULK_UPLOAD_MAX_FILES]
+    try:
+        results = extract_all([upload for upload, _ in accepted])
+
+        receipts, failed = [], []
+        for (upload, media_hash), extracted_data in zip(accepted, results):
+            extracted_data = extracted_data if isinstance(extracted_data, dict) else {}
+            form = ReceiptForm({
+                'date': extracted_data.get('date'),
+                'vendor': extracted_data.get('vendor'),
+                'total_amount': extracted_data.get('total_amount'),
+            }, files={'file': upload})
+            if form.is_valid():
+                receipt = form.save(commit=False)
+                receipt.user = user
+                receipt.content_hash = media_hash
+                assign_vendor(receipt)
+                receipts.append(receipt)
+            else:
+                logger.warning("Invalid receipt data in %s: %s", upload.name, form.errors.as_json())
+                failed.append(upload.name)
+
+        # bulk_create skips the Receipt signals, so the rollup, query frame and dashboard are updated here
+        with span('save', count=len(receipts)):
+            Receipt.objects.bulk_create(receipts)
+        receipt_frames.invalidate(user.pk)
+        day_totals = defaultdict(lambda: [Decimal('0'), 0])
+        for receipt in receipts:
+            day_totals[receipt.date][0] += receipt.total_amount or Decimal('0')
+            day_totals[receipt.date][1] += 1
+        for day, (amount, count) in day_totals.items():
+            rollups.apply_delta(user.pk, day, amount, count)
+        dashboard.bump(user.pk)
+
+        return receipts, failed
+    finally:
+        for upload, _ in files:
+            upload.close()
+
+
+def summary_message(receipts, failed, skipped=()):
+    lines = [f"Processed {len(receipts) + len(failed)} receipts: {len(receipts)} saved, {len(failed)} failed."]
+    for receipt in receipts[:10]:
+        day = receipt.date.strftime('%d-%m-%Y') if receipt.date else 'no date'
+        lines.append(f"- {receipt.vendor or 'Unknown vendor'}: ${receipt.total_amount:.2f} ({day})")
+    if len(receipts) > 10:
+        lines.append(f"...and {len(receipts) - 10} more")
+    if receipts:
+        total = sum((receipt.total_amount or Decimal('0') for receipt in receipts), Decimal('0'))
+        lines.append(f"Total: ${total:.2f}")
+    if failed:
+        lines.append("Could not read: " + ', '.join(failed[:10]))
+    if skipped:
+        lines.append("Skipped (not an image or PDF, or over the limit): " + ', '.join(skipped[:10]))
+    return '\n'.join(lines)
+
+
+def batch_result(receipts, failed, skipped):
+    """What the bulk upload API reports for a finished batch job."""
+    return {
+        'created': len(receipts),
+        'failed': failed,
+        'skipped': skipped,
+        'summary': summary_message(receipts, failed, skipped),
+        'receipts': [{
+            'date': receipt.date.isoformat() if receipt.date else None,
+            'vendor': receipt.vendor,
+            'total_amount': str(receipt.total_amount) if receipt.total_amount is not None else None,
+            'file': receipt.file.name,
+        } for receipt in receipts],
+    }
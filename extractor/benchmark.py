@@ -0,0 +1,379 @@
+"""
+Offline load test of the WhatsApp ingestion path (``manage.py benchmark_whatsapp``).
+
+Synthetic Twilio webhook POSTs are replayed against ``process_whatsapp_receipt``
+while the job workers run in-process. Twilio media, Twilio messages and Gemini
+are served by a local stub server, so nothing leaves the machine and the
+Gemini latency can be dialled in. Everything runs against a throwaway SQLite
+database and MEDIA_ROOT.
+"""
+import json
+import mimetypes
+import os
+import random
+import re
+import resource
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fitz
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import Client
+from faker import Faker
+
+from . import metrics, resilience
+from .models import CustomUser, Receipt, ReceiptJob
+from .notifier import notifier
+
+fake = Faker()
+
+QUERIES = [
+    lambda vendor: "How much did I spend this month?",
+    lambda vendor: "How many receipts do I have?",
+    lambda vendor: f"How much did I spend at {vendor}?",
+    lambda vendor: "What are my top 3 vendors?",
+    # Not covered by the rule-based fast path, so these exercise the agent
+    lambda vendor: f"Compare my spending at {vendor} with last month",
+    lambda vendor: "What is the trend of my monthly spending?",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def receipt_pdf():
+    """A one-page text PDF receipt generated with Faker."""
+    with fitz.open() as pdf_document:
+        page = pdf_document.new_page()
+        lines = [fake.company(), fake.address(), fake.date_between(start_date='-1y').strftime('%d-%m-%Y'), '']
+        lines += [f"{fake.word().title():<20} {random.randrange(100, 5000) / 100:>8.2f}" for _ in range(5)]
+        lines.append(f"{'TOTAL':<20} {random.randrange(1000, 20000) / 100:>8.2f}")
+        page.insert_text((72, 72), '\n'.join(lines), fontsize=11)
+        return pdf_document.tobytes()
+
+
+def load_media(directory, pdfs=3):
+    """Return ``{name: (bytes, mime_type)}`` from ``directory`` plus a few generated PDFs."""
+    media = {}
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            mime_type, _ = mimetypes.guess_type(name)
+            path = os.path.join(directory, name)
+            if mime_type and mime_type.startswith('image/') and os.path.getsize(path):
+                with open(path, 'rb') as f:
+                    media[name] = (f.read(), mime_type)
+    for index in range(pdfs):
+        media[f"generated-{index}.pdf"] = (receipt_pdf(), 'application/pdf')
+    return media
+
+
+class StubServer:
+    """
+    Serves Twilio media (GET /Media/<name>), Twilio messages
+    (POST .../Messages.json) and Gemini generateContent, with optional
+    Gemini errors and slow responses.
+    """
+
+    def __init__(self, media, gemini_latency=0.0, twilio_latency=0.0, gemini_error_rate=0.0,
+                 gemini_slow_rate=0.0, gemini_slow_latency=0.0):
+        self.media = media
+        self.gemini_latency = gemini_latency
+        # Injected faults: a share of Gemini calls fail with 503 or take gemini_slow_latency instead
+        self.gemini_error_rate = gemini_error_rate
+        self.gemini_slow_rate = gemini_slow_rate
+        self.gemini_slow_latency = gemini_slow_latency
+        self.twilio_latency = twilio_latency
+        self.requests = Counter()
+        self.sent = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def _count(self, name, message=None):
+        with self._lock:
+            self.requests[name] += 1
+            if message is not None:
+                self.sent.append(message)
+
+    @staticmethod
+    def receipt():
+        return {
+            'date': fake.date_between(start_date='-1y').strftime('%d-%m-%Y'),
+            'vendor': fake.company(),
+            'total_amount': random.randrange(100, 20000) / 100,
+        }
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def reply(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                name = self.path.rsplit('/', 1)[-1]
+                if name not in stub.media:
+                    return self.reply(404, b'{}')
+                stub._count('media')
+                time.sleep(stub.twilio_latency)
+                data, mime_type = stub.media[name]
+                self.reply(200, data, mime_type)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.path.endswith('/Messages.json'):
+                    stub._count('messages', body)
+                    time.sleep(stub.twilio_latency)
+                    return self.reply(201, json.dumps({'sid': f"SM{fake.md5()}", 'status': 'queued'}).encode())
+
+                stub._count('gemini')
+                roll = random.random()
+                if roll < stub.gemini_error_rate:
+                    stub._count('gemini_errors')
+                    return self.reply(503, json.dumps({'error': {
+                        'code': 503, 'message': 'The model is overloaded.', 'status': 'UNAVAILABLE'}}).encode())
+                if roll < stub.gemini_error_rate + stub.gemini_slow_rate:
+                    stub._count('gemini_slow')
+                    time.sleep(stub.gemini_slow_latency)
+                else:
+                    time.sleep(stub.gemini_latency)
+                batch = re.search(rb'(\d+) receipts follow', body)
+                if batch:
+                    text = json.dumps([{'receipt': number, **stub.receipt()}
+                                       for number in range(1, int(batch.group(1)) + 1)])
+                    stub._count('gemini_batched')
+                elif b'receipt processing expert' in body:
+                    text = json.dumps(stub.receipt())
+                elif b"Action Input: df['total_amount']" in body:
+                    text = f"Final Answer: You spent ${random.randrange(100, 20000) / 100:.2f}."
+                else:
+                    # One tool step first, so agent queries run pandas code like the real model's do
+                    text = "Thought: I should add up the totals.\nAction: python_repl_ast\n" \
+                           "Action Input: df['total_amount'].sum()"
+                self.reply(200, json.dumps({'candidates': [{
+                    'content': {'parts': [{'text': text}], 'role': 'model'},
+                    'finishReason': 'STOP',
+                    'index': 0,
+                }]}).encode())
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class QueryCounter:
+    """Counts SQL queries on every connection, split by the phase set on the calling thread."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def set_phase(self, name):
+        self._local.phase = name
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.counts[getattr(self._local, 'phase', 'worker')] += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def start(self):
+        connection_created.connect(self.install)
+        if connection.connection is not None:
+            self.install(connection=connection)
+
+    def stop(self):
+        connection_created.disconnect(self.install)
+
+
+def seed_users(count, receipts_per_user):
+    users = []
+    for index in range(count):
+        user = CustomUser.objects.create(phone_number=f"+1555{index:07d}", name=fake.name())
+        Receipt.objects.bulk_create([Receipt(
+            user=user,
+            date=fake.date_between(start_date='-1y', end_date='today'),
+            vendor=fake.company(),
+            total_amount=Decimal(random.randrange(10, 5001)) / 100,
+        ) for _ in range(receipts_per_user)])
+        users.append(user)
+    return users
+
+
+def build_messages(count, users, media, media_url, query_ratio=0.2, batch_ratio=0.05):
+    """Return Twilio webhook form payloads: single receipts, multi-media batches and queries."""
+    names = list(media)
+    vendors = list(Receipt.objects.values_list('vendor', flat=True).distinct()[:50]) or [fake.company()]
+    messages = []
+    for _ in range(count):
+        user = random.choice(users)
+        data = {'From': f"whatsapp:{user.phone_number}", 'To': f"whatsapp:{settings.TWILIO_NUMBER}",
+                'MessageSid': f"SM{fake.md5()}", 'Body': '', 'NumMedia': '0'}
+        roll = random.random()
+        if roll < query_ratio or not names:
+            data['Body'] = random.choice(QUERIES)(random.choice(vendors))
+        else:
+            picked = random.sample(names, min(len(names), random.randint(2, 4))) if roll < query_ratio + batch_ratio \
+                else [random.choice(names)]
+            data['NumMedia'] = str(len(picked))
+            for index, name in enumerate(picked):
+                data[f'MediaUrl{index}'] = f"{media_url}/Media/{name}"
+                data[f'MediaContentType{index}'] = media[name][1]
+        messages.append(data)
+    return messages
+
+
+def replay(messages, concurrency, counter):
+    """POST every message to the webhook and return the per-request latencies in ms."""
+    local = threading.local()
+
+    def post(data):
+        if not hasattr(local, 'client'):
+            local.client = Client(enforce_csrf_checks=True)
+            counter.set_phase('webhook')
+        started = time.perf_counter()
+        response = local.client.post('/process_whatsapp_receipt/', data)
+        elapsed = (time.perf_counter() - started) * 1000
+        if response.status_code != 200:
+            raise RuntimeError(f"Webhook returned {response.status_code}")
+        return elapsed
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(post, messages))
+
+
+def start_workers(workers, mode, poll_interval):
+    """Start the job workers in-process and return a function that stops them."""
+    from . import jobs
+
+    if mode == 'async':
+        import asyncio
+
+        from .async_pipeline import run_async_pool
+
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(run_async_pool(workers, poll_interval))
+
+        def run():
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                loop.close()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+        return stop
+
+    stop_event = threading.Event()
+    pool = [threading.Thread(target=jobs.work, args=(stop_event, poll_interval), daemon=True)
+            for _ in range(workers)]
+    for worker in pool:
+        worker.start()
+
+    def stop():
+        stop_event.set()
+        for worker in pool:
+            worker.join()
+    return stop
+
+
+def wait_for_jobs(timeout):
+    pending = (ReceiptJob.STATUS_QUEUED, ReceiptJob.STATUS_RUNNING)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not ReceiptJob.objects.filter(status__in=pending).exists():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def stage_means():
+    means = {}
+    for (stage,), (counts, total) in metrics.STAGE_SECONDS._values.items():
+        means[stage] = round(total / counts[-1] * 1000, 1) if counts[-1] else 0
+    return means
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(messages, users, concurrency, workers, mode, stub, counter, timeout=600, poll_interval=0.05):
+    """Replay ``messages`` with the workers running and return the report dict."""
+    stop_workers = start_workers(workers, mode, poll_interval)
+    try:
+        counter.set_phase('monitor')
+        started = time.perf_counter()
+        latencies = replay(messages, concurrency, counter)
+        replayed = time.perf_counter() - started
+        drained = wait_for_jobs(timeout) and notifier.flush(timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        stop_workers()
+
+    jobs = list(ReceiptJob.objects.values('kind', 'status', 'created_at', 'updated_at'))
+    completion = [(job['updated_at'] - job['created_at']).total_seconds() * 1000
+                  for job in jobs if job['status'] == ReceiptJob.STATUS_DONE]
+    return {
+        'mode': mode,
+        'messages': len(messages),
+        'users': users,
+        'concurrency': concurrency,
+        'workers': workers,
+        'drained': drained,
+        'webhook_ms': {f'p{pct}': round(percentile(latencies, pct), 1) for pct in (50, 95, 99)},
+        'job_ms': {f'p{pct}': round(percentile(completion, pct), 1) for pct in (50, 95, 99)},
+        'replay_seconds': round(replayed, 2),
+        'completion_seconds': round(elapsed, 2),
+        'throughput_per_second': round(len(messages) / elapsed, 2) if elapsed else 0,
+        'jobs': dict(Counter(f"{job['kind']}:{job['status']}" for job in jobs)),
+        'receipts_saved': Receipt.objects.filter(file__startswith='receipts/').count(),
+        'queries': {
+            'webhook': counter.counts['webhook'],
+            'webhook_per_message': round(counter.counts['webhook'] / len(messages), 1) if messages else 0,
+            'worker': counter.counts['worker'],
+            'worker_per_job': round(counter.counts['worker'] / len(jobs), 1) if jobs else 0,
+        },
+        'stage_mean_ms': stage_means(),
+        'stub_requests': dict(stub.requests),
+        'gemini_calls': {'/'.join(key): int(value) for key, value in resilience.CALLS._values.items()},
+        'gemini_hedges': {'/'.join(key): int(value) for key, value in resilience.HEDGES._values.items()},
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
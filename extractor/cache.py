@@ -0,0 +1,147 @@
+"""
+Content-addressed cache of receipt extraction results.
+
+Results are keyed by the SHA-256 of the normalized document bytes returned by
+``load_document`` together with what extracted them (the model cascade and
+prompts, see ``utils.extractor_version``), so changing either stops old
+results from being served. They are stored in the ``ExtractionCache`` table, with a small
+in-process LRU in front so repeated forwards skip the database as well.
+Rows past the TTL or ``EXTRACTION_CACHE_MAX_ENTRIES`` are evicted by stores,
+at most once per ``EVICT_INTERVAL``.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ExtractionCache
+
+logger = logging.getLogger(__name__)
+
+EVICT_INTERVAL = 300  # seconds between evictions of old rows, per process
+
+
+def content_hash(content, mime_type, version=''):
+    # Multi-page documents are a list of per-page text or image bytes
+    parts = content if isinstance(content, list) else [content]
+    digest = hashlib.sha256(mime_type.encode('utf-8'))
+    if version:
+        digest.update(b'\0')
+        digest.update(version.encode('utf-8'))
+    for part in parts:
+        digest.update(b'\0')
+        digest.update(part.encode('utf-8') if isinstance(part, str) else part)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_evict = float('-inf')
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def get(self, key):
+        if not settings.EXTRACTION_CACHE_ENABLED:
+            return None
+
+        ttl = settings.EXTRACTION_CACHE_TTL
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, stored_at = entry
+                if ttl and time.monotonic() - stored_at > ttl:
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return dict(result)
+
+        cutoff = timezone.now() - timedelta(seconds=ttl) if ttl else None
+        try:
+            row = ExtractionCache.objects.filter(content_hash=key).values_list('result', 'last_hit_at').first()
+            if row is not None and not (cutoff and row[1] < cutoff):
+                ExtractionCache.objects.filter(content_hash=key).update(hits=F('hits') + 1, last_hit_at=timezone.now())
+        except DatabaseError as e:
+            # A busy cache table must never fail the extraction itself
+            logger.warning("Extraction cache lookup failed: %s", e)
+            row = None
+        if row is None or (cutoff and row[1] < cutoff):
+            self._count('misses')
+            return None
+
+        result = row[0]
+        self._remember(key, result)
+        self._count('db_hits')
+        return dict(result)
+
+    def set(self, key, result):
+        if not settings.EXTRACTION_CACHE_ENABLED or not result:
+            return
+
+        self._remember(key, result)
+        try:
+            ExtractionCache.objects.update_or_create(content_hash=key, defaults={
+                'result': result,
+                'last_hit_at': timezone.now(),
+            })
+            if self._evict_due():
+                self.evict()
+        except IntegrityError:
+            # Another worker stored the same document first
+            pass
+        except DatabaseError as e:
+            logger.warning("Extraction cache store failed: %s", e)
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = (result, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.EXTRACTION_CACHE_LRU_SIZE:
+                self._entries.popitem(last=False)
+
+    def _evict_due(self):
+        # Eviction scans the table, so it runs at most once per EVICT_INTERVAL rather than on every store
+        with self._lock:
+            if time.monotonic() - self._last_evict < EVICT_INTERVAL:
+                return False
+            self._last_evict = time.monotonic()
+            return True
+
+    def evict(self):
+        """Drop database rows that outlived the TTL or exceed the size limit, least recently hit first."""
+        evicted = 0
+        if settings.EXTRACTION_CACHE_TTL:
+            cutoff = timezone.now() - timedelta(seconds=settings.EXTRACTION_CACHE_TTL)
+            evicted += ExtractionCache.objects.filter(last_hit_at__lt=cutoff).delete()[0]
+
+        max_entries = settings.EXTRACTION_CACHE_MAX_ENTRIES
+        if max_entries:
+            stale_ids = list(ExtractionCache.objects
+                             .order_by('-last_hit_at')
+                             .values_list('id', flat=True)[max_entries:])
+            if stale_ids:
+                evicted += ExtractionCache.objects.filter(id__in=stale_ids).delete()[0]
+
+        if evicted:
+            self._count('evictions', evicted)
+        return evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._last_evict = float('-inf')
+
+
+extraction_cache = ResultCache()
@@ -0,0 +1,126 @@
+"""
+Model cascade for receipt extraction.
+
+Each document is sent to the first model of its cascade
+(``EXTRACTION_VISION_MODELS`` or ``EXTRACTION_TEXT_MODELS``, fast and cheap
+models first) and the JSON is checked the way ``ReceiptForm`` will check it
+when the receipt is saved, plus that the required fields are present. Only
+a result that is missing fields, fails validation or doesn't parse is sent
+to the next model; the last one's answer is kept whatever it is (or the
+best earlier one, if that had fewer problems). Every tier records its
+latency and outcome, so the share of receipts finished on the fast tier
+shows on ``/metrics``.
+"""
+import logging
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .forms import ReceiptForm
+from .llm import JSON_PARSER
+from .metrics import span
+
+logger = logging.getLogger(__name__)
+
+TIER_SECONDS = metrics.Histogram('extraction_tier_seconds', 'Duration of each extraction attempt by model', ['model'])
+TIER_RESULTS = metrics.Counter('extraction_tier_results_total',
+                               'Extraction attempts by model and outcome (accepted, escalated, exhausted, error)',
+                               ['model', 'outcome'])
+
+
+def extraction_problems(result):
+    """Return what is wrong with an extraction result; an empty list means it can be saved as is."""
+    if not isinstance(result, dict):
+        return ['not a JSON object']
+
+    problems = [f"missing {field}" for field in settings.EXTRACTION_REQUIRED_FIELDS
+                if result.get(field) in (None, '')]
+    form = ReceiptForm({field: result.get(field) for field in ('date', 'vendor', 'total_amount')})
+    form.is_valid()
+    # The file is attached when saving; only the extracted fields are checked here
+    problems += [f"invalid {field}" for field in form.errors if field != 'file']
+    return problems
+
+
+class Cascade:
+    """Tracks the attempts of one extraction and decides when to stop."""
+
+    def __init__(self, models):
+        self.models = models
+        self.best = None
+        self.best_problems = None
+        self.error = None
+
+    def record(self, tier, model_name, seconds, result=None, error=None):
+        """Record one attempt that took ``seconds``; returns True when no further tier should be tried."""
+        TIER_SECONDS.observe(seconds, model=model_name)
+        final = tier == len(self.models) - 1
+        problems = [f"error: {error}"] if error is not None else extraction_problems(result)
+        if error is not None:
+            self.error = error
+
+        if error is None and (self.best_problems is None or len(problems) <= len(self.best_problems)):
+            self.best, self.best_problems = result, problems
+        if not problems:
+            TIER_RESULTS.inc(model=model_name, outcome='accepted')
+            return True
+        if final:
+            TIER_RESULTS.inc(model=model_name, outcome='error' if error is not None else 'exhausted')
+            return True
+
+        TIER_RESULTS.inc(model=model_name, outcome='error' if error is not None else 'escalated')
+        logger.info("Escalating extraction from %s: %s", model_name, ', '.join(problems))
+        return False
+
+    def run(self, message, invoke, start=0):
+        """Call ``invoke(model_name, messages)`` from tier ``start`` down until a tier is accepted."""
+        for tier, model_name in enumerate(self.models[start:], start):
+            started = time.perf_counter()
+            try:
+                with span('llm', model=model_name, tier=tier) as fields:
+                    response = invoke(model_name, [message])
+                    fields['bytes'] = len(response.content)
+                with span('parse'):
+                    result = JSON_PARSER.parse(response.content)
+            except Exception as e:
+                done = self.record(tier, model_name, time.perf_counter() - started, error=e)
+            else:
+                done = self.record(tier, model_name, time.perf_counter() - started, result=result)
+            if done:
+                break
+        return self.result()
+
+    async def arun(self, message, ainvoke, start=0):
+        """Async counterpart of ``run`` for an awaitable ``ainvoke(model_name, messages)``."""
+        for tier, model_name in enumerate(self.models[start:], start):
+            started = time.perf_counter()
+            try:
+                with span('llm', model=model_name, tier=tier) as fields:
+                    response = await ainvoke(model_name, [message])
+                    fields['bytes'] = len(response.content)
+                with span('parse'):
+                    result = JSON_PARSER.parse(response.content)
+            except Exception as e:
+                done = self.record(tier, model_name, time.perf_counter() - started, error=e)
+            else:
+                done = self.record(tier, model_name, time.perf_counter() - started, result=result)
+            if done:
+                break
+        return self.result()
+
+    def result(self):
+        """Return ``(result, problems)``; raises if no tier produced a usable answer."""
+        if self.best is None:
+            raise self.error or ValueError("No extraction models are configured")
+        return self.best, self.best_problems
+
+
+def extract(models, message, invoke):
+    """Run ``invoke(model_name, messages)`` down the cascade and return ``(result, problems)``."""
+    return Cascade(models).run(message, invoke)
+
+
+async def aextract(models, message, ainvoke):
+    """Async counterpart of ``extract`` for an awaitable ``ainvoke(model_name, messages)``."""
+    return await Cascade(models).arun(message, ainvoke)
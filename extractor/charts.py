@@ -0,0 +1,90 @@
+"""
+Spending series for the dashboard chart (``/api/chart/``).
+
+Totals are bucketed by day, week or month in SQL over the ``DailySpend``
+rollup, then reduced with Largest-Triangle-Three-Buckets to at most
+``max_points`` points, which keeps the peaks and dips a plain stride would
+drop. The response is columnar (one array per field) and encoded with
+orjson, so its size depends on the point budget, not on the user's history.
+"""
+from django.db.models import Sum
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek
+
+from .models import DailySpend
+
+GRANULARITIES = {
+    'day': TruncDay,
+    'week': TruncWeek,
+    'month': TruncMonth,
+}
+
+
+def spend_series(user, granularity='day', start=None, end=None):
+    """Return ``(dates, totals, counts)`` for each bucket with spending, oldest first."""
+    rows = DailySpend.objects.filter(user=user, date__isnull=False)
+    if start:
+        rows = rows.filter(date__gte=start)
+    if end:
+        rows = rows.filter(date__lte=end)
+    rows = (rows.annotate(bucket=GRANULARITIES[granularity]('date'))
+            .values('bucket')
+            .annotate(bucket_total=Sum('total'), bucket_count=Sum('count'))
+            .order_by('bucket')
+            .values_list('bucket', 'bucket_total', 'bucket_count'))
+
+    dates, totals, counts = [], [], []
+    for bucket, total, count in rows:
+        dates.append(bucket)
+        totals.append(round(float(total or 0), 2))
+        counts.append(count)
+    return dates, totals, counts
+
+
+def lttb(xs, ys, max_points):
+    """Indices of the points Largest-Triangle-Three-Buckets keeps out of ``(xs, ys)``."""
+    size = len(xs)
+    if max_points >= size:
+        return list(range(size))
+    if max_points < 3:
+        # No room for a bucket between the ends
+        return [0, size - 1][:max(max_points, 0)]
+
+    kept = [0]
+    # First and last points are always kept; the rest is split into max_points - 2 buckets
+    every = (size - 2) / (max_points - 2)
+    previous = 0
+    for bucket in range(max_points - 2):
+        start = int(bucket * every) + 1
+        stop = int((bucket + 1) * every) + 1
+        next_stop = min(int((bucket + 2) * every) + 1, size)
+        # The third corner is the average of the next bucket (or the last point)
+        following = range(stop, next_stop) if stop < size - 1 else range(size - 1, size)
+        average_x = sum(xs[index] for index in following) / len(following)
+        average_y = sum(ys[index] for index in following) / len(following)
+
+        best, best_area = start, -1.0
+        for index in range(start, stop):
+            area = abs((xs[previous] - average_x) * (ys[index] - ys[previous])
+                       - (xs[previous] - xs[index]) * (average_y - ys[previous]))
+            if area > best_area:
+                best, best_area = index, area
+        kept.append(best)
+        previous = best
+    kept.append(size - 1)
+    return kept
+
+
+def chart_payload(user, granularity='day', start=None, end=None, max_points=None):
+    dates, totals, counts = spend_series(user, granularity, start, end)
+    if max_points is not None:
+        kept = lttb([day.toordinal() for day in dates], totals, max_points)
+        if len(kept) < len(dates):
+            dates = [dates[index] for index in kept]
+            totals = [totals[index] for index in kept]
+            counts = [counts[index] for index in kept]
+    return {
+        'granularity': granularity,
+        'dates': dates,
+        'totals': totals,
+        'counts': counts,
+    }
@@ -0,0 +1,72 @@
+"""
+Per-user cache of the rendered dashboard.
+
+Each user has a dashboard version in the cache: a counter incremented by the
+receipt signals (and bulk ingestion) once a change to their receipts
+commits. Rendered pages are stored under the version they were built from,
+so a change makes the old page unreachable instead of having to delete it.
+The version doubles as the ETag of the page, so a refresh with nothing new is
+answered with a 304 before the view body runs.
+
+The version has to be visible to the job workers that save receipts (and
+is what the query agent's cached columns in ``frames.py`` check), so the
+cache must be shared between processes (the file or Redis backend); the
+local-memory backend only suits a single process. Redis increments the
+counter atomically; the file backend's increment is a read and a write, so
+two processes bumping the same user at once can be given the same version.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def cache():
+    return caches[settings.DASHBOARD_CACHE]
+
+
+def version_key(user_id):
+    return f'dashboard:{user_id}:version'
+
+
+def version(user_id):
+    key = version_key(user_id)
+    value = cache().get(key)
+    if value is None:
+        # Evicted or never set; counting on from the time in nanoseconds can't collide with an older page
+        cache().add(key, time.time_ns(), None)
+        value = cache().get(key)
+    return value
+
+
+def bump(user_id):
+    """Mark the user's receipts as changed and return the new version, one more than the last."""
+    key = version_key(user_id)
+    try:
+        value = cache().incr(key)
+    except ValueError:
+        version(user_id)
+        value = cache().incr(key)
+    # The file backend's incr rewrites the entry with the default timeout
+    cache().touch(key, None)
+    return value
+
+
+def request_version(request):
+    """The user's dashboard version, read once per request."""
+    if not hasattr(request, '_dashboard_version'):
+        request._dashboard_version = version(request.user.pk) if request.user.is_authenticated else None
+    return request._dashboard_version
+
+
+def etag(request):
+    value = request_version(request)
+    return f'"{request.user.pk}-{value}"' if value is not None else None
+
+
+def get_page(user_id, version):
+    return cache().get(f'dashboard:{user_id}:{version}:page')
+
+
+def set_page(user_id, version, html):
+    cache().set(f'dashboard:{user_id}:{version}:page', html, settings.DASHBOARD_CACHE_TIMEOUT)
@@ -0,0 +1,120 @@
+"""
+Deduplication of WhatsApp messages and receipts.
+
+Twilio redelivers a webhook when the first response is slow, so the webhook
+records every MessageSid (or SmsMessageSid) in ``InboundMessage`` in the same
+transaction as the job it queues. A redelivery finds the row and gets the
+same reply without a second job. Rows are purged after
+``MESSAGE_DEDUPE_WINDOW`` seconds.
+
+Users also send the same picture twice. Receipt jobs extract and save under a
+single flight keyed by user and media hash, so a duplicate that arrives while
+the first is in flight waits for its result instead of calling the model, and
+one that arrives later finds the saved receipt. Flights are per process; the
+queue's per-user concurrency limit keeps one user's jobs on one worker at a
+time by default.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import InboundMessage, Receipt
+
+PURGE_INTERVAL = 300  # seconds between deletes of expired message ids in one process
+
+DUPLICATES = metrics.Counter('whatsapp_duplicates_total', 'Duplicate messages and receipts that were not processed again',
+                             ['reason'])
+
+_last_purge = 0.0
+
+
+def claim_message(message_sid):
+    """Record ``message_sid``; returns False if it was already seen within the window."""
+    purge_messages()
+    try:
+        with transaction.atomic():
+            InboundMessage.objects.create(message_sid=message_sid)
+    except IntegrityError:
+        DUPLICATES.inc(reason='redelivery')
+        return False
+    return True
+
+
+def purge_messages(force=False):
+    global _last_purge
+    now = time.monotonic()
+    if not force and now - _last_purge < PURGE_INTERVAL:
+        return 0
+    _last_purge = now
+    cutoff = timezone.now() - timedelta(seconds=settings.MESSAGE_DEDUPE_WINDOW)
+    return InboundMessage.objects.filter(created_at__lt=cutoff).delete()[0]
+
+
+def find_duplicate(user, media_hash):
+    receipt = Receipt.objects.filter(user=user, content_hash=media_hash).order_by('id').first()
+    if receipt is not None:
+        DUPLICATES.inc(reason='already_saved')
+    return receipt
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers that arrive meanwhile share its result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Return ``(result, shared)``; ``shared`` is True when another caller's result was reused."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            DUPLICATES.inc(reason='in_flight')
+            return future.result(), True
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight:
+    """``SingleFlight`` for coroutines running on one event loop."""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is not None:
+            DUPLICATES.inc(reason='in_flight')
+            # Shielded so a cancelled waiter doesn't cancel the shared call
+            return await asyncio.shield(task), True
+
+        task = self._calls[key] = asyncio.ensure_future(fn(*args, **kwargs))
+        try:
+            return await task, False
+        finally:
+            if self._calls.get(key) is task:
+                del self._calls[key]
+
+
+receipt_flights = SingleFlight()
+async_receipt_flights = AsyncSingleFlight()
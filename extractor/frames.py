@@ -0,0 +1,143 @@
+"""
+Per-user columnar receipt data for the query agent.
+
+A user's receipts are fetched once with ``values_list`` into typed NumPy
+columns (datetime64 dates, float64 amounts, codes into a list of canonical
+vendor names) and kept in an in-process LRU, tagged with the user's
+dashboard version (see ``dashboard.py``) they were read at. Every change to a
+user's receipts bumps that version in the shared cache, whichever process
+makes it, so a read that finds a different version reloads the columns. A
+receipt created in this process is appended instead, when its bump was the
+only change since the entry was read. Building the DataFrame from the columns is then a
+copy of a few arrays instead of a conversion of every row.
+NumPy and pandas are imported on first use, so receipt signals can reach the
+cache in processes that never answer a query.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.functions import Coalesce
+
+from . import dashboard
+from .models import Receipt
+from .vendors import vendor_index
+
+
+class ReceiptColumns:
+    def __init__(self, rows=(), version=None):
+        import numpy as np
+
+        self.version = version
+        self.vendors = []
+        self._vendor_codes = {}
+        ids, dates, amounts, codes = [], [], [], []
+        for pk, day, vendor, amount in rows:
+            ids.append(pk)
+            dates.append(day)
+            amounts.append(np.nan if amount is None else float(amount))
+            codes.append(self._vendor_code(vendor))
+        self.ids = np.array(ids, dtype=np.int64)
+        self.dates = np.array(dates, dtype='datetime64[D]')
+        self.amounts = np.array(amounts, dtype=np.float64)
+        self.codes = np.array(codes, dtype=np.int32)
+
+    def _vendor_code(self, vendor):
+        if vendor is None:
+            return -1
+        code = self._vendor_codes.get(vendor)
+        if code is None:
+            code = self._vendor_codes[vendor] = len(self.vendors)
+            self.vendors.append(vendor)
+        return code
+
+    def append(self, receipt, vendor):
+        import numpy as np
+
+        self.ids = np.append(self.ids, receipt.pk)
+        self.dates = np.append(self.dates, np.array([receipt.date], dtype='datetime64[D]'))
+        self.amounts = np.append(self.amounts, np.nan if receipt.total_amount is None else float(receipt.total_amount))
+        self.codes = np.append(self.codes, np.int32(self._vendor_code(vendor)))
+
+    def frame(self):
+        import pandas as pd
+
+        return pd.DataFrame({
+            'date': self.dates.astype('datetime64[ns]'),
+            'vendor': pd.Categorical.from_codes(self.codes, categories=list(self.vendors)),
+            'total_amount': self.amounts.copy(),
+        })
+
+
+class FrameCache:
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'loads': 0, 'appends': 0, 'invalidations': 0}
+
+    def load(self, user_id, version=None):
+        rows = (Receipt.objects
+                .filter(user_id=user_id)
+                .order_by('id')
+                .annotate(vendor_name=Coalesce('vendor_ref__name', 'vendor'))
+                .values_list('id', 'date', 'vendor_name', 'total_amount'))
+        return ReceiptColumns(rows.iterator(), version)
+
+    def get(self, user_id):
+        """Return the user's receipts as a fresh DataFrame with columns date, vendor and total_amount."""
+        max_size = settings.QUERY_FRAME_CACHE_SIZE
+        if not max_size:
+            return self.load(user_id).frame()
+
+        # Read before the rows, so a change made during the load leaves the entry stale rather than hidden
+        version = dashboard.version(user_id)
+        with self._lock:
+            columns = self._entries.get(user_id)
+            if columns is not None and columns.version == version:
+                self._entries.move_to_end(user_id)
+                self.stats['hits'] += 1
+                return columns.frame()
+
+        columns = self.load(user_id, version)
+        with self._lock:
+            self._entries[user_id] = columns
+            self._entries.move_to_end(user_id)
+            self.stats['loads'] += 1
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+            return columns.frame()
+
+    def append(self, receipt, version):
+        """
+        Add a committed new receipt to its user's entry, if the bump that returned
+        ``version`` was the only change since the entry was read; otherwise drop the entry.
+        """
+        if receipt.user_id not in self._entries:
+            return
+        vendor = vendor_index.name(receipt.vendor_ref_id) if receipt.vendor_ref_id else receipt.vendor
+        with self._lock:
+            columns = self._entries.get(receipt.user_id)
+            if columns is None:
+                return
+            if columns.version is None or columns.version + 1 != version:
+                # Another change happened since the load; only a reload sees it
+                del self._entries[receipt.user_id]
+                self.stats['invalidations'] += 1
+                return
+            # A load that ran after the commit already has the row
+            if not (columns.ids == receipt.pk).any():
+                columns.append(receipt, vendor)
+                self.stats['appends'] += 1
+            columns.version = version
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+receipt_frames = FrameCache()
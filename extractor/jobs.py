@@ -0,0 +1,286 @@
+"""
+Database-backed job queue for WhatsApp receipts and queries.
+
+The webhook only calls ``enqueue``; ``run_pool`` (started by
+``manage.py run_receipt_workers``) claims jobs and runs them on a bounded
+number of thread or process workers, or as tasks on one asyncio event loop.
+Idle workers delete done jobs once they are older than
+``RECEIPT_JOB_RETENTION``.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.db.models import Count, F, Min
+from django.utils import timezone
+
+from . import metrics
+from .models import ReceiptJob
+from .notifier import notifier
+from .resilience import Unavailable
+from .startup import preload
+
+logger = logging.getLogger(__name__)
+
+PURGE_INTERVAL = 3600  # seconds between purges of old done jobs, per process
+PURGE_CHUNK = 1000
+
+_last_purge = float('-inf')
+
+
+class QueueFull(Exception):
+    pass
+
+
+def enqueue(kind, user, **payload):
+    max_depth = settings.RECEIPT_QUEUE_MAX_DEPTH
+    if max_depth and ReceiptJob.objects.filter(status=ReceiptJob.STATUS_QUEUED).count() >= max_depth:
+        raise QueueFull(f"Receipt queue is full ({max_depth} jobs waiting)")
+    return ReceiptJob.objects.create(kind=kind, user=user, payload=payload)
+
+
+def claim_next():
+    """Atomically mark the next runnable job as running and return it, or None."""
+    now = timezone.now()
+
+    # Per-user fairness: users already at their concurrency limit are skipped,
+    # so one user's burst can't occupy every worker.
+    busy_users = (ReceiptJob.objects
+                  .filter(status=ReceiptJob.STATUS_RUNNING)
+                  .values('user')
+                  .annotate(running=Count('id'))
+                  .filter(running__gte=settings.RECEIPT_JOBS_PER_USER)
+                  .values('user'))
+    candidates = (ReceiptJob.objects
+                  .filter(status=ReceiptJob.STATUS_QUEUED, run_after__lte=now)
+                  .exclude(user__in=busy_users)
+                  .order_by('run_after', 'id')
+                  .values_list('id', flat=True)[:10])
+
+    for job_id in candidates:
+        # Conditional update so only one worker (thread or process) wins the job
+        claimed = (ReceiptJob.objects
+                   .filter(pk=job_id, status=ReceiptJob.STATUS_QUEUED)
+                   .update(status=ReceiptJob.STATUS_RUNNING, locked_at=now,
+                           attempts=F('attempts') + 1, updated_at=now))
+        if claimed:
+            return ReceiptJob.objects.select_related('user').get(pk=job_id)
+    return None
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=settings.RECEIPT_JOB_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def job_done(job):
+    metrics.JOBS.inc(kind=job.kind, outcome='done')
+    ReceiptJob.objects.filter(pk=job.pk).update(
+        status=ReceiptJob.STATUS_DONE, locked_at=None, updated_at=timezone.now())
+
+
+def job_failed(job, error):
+    """Schedule a retry with backoff, or mark the job failed and tell the user once attempts run out."""
+    from .tasks import notify_job_deferred, notify_job_failed
+
+    logger.error("Error in job %s (%s, attempt %s): %s", job.pk, job.kind, job.attempts, error)
+    now = timezone.now()
+    if job.attempts < settings.RECEIPT_JOB_MAX_ATTEMPTS:
+        metrics.JOBS.inc(kind=job.kind, outcome='retry')
+        delay = retry_delay(job.attempts)
+        if isinstance(error, Unavailable):
+            # Don't come back before the circuit breaker lets a call through again
+            delay = max(delay, timedelta(seconds=settings.GEMINI_BREAKER_RESET))
+            if job.attempts == 1:
+                notify_job_deferred(job)
+        ReceiptJob.objects.filter(pk=job.pk).update(
+            status=ReceiptJob.STATUS_QUEUED, run_after=now + delay,
+            locked_at=None, last_error=str(error), updated_at=now)
+    else:
+        metrics.JOBS.inc(kind=job.kind, outcome='failed')
+        ReceiptJob.objects.filter(pk=job.pk).update(
+            status=ReceiptJob.STATUS_FAILED, locked_at=None, last_error=str(error), updated_at=now)
+        notify_job_failed(job)
+
+
+def job_correlation_id(job):
+    # The webhook stores Twilio's MessageSid so a message can be followed from request to reply
+    return job.payload.get('message_sid') or f"job-{job.pk}"
+
+
+def run_job(job):
+    from .tasks import HANDLERS
+
+    with metrics.correlation(job_correlation_id(job)):
+        metrics.IN_FLIGHT.inc(kind=job.kind)
+        try:
+            with metrics.span('job', kind=job.kind, attempt=job.attempts):
+                HANDLERS[job.kind](job)
+        except Exception as e:
+            job_failed(job, e)
+        else:
+            job_done(job)
+        finally:
+            metrics.IN_FLIGHT.dec(kind=job.kind)
+
+
+def requeue_stale():
+    """Put jobs left running by a crashed or restarted worker back on the queue."""
+    cutoff = timezone.now() - timedelta(seconds=settings.RECEIPT_JOB_TIMEOUT)
+    return (ReceiptJob.objects
+            .filter(status=ReceiptJob.STATUS_RUNNING, locked_at__lt=cutoff)
+            .update(status=ReceiptJob.STATUS_QUEUED, locked_at=None, updated_at=timezone.now()))
+
+
+def purge_done():
+    """Delete done jobs older than ``RECEIPT_JOB_RETENTION``; failed ones are kept for inspection."""
+    global _last_purge
+    if not settings.RECEIPT_JOB_RETENTION or time.monotonic() - _last_purge < PURGE_INTERVAL:
+        return 0
+    _last_purge = time.monotonic()
+
+    cutoff = timezone.now() - timedelta(seconds=settings.RECEIPT_JOB_RETENTION)
+    purged = 0
+    while True:
+        # In chunks, so a backlog of old jobs never holds the write lock for long
+        ids = list(ReceiptJob.objects
+                   .filter(status=ReceiptJob.STATUS_DONE, updated_at__lt=cutoff)
+                   .values_list('id', flat=True)[:PURGE_CHUNK])
+        if not ids:
+            break
+        purged += ReceiptJob.objects.filter(id__in=ids).delete()[0]
+    if purged:
+        logger.info("Purged %s done jobs", purged)
+    return purged
+
+
+def queue_stats():
+    now = timezone.now()
+    stats = {status: 0 for status, _ in ReceiptJob.STATUS_CHOICES}
+    for row in ReceiptJob.objects.values('status').annotate(count=Count('id')):
+        stats[row['status']] = row['count']
+
+    queued = ReceiptJob.objects.filter(status=ReceiptJob.STATUS_QUEUED)
+    stats['ready'] = queued.filter(run_after__lte=now).count()
+    oldest = queued.aggregate(oldest=Min('created_at'))['oldest']
+    stats['oldest_queued_seconds'] = round((now - oldest).total_seconds(), 1) if oldest else 0
+    return stats
+
+
+def work(stop_event, poll_interval):
+    from .llm import warm_up
+
+    # Built inside each worker so forked processes never share a gRPC channel
+    try:
+        warm_up()
+    except Exception as e:
+        logger.warning("Error warming up LLM clients: %s", e)
+
+    while not stop_event.is_set():
+        close_old_connections()
+        try:
+            job = claim_next()
+        except Exception as e:
+            logger.error("Error claiming job: %s", e)
+            job = None
+
+        if job is None:
+            try:
+                purge_done()
+            except Exception as e:
+                logger.warning("Error purging done jobs: %s", e)
+            stop_event.wait(poll_interval)
+            continue
+        run_job(job)
+    # Connections persist for CONN_MAX_AGE, so close this thread's explicitly on the way out
+    connections.close_all()
+
+
+def work_process(stop_event, poll_interval, metrics_port=None, render_workers=None, senders=1):
+    from . import pdf
+
+    if metrics_port:
+        metrics.serve(metrics_port)
+    if render_workers is not None:
+        pdf.limit_render_workers(render_workers)
+    notifier.split_rate(senders)
+    try:
+        work(stop_event, poll_interval)
+    finally:
+        pdf.shutdown()
+    notifier.flush(settings.TWILIO_SEND_TIMEOUT)
+
+
+def worker_process(ctx, target, args):
+    # Not daemonic, since daemonic processes can't start the sandbox workers and PDF render pools
+    # a job worker needs; run_pool stops them through their stop event instead
+    return ctx.Process(target=target, args=args)
+
+
+def run_pool(workers=None, mode=None, poll_interval=None, metrics_port=None):
+    from . import pdf
+
+    workers = workers or settings.RECEIPT_WORKERS
+    mode = mode or settings.RECEIPT_WORKER_MODE
+    poll_interval = poll_interval or settings.RECEIPT_WORKER_POLL_INTERVAL
+    metrics_port = metrics_port if metrics_port is not None else settings.RECEIPT_WORKER_METRICS_PORT
+
+    requeued = requeue_stale()
+    if requeued:
+        logger.info("Requeued %s stale jobs", requeued)
+
+    # Every worker extracts receipts, so load the stack once here and let forked workers share it
+    preload()
+
+    # Forked workers keep separate registries, so each serves its own port (metrics_port + index)
+    if metrics_port and mode != 'process':
+        metrics.serve(metrics_port)
+
+    if mode == 'async':
+        import asyncio
+
+        from .async_pipeline import run_async_pool
+
+        # One event loop holds up to `workers` jobs in flight
+        try:
+            asyncio.run(run_async_pool(workers, poll_interval))
+        except KeyboardInterrupt:
+            pass
+        pdf.shutdown()
+        notifier.flush(settings.TWILIO_SEND_TIMEOUT)
+        return
+
+    if mode == 'process':
+        # Fork after closing the parent's connections so every worker opens its own
+        ctx = multiprocessing.get_context('fork')
+        stop_event = ctx.Event()
+        connections.close_all()
+        # Each worker renders PDFs on its own process pool and sends replies through its own token
+        # bucket, so they split PDF_RENDER_WORKERS and the pool's share of TWILIO_SEND_RATE between them
+        render_workers = max(1, settings.PDF_RENDER_WORKERS // workers)
+        pool = [worker_process(ctx, work_process, (stop_event, poll_interval, metrics_port and metrics_port + index,
+                                                    render_workers, workers))
+                for index in range(workers)]
+    elif mode == 'thread':
+        stop_event = threading.Event()
+        pool = [threading.Thread(target=work, args=(stop_event, poll_interval), daemon=True)
+                for _ in range(workers)]
+    else:
+        raise ValueError(f"Unsupported worker mode: {mode}")
+
+    for worker in pool:
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in pool):
+            for worker in pool:
+                worker.join(timeout=1)
+    except KeyboardInterrupt:
+        stop_event.set()
+        for worker in pool:
+            worker.join()
+    pdf.shutdown()
+    # Replies are sent from background threads, so give queued ones a chance to go out
+    notifier.flush(settings.TWILIO_SEND_TIMEOUT)
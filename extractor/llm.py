@@ -0,0 +1,169 @@
+"""
+Process-wide registry of LLM clients, prompts and agents.
+
+Chat models are built once per model name and shared by every thread so
+their HTTP/gRPC channels are reused, and calls go through ``invoke_chat``
+and ``ainvoke_chat`` for the deadlines and circuit breakers in
+``resilience``. Query agents hold a mutable REPL tool, so each thread gets
+its own agent built on top of the shared model. Async callers get a model
+per event loop, since gRPC asyncio channels are bound to the loop that
+created them.
+"""
+import asyncio
+import threading
+from typing import Any
+
+from django.conf import settings
+from langchain.agents import AgentType, initialize_agent
+from langchain.prompts import PromptTemplate
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_experimental.tools.python.tool import PythonAstREPLTool, sanitize_input
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+from . import resilience, sandbox
+
+
+RECEIPT_PROMPT = PromptTemplate(
+    input_variables=["content"],
+    template="""You are a receipt processing expert. Please extract the following information from the receipt content and provide the output in JSON format:
+
+            "date": "date on the receipt",
+            "vendor": "vendor or store name",
+            "total_amount": "total amount"
+
+            return Date in the format DD-MM-YYYY, Vendor/Store Name as a string, and Total Amount as a number.
+            Always return a single valid JSON object.
+            Receipt Content:{content}
+        """
+)
+
+BATCH_RECEIPT_PROMPT = PromptTemplate(
+    input_variables=["count"],
+    template="""You are a receipt processing expert. {count} receipts follow, each one starting with "Receipt N:". Please extract the following information from every receipt:
+
+            "date": "date on the receipt",
+            "vendor": "vendor or store name",
+            "total_amount": "total amount"
+
+            return Date in the format DD-MM-YYYY, Vendor/Store Name as a string, and Total Amount as a number.
+            Each object must also have "receipt": the number N of the "Receipt N:" it was extracted from.
+            Always return a single valid JSON array of exactly {count} objects, one per receipt, in the order the receipts are given.
+        """
+)
+
+QUERY_PROMPT = PromptTemplate(
+    input_variables=["query"],
+    template="""
+        You are an AI assistant analyzing receipt data for a user. The data is in a pandas DataFrame named 'df' with columns: date, vendor, and total_amount.
+
+        User query: {query}
+
+        To answer this query:
+        1. Analyze the 'df' DataFrame using pandas operations.
+        2. Provide a detailed response based on your analysis.
+        3. If needed, perform calculations, find patterns, or create summaries.
+        4. Present the results in a clear, user-friendly format.
+
+        Remember to use pandas functions like df.groupby(), df.sum(), df.mean(), etc., as needed.
+        """
+)
+
+JSON_PARSER = JsonOutputParser()
+
+_models = {}
+_async_models = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def model_options():
+    options = {'google_api_key': settings.GEMINI_API_KEY}
+    if settings.GEMINI_API_ENDPOINT:
+        # Point the client at another endpoint, e.g. a local fake backend
+        options['client_options'] = {'api_endpoint': settings.GEMINI_API_ENDPOINT}
+    if settings.GEMINI_TRANSPORT:
+        options['transport'] = settings.GEMINI_TRANSPORT
+    return options
+
+
+def get_chat_model(model_name):
+    model = _models.get(model_name)
+    if model is None:
+        with _lock:
+            model = _models.get(model_name)
+            if model is None:
+                model = _models[model_name] = ChatGoogleGenerativeAI(model=model_name, **model_options())
+    return model
+
+
+def get_query_agent(model_name=None):
+    """Return this thread's ``(agent, python_tool)``; set ``python_tool.locals`` or ``.sandbox`` before invoking."""
+    model_name = model_name or settings.GEMINI_TEXT_MODEL
+    agents = getattr(_local, 'agents', None)
+    if agents is None:
+        agents = _local.agents = {}
+
+    if model_name not in agents:
+        agents[model_name] = build_query_agent(get_chat_model(model_name))
+    return agents[model_name]
+
+
+class SandboxedPythonTool(PythonAstREPLTool):
+    """Sends the agent's code to ``sandbox``, a ``sandbox.Session``, when one is set."""
+
+    sandbox: Any = None
+
+    def _run(self, query, run_manager=None):
+        if self.sandbox is None:
+            return super()._run(query, run_manager)
+        return self.sandbox.run(sanitize_input(query) if self.sanitize_input else query)
+
+
+def build_query_agent(model, tool_locals=None):
+    python_tool = SandboxedPythonTool(locals=tool_locals or {})
+    agent = initialize_agent(
+        [python_tool],
+        model,
+        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+        verbose=True
+    )
+    return agent, python_tool
+
+
+def get_async_chat_model(model_name):
+    """Return a model whose asyncio client belongs to the running event loop."""
+    loop = asyncio.get_running_loop()
+    key = (model_name, id(loop))
+    model = _async_models.get(key)
+    if model is None:
+        # The asyncio client is only created when the model is built inside a running loop
+        model = _async_models[key] = ChatGoogleGenerativeAI(model=model_name, **model_options())
+    return model
+
+
+def discard_query_agent(model_name=None):
+    """Drop this thread's agent, e.g. when an abandoned run may still be using its REPL tool."""
+    getattr(_local, 'agents', {}).pop(model_name or settings.GEMINI_TEXT_MODEL, None)
+
+
+def invoke_chat(model_name, messages):
+    return resilience.call(model_name, get_chat_model(model_name).invoke, messages)
+
+
+async def ainvoke_chat(model_name, messages):
+    if settings.GEMINI_TRANSPORT == 'rest':
+        # The REST transport has no asyncio client, so the shared sync model runs on a thread
+        return await resilience.acall(model_name, asyncio.to_thread, get_chat_model(model_name).invoke, messages)
+    return await resilience.acall(model_name, get_async_chat_model(model_name).ainvoke, messages)
+
+
+def warm_up(model_names=None):
+    """Build the shared clients ahead of the first request."""
+    model_names = model_names or dict.fromkeys(settings.EXTRACTION_VISION_MODELS + settings.EXTRACTION_TEXT_MODELS
+                                               + [settings.GEMINI_TEXT_MODEL])
+    for model_name in model_names:
+        get_chat_model(model_name)
+    get_query_agent()
+    if settings.QUERY_SANDBOX_ENABLED:
+        sandbox.pool.start()
+
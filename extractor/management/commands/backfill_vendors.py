@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from extractor import dashboard
+from extractor.frames import receipt_frames
+from extractor.models import Receipt
+from extractor.vendors import vendor_index
+
+
+class Command(BaseCommand):
+    help = 'Match existing receipts to canonical vendors (Receipt.vendor_ref)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Re-match every receipt, not only those without a vendor')
+
+    def handle(self, *args, **options):
+        receipts = Receipt.objects.exclude(vendor='')
+        if not options['all']:
+            receipts = receipts.filter(vendor_ref__isnull=True)
+
+        # One match per distinct raw name, then one UPDATE per name
+        names = list(receipts.order_by().values_list('vendor', flat=True).distinct())
+        vendor_index.clear()
+        updated = 0
+        user_ids = set()
+        for position, name in enumerate(names, start=1):
+            vendor_id = vendor_index.resolve(name)
+            with transaction.atomic():
+                matched = receipts.filter(vendor=name)
+                user_ids.update(matched.order_by().values_list('user_id', flat=True).distinct())
+                updated += matched.update(vendor_ref_id=vendor_id)
+            if position % 500 == 0:
+                self.stdout.write(f"{position}/{len(names)} names matched")
+
+        # update() skips the Receipt signals; the version tells every process's query frames to reload
+        for user_id in user_ids:
+            dashboard.bump(user_id)
+        receipt_frames.clear()
+        self.stdout.write(self.style.SUCCESS(
+            f"Matched {len(names)} vendor names on {updated} receipts"))
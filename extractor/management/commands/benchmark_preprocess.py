@@ -0,0 +1,58 @@
+import mimetypes
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from extractor.preprocess import preprocess_image
+
+
+class Command(BaseCommand):
+    help = 'Report size and time of the image preprocessing stage on local receipt images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Images or directories (defaults to MEDIA_ROOT/receipts)')
+        parser.add_argument('--max-edge', type=int, default=settings.IMAGE_MAX_EDGE)
+        parser.add_argument('--quality', type=int, default=settings.IMAGE_QUALITY)
+        parser.add_argument('--format', default=settings.IMAGE_FORMAT, choices=['JPEG', 'WEBP'])
+        parser.add_argument('--color', action='store_true', help='Keep colour instead of converting to grayscale')
+        parser.add_argument('--no-crop', action='store_true', help='Skip cropping to the document')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or [os.path.join(settings.MEDIA_ROOT, 'receipts')]
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+            else:
+                files.append(path)
+
+        total_in = total_out = total_ms = count = 0
+        for file_path in files:
+            mime_type, _ = mimetypes.guess_type(file_path)
+            if not mime_type or not mime_type.startswith('image/'):
+                continue
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            try:
+                _, _, stats = preprocess_image(data,
+                                               max_edge=options['max_edge'],
+                                               quality=options['quality'],
+                                               image_format=options['format'],
+                                               grayscale=not options['color'],
+                                               crop=not options['no_crop'])
+            except Exception as e:
+                self.stderr.write(f"{os.path.basename(file_path)}: {str(e)}")
+                continue
+
+            count += 1
+            total_in += stats['input_bytes']
+            total_out += stats['output_bytes']
+            total_ms += stats['ms']
+            self.stdout.write(f"{os.path.basename(file_path)}: {stats['input_bytes']} -> {stats['output_bytes']} bytes "
+                              f"({stats['width']}x{stats['height']}) in {stats['ms']} ms")
+
+        if count:
+            self.stdout.write(self.style.SUCCESS(
+                f"{count} images: {total_in} -> {total_out} bytes "
+                f"({100 * total_out / total_in:.1f}%), {total_ms / count:.1f} ms average"))
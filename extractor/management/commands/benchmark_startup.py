@@ -0,0 +1,40 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from extractor.startup import measure
+
+
+class Command(BaseCommand):
+    help = 'Measure import time and RSS of a cold web process and a preloaded worker process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=3, help='Fresh interpreters per target; the fastest is kept')
+        parser.add_argument('--top', type=int, default=10, help='Packages to list by import time')
+        parser.add_argument('--budget-ms', type=float, default=settings.STARTUP_BUDGET_MS,
+                            help='Fail if the web process takes longer to start')
+        parser.add_argument('--budget-mb', type=float, default=settings.STARTUP_BUDGET_MB,
+                            help='Fail if the web process uses more memory after startup')
+        parser.add_argument('--json', dest='json_path', help='Also write the report to this file')
+
+    def handle(self, *args, **options):
+        report = {}
+        for target, preload in (('web', False), ('worker', True)):
+            runs = [measure(preload) for _ in range(options['runs'])]
+            report[target] = min(runs, key=lambda run: run['ms'])
+            best = report[target]
+            self.stdout.write(f"{target}: {best['ms']:.0f} ms, {best['rss_mb']:.1f} MB RSS")
+            top = list(best['packages_ms'].items())[:options['top']]
+            self.stdout.write("  " + ', '.join(f"{name} {ms} ms" for name, ms in top))
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        web = report['web']
+        if options['budget_ms'] and web['ms'] > options['budget_ms']:
+            raise CommandError(f"Web startup took {web['ms']:.0f} ms, budget is {options['budget_ms']:.0f} ms")
+        if options['budget_mb'] and web['rss_mb'] > options['budget_mb']:
+            raise CommandError(f"Web startup used {web['rss_mb']:.1f} MB, budget is {options['budget_mb']:.0f} MB")
+        self.stdout.write(self.style.SUCCESS("Web startup is within budget"))
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import random
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from extractor import benchmark, llm
+from extractor.cache import extraction_cache
+
+
+class Command(BaseCommand):
+    help = 'Replay synthetic WhatsApp webhooks against local Twilio/Gemini stubs and report latency and throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--seed-receipts', type=int, default=50, help='Existing receipts per user')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent webhook requests')
+        parser.add_argument('--workers', type=int, default=settings.RECEIPT_WORKERS)
+        parser.add_argument('--mode', choices=['thread', 'async'], default='thread')
+        parser.add_argument('--query-ratio', type=float, default=0.2)
+        parser.add_argument('--batch-ratio', type=float, default=0.05)
+        parser.add_argument('--gemini-latency', type=float, default=0.5, help='Seconds per fake Gemini call')
+        parser.add_argument('--twilio-latency', type=float, default=0.05, help='Seconds per fake Twilio call')
+        parser.add_argument('--gemini-error-rate', type=float, default=0.0, help='Share of fake Gemini calls that return 503')
+        parser.add_argument('--gemini-slow-rate', type=float, default=0.0,
+                            help='Share of fake Gemini calls that take --gemini-slow-latency')
+        parser.add_argument('--gemini-slow-latency', type=float, default=10.0, help='Seconds per slow fake Gemini call')
+        parser.add_argument('--media-dir', default=os.path.join(settings.MEDIA_ROOT, 'receipts'))
+        parser.add_argument('--no-cache', action='store_true', help='Disable the extraction cache')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', dest='json_path', help='Also write the report to this file')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        if options['verbosity'] < 2:
+            # Per-stage pipeline logs are only shown with -v 2
+            logging.getLogger('extractor').setLevel(logging.WARNING)
+        benchmark.fake.seed_instance(options['seed'])
+
+        stub = benchmark.StubServer(benchmark.load_media(options['media_dir']),
+                                    gemini_latency=options['gemini_latency'],
+                                    twilio_latency=options['twilio_latency'],
+                                    gemini_error_rate=options['gemini_error_rate'],
+                                    gemini_slow_rate=options['gemini_slow_rate'],
+                                    gemini_slow_latency=options['gemini_slow_latency'])
+        stub.start()
+
+        workdir = tempfile.mkdtemp(prefix='receipt-bench-')
+        old_name = connection.settings_dict['NAME']
+        # A file database (not in-memory) so worker threads see each other's writes
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0)
+        counter = benchmark.QueryCounter()
+
+        try:
+            with override_settings(MEDIA_ROOT=os.path.join(workdir, 'media'),
+                                   GEMINI_API_ENDPOINT=stub.url,
+                                   GEMINI_TRANSPORT='rest',
+                                   TWILIO_API_BASE_URL=stub.url,
+                                   EXTRACTION_CACHE_ENABLED=not options['no_cache']):
+                llm._models.clear()
+                extraction_cache.clear()
+
+                users = benchmark.seed_users(options['users'], options['seed_receipts'])
+                messages = benchmark.build_messages(options['messages'], users, stub.media, stub.url,
+                                                    query_ratio=options['query_ratio'],
+                                                    batch_ratio=options['batch_ratio'])
+                counter.start()
+                report = benchmark.run(messages, len(users), options['concurrency'], options['workers'],
+                                       options['mode'], stub, counter)
+        finally:
+            counter.stop()
+            llm._models.clear()
+            stub.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        webhook, job = report['webhook_ms'], report['job_ms']
+        self.stdout.write(f"{report['messages']} messages from {report['users']} users, "
+                          f"{report['workers']} {report['mode']} workers, concurrency {report['concurrency']}")
+        self.stdout.write(f"Webhook latency: p50 {webhook['p50']} ms, p95 {webhook['p95']} ms, p99 {webhook['p99']} ms")
+        self.stdout.write(f"Job completion:  p50 {job['p50']} ms, p95 {job['p95']} ms, p99 {job['p99']} ms")
+        self.stdout.write(f"Drained in {report['completion_seconds']} s ({report['throughput_per_second']} messages/s), "
+                          f"jobs: {report['jobs']}")
+        self.stdout.write(f"DB queries: {report['queries']['webhook_per_message']} per webhook, "
+                          f"{report['queries']['worker_per_job']} per job")
+        self.stdout.write("Stage means: " + ', '.join(f"{stage} {ms} ms" for stage, ms in report['stage_mean_ms'].items()))
+        self.stdout.write(f"Stub requests: {report['stub_requests']}, peak RSS {report['peak_rss_mb']} MB")
+        self.stdout.write(f"Gemini calls: {report['gemini_calls']}, hedges: {report['gemini_hedges']}")
+        if not report['drained']:
+            self.stderr.write("Timed out before the queue drained")
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        self.stdout.write(self.style.SUCCESS(f"Saved {report['receipts_saved']} receipts"))
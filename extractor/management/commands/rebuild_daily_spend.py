@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from extractor import dashboard
+from extractor.models import CustomUser
+from extractor.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Recompute the DailySpend rollup from the receipts table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--phone-number', help='Only rebuild the rollup of this user')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['phone_number']:
+            user = CustomUser.objects.get(phone_number=options['phone_number'])
+        rebuild(user)
+        for user_id in [user.pk] if user else CustomUser.objects.values_list('id', flat=True):
+            dashboard.bump(user_id)
+        self.stdout.write(self.style.SUCCESS('DailySpend rollup rebuilt'))
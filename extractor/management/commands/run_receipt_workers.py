@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from extractor.jobs import queue_stats, run_pool
+
+
+class Command(BaseCommand):
+    help = 'Run the worker pool that processes queued WhatsApp receipts and queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.RECEIPT_WORKERS,
+                            help='Maximum number of jobs processed concurrently')
+        parser.add_argument('--mode', choices=['thread', 'process', 'async'], default=settings.RECEIPT_WORKER_MODE,
+                            help='Run workers as threads, forked processes or asyncio tasks')
+        parser.add_argument('--poll-interval', type=float, default=settings.RECEIPT_WORKER_POLL_INTERVAL,
+                            help='Seconds an idle worker waits before polling the queue again')
+        parser.add_argument('--metrics-port', type=int, default=settings.RECEIPT_WORKER_METRICS_PORT,
+                            help='Serve Prometheus metrics on this port (process mode uses one port per worker)')
+        parser.add_argument('--stats', action='store_true',
+                            help='Print queue depth metrics and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for name, value in queue_stats().items():
+                self.stdout.write(f"{name}: {value}")
+            return
+
+        self.stdout.write(f"Starting {options['workers']} {options['mode']} workers")
+        run_pool(workers=options['workers'], mode=options['mode'], poll_interval=options['poll_interval'],
+                 metrics_port=options['metrics_port'])
@@ -0,0 +1,56 @@
+"""
+Streaming download of Twilio media.
+
+Chunks are written straight into a Django ``TemporaryUploadedFile`` and hashed
+in the same pass, so the file is never held in memory and saving the receipt
+moves the temp file into storage instead of copying it.
+"""
+import hashlib
+
+import requests
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+session = requests.Session()
+session.auth = (settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(settings.RECEIPT_WORKERS, 10),
+                       max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]))
+session.mount('https://', _adapter)
+session.mount('http://', _adapter)
+
+
+def download_media(media_url, mime_type, filename):
+    """Stream ``media_url`` to a temporary upload file and return ``(upload, sha256_hex)``."""
+    max_bytes = settings.RECEIPT_MAX_MEDIA_BYTES
+
+    with session.get(media_url, stream=True, timeout=settings.MEDIA_DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        declared_size = int(response.headers.get('Content-Length') or 0)
+        if max_bytes and declared_size > max_bytes:
+            raise MediaTooLarge(f"Media is {declared_size} bytes, limit is {max_bytes}")
+
+        upload = TemporaryUploadedFile(filename, mime_type, 0, None)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size=settings.MEDIA_DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise MediaTooLarge(f"Media exceeds the {max_bytes} byte limit")
+                digest.update(chunk)
+                upload.write(chunk)
+            upload.flush()
+            upload.seek(0)
+        except BaseException:
+            upload.close()
+            raise
+
+    upload.size = size
+    return upload, digest.hexdigest()
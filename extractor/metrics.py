@@ -0,0 +1,270 @@
+"""
+Pipeline spans and in-process metrics in the Prometheus text format.
+
+``span`` times one stage of a receipt (download, load_document, llm, ...):
+it logs the duration, and the byte size when one is set, with the message's
+correlation id and records both in histograms. ``render`` returns every
+metric plus queue depth and cache hit counts for the ``/metrics`` endpoint.
+Each process keeps its own registry; job workers serve theirs with
+``run_receipt_workers --metrics-port``. Both endpoints only answer
+``METRICS_ALLOWED_IPS`` or requests carrying ``METRICS_TOKEN``.
+"""
+import contextvars
+import hmac
+import ipaddress
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('extractor.pipeline')
+
+correlation_id = contextvars.ContextVar('correlation_id', default='-')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 512 * 1024, 1024 ** 2, 5 * 1024 ** 2, 20 * 1024 ** 2)
+
+
+class CorrelationIdFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+@contextmanager
+def correlation(value=None):
+    """Tag everything logged inside the block (threads and tasks included) with ``value``."""
+    token = correlation_id.set(value or uuid.uuid4().hex[:12])
+    try:
+        yield correlation_id.get()
+    finally:
+        correlation_id.reset(token)
+
+
+def propagate(fn):
+    """Wrap ``fn`` so pool threads running it log with the caller's correlation id."""
+    value = correlation_id.get()
+
+    def run(*args, **kwargs):
+        token = correlation_id.set(value)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            correlation_id.reset(token)
+    return run
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[self._key(labels)] += amount
+
+    def samples(self):
+        with self._lock:
+            return [f"{self.name}{_labels(self.label_names, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names + ('le',), key + (bound,))} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, key)} {counts[-1]}")
+        return lines
+
+
+REGISTRY = []
+
+STAGE_SECONDS = Histogram('receipt_stage_seconds', 'Duration of each receipt pipeline stage', ['stage'])
+STAGE_BYTES = Histogram('receipt_stage_bytes', 'Bytes handled by each receipt pipeline stage', ['stage'],
+                        buckets=SIZE_BUCKETS)
+STAGE_ERRORS = Counter('receipt_stage_errors_total', 'Receipt pipeline stages that raised', ['stage'])
+JOBS = Counter('receipt_jobs_total', 'Finished job attempts by outcome', ['kind', 'outcome'])
+IN_FLIGHT = Gauge('receipt_jobs_in_flight', 'Jobs currently running in this process', ['kind'])
+
+
+@contextmanager
+def span(stage, **fields):
+    """Time a pipeline stage; set ``fields['bytes']`` inside the block to record a size."""
+    started = time.perf_counter()
+    try:
+        yield fields
+    except BaseException:
+        fields['error'] = True
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if fields.get('bytes') is not None:
+            STAGE_BYTES.observe(fields['bytes'], stage=stage)
+        logger.info("stage=%s ms=%.1f%s", stage, elapsed * 1000,
+                    ''.join(f" {key}={value}" for key, value in fields.items()))
+
+
+def collect_queue():
+    from .jobs import queue_stats
+
+    stats = queue_stats()
+    lines = ["# HELP receipt_queue_jobs Jobs in the queue by status", "# TYPE receipt_queue_jobs gauge"]
+    lines += [f'receipt_queue_jobs{{status="{status}"}} {stats[status]}' for status in
+              ('queued', 'running', 'done', 'failed', 'ready')]
+    lines += ["# HELP receipt_queue_oldest_seconds Age of the oldest queued job",
+              "# TYPE receipt_queue_oldest_seconds gauge",
+              f"receipt_queue_oldest_seconds {stats['oldest_queued_seconds']}"]
+    return lines
+
+
+def collect_cache():
+    from .cache import extraction_cache
+
+    stats = dict(extraction_cache.stats)
+    lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+    hit_ratio = (stats['memory_hits'] + stats['db_hits']) / lookups if lookups else 0
+    lines = ["# HELP extraction_cache_lookups_total Extraction cache lookups by result",
+             "# TYPE extraction_cache_lookups_total counter"]
+    lines += [f'extraction_cache_lookups_total{{result="{result}"}} {stats[name]}'
+              for result, name in (('memory_hit', 'memory_hits'), ('db_hit', 'db_hits'), ('miss', 'misses'))]
+    lines += ["# HELP extraction_cache_hit_ratio Share of extraction cache lookups that hit",
+              "# TYPE extraction_cache_hit_ratio gauge",
+              f"extraction_cache_hit_ratio {round(hit_ratio, 4)}",
+              "# HELP extraction_cache_evictions_total Extraction cache rows evicted",
+              "# TYPE extraction_cache_evictions_total counter",
+              f"extraction_cache_evictions_total {stats['evictions']}"]
+    return lines
+
+
+def collect_frames():
+    from .frames import receipt_frames
+
+    lines = ["# HELP query_frame_cache_events_total Per-user query frame cache events",
+             "# TYPE query_frame_cache_events_total counter"]
+    lines += [f'query_frame_cache_events_total{{event="{event}"}} {count}'
+              for event, count in dict(receipt_frames.stats).items()]
+    return lines
+
+
+COLLECTORS = [collect_queue, collect_cache, collect_frames]
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    for collector in COLLECTORS:
+        try:
+            lines += collector()
+        except Exception as e:
+            logger.warning("Metrics collector %s failed: %s", collector.__name__, e)
+    return '\n'.join(lines) + '\n'
+
+
+def authorized(remote_addr, authorization):
+    """Whether a scrape from ``remote_addr`` with this ``Authorization`` header may read the metrics."""
+    from django.conf import settings
+
+    if settings.METRICS_TOKEN and authorization:
+        scheme, _, token = authorization.partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(token.strip(), settings.METRICS_TOKEN):
+            return True
+    try:
+        address = ipaddress.ip_address(remote_addr)
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network.strip(), strict=False)
+               for network in settings.METRICS_ALLOWED_IPS)
+
+
+def serve(port, host='0.0.0.0'):
+    """Serve ``render()`` on ``http://host:port/metrics`` from a daemon thread."""
+    from django.db import close_old_connections
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            if not authorized(self.client_address[0], self.headers.get('Authorization')):
+                self.send_error(403)
+                return
+            try:
+                body = render().encode('utf-8')
+            finally:
+                close_old_connections()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,234 @@
+"""
+Micro-batching of receipt extraction calls.
+
+Extractions that start on the same model at about the same time are
+collected for up to ``EXTRACTION_BATCH_WAIT_MS`` or until
+``EXTRACTION_BATCH_MAX_ITEMS`` receipts are waiting, then sent as one
+request for a JSON array with one object per receipt, each naming the
+receipt number it was read from. The first caller of a batch waits for the
+others and makes the call. Each entry of the answer then goes through its
+own cascade like a single call's result, so an invalid entry escalates on
+its own. A batch can mix receipts of different users, so when the batch
+fails, or its numbers are not exactly 1..N, every caller makes its own call
+instead of risking someone else's vendor and total. A
+caller still alone when the wait ends calls the model straight away, so a
+quiet worker only pays the wait.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from langchain.schema import HumanMessage
+
+from . import cascade, metrics
+from .llm import BATCH_RECEIPT_PROMPT, JSON_PARSER
+from .metrics import span
+
+logger = logging.getLogger(__name__)
+
+BATCHES = metrics.Counter('extraction_batches_total', 'Batched extraction calls by outcome (ok, failed, alone)',
+                          ['outcome'])
+BATCH_SIZE = metrics.Histogram('extraction_batch_size', 'Receipts sent in one batched extraction call',
+                               buckets=(2, 4, 8, 16, 32))
+
+# Returned to callers whose receipt was not extracted in a batch
+UNBATCHED = object()
+
+
+def batch_message(items):
+    """One message with the batch prompt followed by every receipt's parts, numbered from 1."""
+    parts = [{"type": "text", "text": BATCH_RECEIPT_PROMPT.format(count=len(items))}]
+    for number, item_parts in enumerate(items, 1):
+        parts.append({"type": "text", "text": f"Receipt {number}:"})
+        parts += item_parts
+    return HumanMessage(content=parts)
+
+
+def split_batch(content, count):
+    """Return the entries of a batch answer in receipt order, without their ``receipt`` numbers."""
+    results = JSON_PARSER.parse(content)
+    if isinstance(results, dict) and len(results) == 1:
+        # Some answers wrap the array in an object, e.g. {"receipts": [...]}
+        results = next(iter(results.values()))
+    if not isinstance(results, list) or len(results) != count:
+        raise ValueError(f"Expected a JSON array of {count} receipts")
+
+    by_number = {}
+    for result in results:
+        number = result.pop('receipt', None) if isinstance(result, dict) else None
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise ValueError(f"Batch entry without a receipt number: {result!r}") from None
+        by_number[number] = result
+    if sorted(by_number) != list(range(1, count + 1)):
+        raise ValueError(f"Expected receipt numbers 1 to {count}, got {sorted(by_number)}")
+    return [by_number[number] for number in range(1, count + 1)]
+
+
+def settle(entries, results):
+    for (_, future), result in zip(entries, results):
+        if not future.done():
+            future.set_result(result)
+
+
+class Batcher:
+    """Collects concurrent ``submit`` calls per key into batches run by their first caller."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = {}
+
+    def submit(self, key, item, run):
+        """
+        Add ``item`` to the open batch for ``key`` and return its entry of ``run(key, items)``,
+        or ``UNBATCHED`` if the caller should make its own call.
+        """
+        max_items = settings.EXTRACTION_BATCH_MAX_ITEMS
+        if max_items < 2:
+            return UNBATCHED
+
+        future = Future()
+        with self._cond:
+            entries = self._pending.setdefault(key, [])
+            entries.append((item, future))
+            leader = len(entries) == 1
+            if len(entries) >= max_items:
+                del self._pending[key]
+                self._cond.notify_all()
+            if leader:
+                deadline = time.monotonic() + settings.EXTRACTION_BATCH_WAIT_MS / 1000
+                while self._pending.get(key) is entries and (remaining := deadline - time.monotonic()) > 0:
+                    self._cond.wait(remaining)
+                if self._pending.get(key) is entries:
+                    del self._pending[key]
+        if not leader:
+            return future.result()
+
+        try:
+            settle(entries, run_batch(key, entries, run))
+        finally:
+            # Anyone left waiting (the batch raised something fatal) makes their own call
+            settle(entries, [UNBATCHED] * len(entries))
+        return future.result()
+
+
+class AsyncBatcher:
+    """``Batcher`` for coroutines running on one event loop."""
+
+    def __init__(self):
+        self._pending = {}
+
+    async def submit(self, key, item, run):
+        max_items = settings.EXTRACTION_BATCH_MAX_ITEMS
+        if max_items < 2:
+            return UNBATCHED
+
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = ([], asyncio.Event())
+        entries, full = batch
+        entries.append((item, future))
+        leader = len(entries) == 1
+        if len(entries) >= max_items:
+            del self._pending[key]
+            full.set()
+        if not leader:
+            return await future
+
+        try:
+            try:
+                await asyncio.wait_for(full.wait(), settings.EXTRACTION_BATCH_WAIT_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+            settle(entries, await arun_batch(key, entries, run))
+        finally:
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+            settle(entries, [UNBATCHED] * len(entries))
+        return future.result()
+
+
+def run_batch(key, entries, run):
+    if len(entries) == 1:
+        BATCHES.inc(outcome='alone')
+        return [UNBATCHED]
+    BATCH_SIZE.observe(len(entries))
+    try:
+        results = run(key, [item for item, _ in entries])
+    except Exception as e:
+        BATCHES.inc(outcome='failed')
+        logger.warning("Batched extraction of %s receipts failed, extracting them one by one: %s", len(entries), e)
+        return [UNBATCHED] * len(entries)
+    BATCHES.inc(outcome='ok')
+    return results
+
+
+async def arun_batch(key, entries, run):
+    if len(entries) == 1:
+        BATCHES.inc(outcome='alone')
+        return [UNBATCHED]
+    BATCH_SIZE.observe(len(entries))
+    try:
+        results = await run(key, [item for item, _ in entries])
+    except Exception as e:
+        BATCHES.inc(outcome='failed')
+        logger.warning("Batched extraction of %s receipts failed, extracting them one by one: %s", len(entries), e)
+        return [UNBATCHED] * len(entries)
+    BATCHES.inc(outcome='ok')
+    return results
+
+
+batcher = Batcher()
+async_batcher = AsyncBatcher()
+
+
+def extract(models, parts, message, invoke):
+    """``cascade.extract`` with the first tier shared with concurrent extractions on the same model."""
+    def run(model_name, items):
+        started = time.perf_counter()
+        with span('llm', model=model_name, tier=0, batch=len(items)) as fields:
+            response = invoke(model_name, [batch_message(items)])
+            fields['bytes'] = len(response.content)
+        with span('parse'):
+            results = split_batch(response.content, len(items))
+        # Every receipt's first tier took as long as the shared call, not the time spent waiting for it
+        seconds = time.perf_counter() - started
+        return [(result, seconds) for result in results]
+
+    attempts = cascade.Cascade(models)
+    batched = batcher.submit(models[0], parts, run)
+    if batched is UNBATCHED:
+        return attempts.run(message, invoke)
+    result, seconds = batched
+    if attempts.record(0, models[0], seconds, result=result):
+        return attempts.result()
+    return attempts.run(message, invoke, start=1)
+
+
+async def aextract(models, parts, message, ainvoke):
+    """Async counterpart of ``extract`` for an awaitable ``ainvoke(model_name, messages)``."""
+    async def run(model_name, items):
+        started = time.perf_counter()
+        with span('llm', model=model_name, tier=0, batch=len(items)) as fields:
+            response = await ainvoke(model_name, [batch_message(items)])
+            fields['bytes'] = len(response.content)
+        with span('parse'):
+            results = split_batch(response.content, len(items))
+        seconds = time.perf_counter() - started
+        return [(result, seconds) for result in results]
+
+    attempts = cascade.Cascade(models)
+    batched = await async_batcher.submit(models[0], parts, run)
+    if batched is UNBATCHED:
+        return await attempts.arun(message, ainvoke)
+    result, seconds = batched
+    if attempts.record(0, models[0], seconds, result=result):
+        return attempts.result()
+    return await attempts.arun(message, ainvoke, start=1)
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-18 01:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extractor', '0006_extractioncache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
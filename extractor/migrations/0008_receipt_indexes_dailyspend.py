@@ -0,0 +1,54 @@
+# Generated by Django 4.2.13 on 2026-10-18 01:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_daily_spend(apps, schema_editor):
+    Receipt = apps.get_model('extractor', 'Receipt')
+    DailySpend = apps.get_model('extractor', 'DailySpend')
+    rows = (Receipt.objects.values('user', 'date')
+            .annotate(day_total=models.Sum('total_amount'), day_count=models.Count('id'))
+            .order_by())
+    DailySpend.objects.bulk_create([
+        DailySpend(user_id=row['user'], date=row['date'], total=row['day_total'] or 0, count=row['day_count'])
+        for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extractor', '0007_receipt_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySpend',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(blank=True, null=True)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='receipt',
+            index=models.Index(fields=['user', 'date'], name='extractor_r_user_id_5221bc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='receipt',
+            index=models.Index(fields=['user', 'vendor'], name='extractor_r_user_id_4ac9b0_idx'),
+        ),
+        migrations.AddField(
+            model_name='dailyspend',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyspend',
+            constraint=models.UniqueConstraint(fields=('user', 'date'), name='unique_daily_spend_per_user'),
+        ),
+        migrations.RunPython(backfill_daily_spend, migrations.RunPython.noop),
+    ]
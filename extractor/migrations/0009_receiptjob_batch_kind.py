@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-18 01:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extractor', '0008_receipt_indexes_dailyspend'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='receiptjob',
+            name='kind',
+            field=models.CharField(choices=[('receipt', 'Receipt'), ('receipt_batch', 'Receipt batch'), ('query', 'Query')], max_length=20),
+        ),
+    ]
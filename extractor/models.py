@@ -47,12 +47,116 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):  # Add PermissionsMixin he
         return self.phone_number
 
 
+class Vendor(models.Model):
+    # Canonical vendor; raw receipt names map to it through VendorAlias (see extractor/vendors.py)
+    name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
+class VendorAlias(models.Model):
+    vendor = models.ForeignKey(Vendor, on_delete=models.CASCADE, related_name='aliases')
+    alias = models.CharField(max_length=255, unique=True)  # normalized name, e.g. "starbucks"
+
+    def __str__(self):
+        return f"{self.alias} -> {self.vendor_id}"
+
+
 class Receipt(models.Model):
     file = models.FileField(upload_to='receipts/')
     date = models.DateField(blank=True, null=True)
     vendor = models.CharField(max_length=255, blank=True)
+    vendor_ref = models.ForeignKey(Vendor, on_delete=models.SET_NULL, blank=True, null=True, related_name='receipts')
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, validators=[MinValueValidator(0)])
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)  # Link receipt to user
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)  # SHA-256 of the uploaded file
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'date']),
+            models.Index(fields=['user', 'vendor']),
+            models.Index(fields=['user', 'vendor_ref']),
+        ]
 
     def __str__(self):
         return f"Receipt: {self.vendor} - {self.date} (by {self.user.phone_number})"
+
+
+class DailySpend(models.Model):
+    # Rollup of Receipt per user and day, kept up to date by extractor/signals.py
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    date = models.DateField(blank=True, null=True)
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'date'], name='unique_daily_spend_per_user'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.date}: {self.total} ({self.count} receipts)"
+
+
+class ReceiptJob(models.Model):
+    KIND_RECEIPT = 'receipt'
+    KIND_RECEIPT_BATCH = 'receipt_batch'
+    KIND_QUERY = 'query'
+    KIND_CHOICES = [
+        (KIND_RECEIPT, 'Receipt'),
+        (KIND_RECEIPT_BATCH, 'Receipt batch'),
+        (KIND_QUERY, 'Query'),
+    ]
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+            models.Index(fields=['user', 'status']),
+        ]
+
+    def __str__(self):
+        return f"Job {self.pk}: {self.kind} [{self.status}] (for {self.user_id})"
+
+
+class ExtractionCache(models.Model):
+    content_hash = models.CharField(max_length=64, unique=True)
+    result = models.JSONField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_hit_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Extraction {self.content_hash[:12]} ({self.hits} hits)"
+
+
+class InboundMessage(models.Model):
+    # Twilio MessageSids accepted by the webhook, kept for MESSAGE_DEDUPE_WINDOW (see extractor/dedupe.py)
+    message_sid = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Message {self.message_sid}"
@@ -0,0 +1,184 @@
+"""
+Outbound WhatsApp messages through the Twilio Messages API.
+
+Every reply goes through one ``Notifier`` per process. It owns a pooled
+``requests`` session, spaces sends with a token bucket, and retries 429 and
+5xx responses with backoff (honouring ``Retry-After`` up to the time the
+attempts would have taken anyway). The bucket is per process, so the sender
+number's throughput (``TWILIO_SEND_RATE``) is split evenly between the
+``TWILIO_SEND_POOLS`` worker pools sending from it, and a process-mode pool
+splits its share again between its workers (``split_rate``). ``notify`` only queues the message; a few sender threads
+deliver it, so job workers never wait on Twilio. Pointing
+``TWILIO_API_BASE_URL`` at a local server is enough to run it against a fake.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .metrics import span
+
+logger = logging.getLogger(__name__)
+
+SENDS = metrics.Counter('whatsapp_sends_total', 'Outbound WhatsApp send attempts by outcome', ['outcome'])
+QUEUED = metrics.Gauge('whatsapp_send_queue', 'Outbound WhatsApp messages waiting to be sent')
+
+
+class NotificationFailed(Exception):
+    pass
+
+
+class TokenBucket:
+    """Allows ``rate`` acquisitions per second on average and up to ``burst`` at once."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def retry_after(response, attempt):
+    header = response.headers.get('Retry-After') if response is not None else None
+    try:
+        # A sender thread must not be parked for however long the header asks
+        return min(max(float(header), 0), settings.TWILIO_SEND_TIMEOUT * settings.TWILIO_SEND_MAX_ATTEMPTS)
+    except (TypeError, ValueError):
+        return settings.TWILIO_SEND_RETRY_DELAY * 2 ** (attempt - 1)
+
+
+class Notifier:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._session = None
+        self.split_rate(1)
+
+    def split_rate(self, parts):
+        """Limit this process to its share of the pool's rate when ``parts`` processes send for the pool."""
+        parts *= max(settings.TWILIO_SEND_POOLS, 1)
+        self.bucket = TokenBucket(settings.TWILIO_SEND_RATE / parts, settings.TWILIO_SEND_BURST // parts)
+
+    def session(self):
+        if self._session is None:
+            session = requests.Session()
+            session.auth = (settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.TWILIO_SENDER_THREADS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+        return self._session
+
+    def send(self, user_phone, body):
+        """Send one message now, blocking through rate limiting and retries; returns the message sid."""
+        url = f"{settings.TWILIO_API_BASE_URL}/2010-04-01/Accounts/{settings.TWILIO_ACCOUNT_SID}/Messages.json"
+        data = {'From': f"whatsapp:{settings.TWILIO_NUMBER}", 'To': f"whatsapp:{user_phone}", 'Body': body}
+        max_attempts = settings.TWILIO_SEND_MAX_ATTEMPTS
+
+        with span('send', bytes=len(body.encode('utf-8'))) as fields:
+            for attempt in range(1, max_attempts + 1):
+                fields['attempts'] = attempt
+                self.bucket.acquire()
+                response = None
+                try:
+                    response = self.session().post(url, data=data, timeout=settings.TWILIO_SEND_TIMEOUT)
+                except requests.RequestException as e:
+                    error = str(e)
+                else:
+                    if response.status_code < 400:
+                        SENDS.inc(outcome='sent')
+                        return response.json().get('sid')
+                    error = f"{response.status_code} {response.text[:200]}"
+                    if response.status_code != 429 and response.status_code < 500:
+                        SENDS.inc(outcome='rejected')
+                        raise NotificationFailed(f"Twilio rejected the message: {error}")
+
+                if attempt == max_attempts:
+                    break
+                SENDS.inc(outcome='retried')
+                delay = retry_after(response, attempt)
+                logger.warning("Send to %s failed (%s), retrying in %.1fs", user_phone, error, delay)
+                time.sleep(delay)
+
+            SENDS.inc(outcome='failed')
+            raise NotificationFailed(f"Giving up after {max_attempts} attempts: {error}")
+
+    def notify(self, user_phone, body):
+        """Queue a message for the sender threads and return a Future for its sid."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((metrics.propagate(self.send), user_phone, body, future))
+        QUEUED.inc()
+        return future
+
+    def _ensure_started(self):
+        # Threads don't survive fork, so a forked worker starts its own on first use
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._session = None
+            self._threads = [threading.Thread(target=self._run, name=f'whatsapp-sender-{index}', daemon=True)
+                             for index in range(settings.TWILIO_SENDER_THREADS)]
+            for thread in self._threads:
+                thread.start()
+
+    def _run(self):
+        while True:
+            send, user_phone, body, future = self._queue.get()
+            QUEUED.dec()
+            try:
+                future.set_result(send(user_phone, body))
+            except Exception as e:
+                logger.error("Error sending WhatsApp message to %s: %s", user_phone, e)
+                future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout=None):
+        """Wait until every queued message has been sent or given up on; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+notifier = Notifier()
+
+_twilio_client = None
+
+
+def twilio_client():
+    """Shared Twilio REST client for the Lookup and Verify calls made by the auth views."""
+    global _twilio_client
+    if _twilio_client is None:
+        from twilio.rest import Client
+
+        _twilio_client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+    return _twilio_client
@@ -0,0 +1,44 @@
+"""
+Keyset pagination of a user's receipts on ``(date, id)``, newest first.
+
+Cursors are ``"<iso date>.<id>"`` (``"null.<id>"`` for undated receipts), so
+fetching a page costs the same however many receipts came before it.
+"""
+from datetime import date
+
+from django.conf import settings
+from django.db.models import F, Q
+
+from .models import Receipt
+
+
+def encode_cursor(receipt):
+    return f"{receipt.date.isoformat() if receipt.date else 'null'}.{receipt.pk}"
+
+
+def decode_cursor(cursor):
+    day, _, pk = cursor.rpartition('.')
+    return (None if day == 'null' else date.fromisoformat(day)), int(pk)
+
+
+def receipt_page(user, cursor=None, page_size=None):
+    """Return ``(receipts, next_cursor)``; ``next_cursor`` is None on the last page."""
+    page_size = page_size or settings.RECEIPT_PAGE_SIZE
+    receipts = (Receipt.objects
+                .filter(user=user)
+                .select_related('user')
+                .only('id', 'date', 'vendor', 'total_amount', 'file', 'user__phone_number')
+                .order_by(F('date').desc(nulls_last=True), '-id'))
+
+    if cursor:
+        day, pk = decode_cursor(cursor)
+        if day is None:
+            receipts = receipts.filter(date__isnull=True, id__lt=pk)
+        else:
+            receipts = receipts.filter(Q(date__lt=day) | Q(date=day, id__lt=pk) | Q(date__isnull=True))
+
+    page = list(receipts[:page_size + 1])
+    if len(page) > page_size:
+        page = page[:page_size]
+        return page, encode_cursor(page[-1])
+    return page, None
@@ -0,0 +1,77 @@
+"""
+Page-aware PDF loading.
+
+Pages with a text layer are read as text; the rest are rasterized straight to
+PNG at ``PDF_RENDER_DPI`` on a process pool so multi-page documents render in
+parallel. This module only depends on PyMuPDF so pool workers start cheaply.
+Job worker processes each get their share of ``PDF_RENDER_WORKERS`` (see
+``limit_render_workers``) and shut their pool down when they stop. A daemonic
+process may not start the pool, so it renders its pages itself.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+_pool = None
+_pool_lock = threading.Lock()
+_max_workers = None
+
+
+def render_page(file_path, page_number, dpi):
+    with fitz.open(file_path) as pdf_document:
+        return pdf_document.load_page(page_number).get_pixmap(dpi=dpi).tobytes('png')
+
+
+def _render_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def limit_render_workers(workers):
+    """Cap the render processes this process starts, for job workers sharing the host's CPUs."""
+    global _max_workers
+    _max_workers = workers
+
+
+def shutdown():
+    """Stop the render processes, if any were started."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def load_pdf(file_path, max_pages, dpi, min_text_chars, workers):
+    """
+    Return ``(content, mime_type)`` for the first ``max_pages`` pages.
+
+    When every page has a text layer the result is plain text. Otherwise it is
+    a list with one entry per page, text (``str``) or PNG bytes, and the mime
+    type is ``image/png``.
+    """
+    with fitz.open(file_path) as pdf_document:
+        if not pdf_document.page_count:
+            raise ValueError(f"PDF has no pages: {file_path}")
+        page_count = min(pdf_document.page_count, max_pages)
+        texts = [pdf_document.load_page(page_number).get_text().strip() for page_number in range(page_count)]
+
+    if all(len(text) >= min_text_chars for text in texts):
+        return '\n\n'.join(f"Page {page_number + 1}:\n{text}" for page_number, text in enumerate(texts)), 'text/plain'
+
+    to_render = [page_number for page_number, text in enumerate(texts) if len(text) < min_text_chars]
+    if _max_workers is not None:
+        workers = min(workers, _max_workers)
+    if len(to_render) > 1 and workers > 1 and not multiprocessing.current_process().daemon:
+        pool = _render_pool(workers)
+        images = list(pool.map(render_page, [file_path] * len(to_render), to_render, [dpi] * len(to_render)))
+    else:
+        images = [render_page(file_path, page_number, dpi) for page_number in to_render]
+
+    rendered = dict(zip(to_render, images))
+    return [rendered.get(page_number, text) for page_number, text in enumerate(texts)], 'image/png'
@@ -0,0 +1,93 @@
+"""
+Shrink receipt images before they are base64-encoded for the vision model.
+
+Large JPEGs are decoded in draft mode (DCT downscaling), then the image is
+rotated from EXIF, converted to grayscale, cropped to the bright document
+area, downscaled to a maximum edge and re-encoded as JPEG or WebP.
+"""
+import io
+import logging
+import time
+
+from django.conf import settings
+from PIL import Image, ImageFilter, ImageOps
+
+from .metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+def crop_to_document(image, threshold=160, min_area=0.2, margin=0.02):
+    """Crop to the bounding box of the bright (paper) region, if one clearly stands out."""
+    small = image.convert('L')
+    small.thumbnail((256, 256))
+    mask = ImageOps.autocontrast(small).point(lambda value: 255 if value > threshold else 0)
+    bbox = mask.filter(ImageFilter.MedianFilter(5)).getbbox()
+    if not bbox:
+        return image
+
+    left, top, right, bottom = bbox
+    area = (right - left) * (bottom - top) / float(small.width * small.height)
+    if area < min_area or area > 0.95:
+        return image
+
+    scale_x, scale_y = image.width / small.width, image.height / small.height
+    pad_x, pad_y = image.width * margin, image.height * margin
+    return image.crop((
+        max(0, int(left * scale_x - pad_x)),
+        max(0, int(top * scale_y - pad_y)),
+        min(image.width, int(right * scale_x + pad_x)),
+        min(image.height, int(bottom * scale_y + pad_y)),
+    ))
+
+
+def preprocess_image(data, max_edge=1600, quality=80, image_format='JPEG', grayscale=True, crop=True):
+    """Return ``(image_bytes, mime_type, stats)``; the input is returned unchanged if it can't be shrunk."""
+    started = time.perf_counter()
+    mode = 'L' if grayscale else 'RGB'
+
+    image = Image.open(io.BytesIO(data))
+    original_format = image.format
+    if original_format == 'JPEG':
+        image.draft(mode, (max_edge, max_edge))
+    image = ImageOps.exif_transpose(image).convert(mode)
+    if crop:
+        image = crop_to_document(image)
+    image.thumbnail((max_edge, max_edge))
+
+    output = io.BytesIO()
+    image.save(output, format=image_format, quality=quality, optimize=True)
+    result, mime_type = output.getvalue(), f"image/{image_format.lower()}"
+    if len(result) >= len(data):
+        result, mime_type = data, Image.MIME.get(original_format, mime_type)
+
+    stats = {
+        'input_bytes': len(data),
+        'output_bytes': len(result),
+        'width': image.width,
+        'height': image.height,
+        'ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+    return result, mime_type, stats
+
+
+def prepare_image(data, mime_type):
+    """Apply ``preprocess_image`` with the configured settings, falling back to the original bytes."""
+    if not settings.IMAGE_PREPROCESS_ENABLED:
+        return data, mime_type
+    try:
+        with span('preprocess', input_bytes=len(data)) as fields:
+            result, result_mime_type, stats = preprocess_image(
+                data,
+                max_edge=settings.IMAGE_MAX_EDGE,
+                quality=settings.IMAGE_QUALITY,
+                image_format=settings.IMAGE_FORMAT,
+                grayscale=settings.IMAGE_GRAYSCALE,
+                crop=settings.IMAGE_CROP,
+            )
+            fields.update(bytes=stats['output_bytes'], size=f"{stats['width']}x{stats['height']}")
+    except Exception as e:
+        logger.warning("Image preprocessing failed, sending original: %s", e)
+        return data, mime_type
+
+    return result, result_mime_type
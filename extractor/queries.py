@@ -0,0 +1,237 @@
+"""
+Rule-based answers for common receipt questions.
+
+``answer_query`` parses questions like "total this month", "how many receipts
+at Starbucks" or "top 3 vendors last year" into a database aggregate and
+returns the reply text. It returns None for anything it does not understand
+so the caller can fall back to the LLM agent.
+"""
+import calendar
+import re
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from django.db.models import Avg, Count, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Receipt
+from .vendors import vendor_index
+
+
+ParsedQuery = namedtuple('ParsedQuery', ['intent', 'start', 'end', 'period', 'vendor', 'limit'])
+
+MONTHS = {name.lower(): number for number, name in enumerate(calendar.month_name) if name}
+MONTHS.update({name.lower(): number for number, name in enumerate(calendar.month_abbr) if name})
+MONTH_PATTERN = '|'.join(sorted(MONTHS, key=len, reverse=True))
+DATE_PATTERN = r'\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[-/]\d{1,2}[-/]\d{4}'
+
+# Questions the rules can't answer faithfully are left to the agent
+COMPLEX_RE = re.compile(r'\b(compare|compared|vs|versus|trend|why|predict|forecast|chart|graph|plot|'
+                        r'monthly|weekly|daily|per (?:month|week|day)|each (?:month|week|day)|'
+                        r'median|percent|percentage|cheapest|smallest|lowest|largest receipt|biggest receipt|categor\w*)\b'
+                        r'|\b(?:spen[dt]|spending)\s+on\b|%')
+TOP_RE = re.compile(r'\b(?:top|most|biggest|largest|highest)\b.*\b(?:vendors?|stores?|merchants?|shops?|places?)\b'
+                    r'|\bwhere\b.*\bspen[dt]\b.*\bmost\b')
+BREAKDOWN_RE = re.compile(r'\b(?:by|per|each|every)\s+(?:vendor|store|merchant|shop)\b|\bbreakdown\b')
+AVERAGE_RE = re.compile(r'\b(?:average|avg|mean)\b')
+COUNT_RE = re.compile(r'\b(?:how many|count|number of)\b')
+TOTAL_RE = re.compile(r'\b(?:total|how much|spent|spend|spending|sum|expenses?|cost)\b')
+TOP_LIMIT_RE = re.compile(r'\btop\s+(\d{1,2})\b')
+# Anything of these left once the period, vendor and top limit were taken out means a condition the rules
+# would silently drop, like an amount, a date or "my last receipt"
+UNPARSED_RE = re.compile(r'\d|\b(?:over|under|above|below|more|less|fewer|greater|exceeding|at least|at most|'
+                         r'last|latest|recent|first|previous|on|since|before|after|until|between)\b')
+VENDOR_WORDS_RE = re.compile(r'(?<!all )\b(?:vendors?|stores?|merchants?|shops?|places?|businesses)\b')
+VENDOR_RE = re.compile(r'\b(?:at|from)\s+(.+?)(?=\s+(?:this|last|past|in|during|since|between|today|yesterday|on|for)\b|[?.!,]|$)')
+GENERIC_VENDORS = {'all', 'all vendors', 'all stores', 'every vendor', 'each vendor', 'vendors', 'stores', 'everywhere', 'my receipts'}
+
+
+def _parse_date(text):
+    for fmt in ('%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y'):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _month_start(year, month):
+    while month < 1:
+        month += 12
+        year -= 1
+    while month > 12:
+        month -= 12
+        year += 1
+    return date(year, month, 1)
+
+
+def _format(day):
+    return day.strftime('%d-%m-%Y')
+
+
+def parse_period(text, today):
+    """Return ``(start, end, label, remaining_text)`` with ``end`` exclusive; dates are None for all time."""
+    tomorrow = today + timedelta(days=1)
+
+    match = re.search(rf'\b(?:between|from)\s+({DATE_PATTERN})\s+(?:and|to|until)\s+({DATE_PATTERN})', text)
+    if match:
+        start, end = _parse_date(match.group(1)), _parse_date(match.group(2))
+        if start and end:
+            return (start, end + timedelta(days=1), f"between {_format(start)} and {_format(end)}",
+                    text.replace(match.group(0), ' '))
+
+    match = re.search(rf'\bsince\s+({DATE_PATTERN})', text)
+    if match and _parse_date(match.group(1)):
+        start = _parse_date(match.group(1))
+        return start, tomorrow, f"since {_format(start)}", text.replace(match.group(0), ' ')
+
+    match = re.search(r'\b(?:last|past)\s+(\d{1,3})\s+(days?|weeks?|months?)\b', text)
+    if match:
+        amount, unit = int(match.group(1)), match.group(2)
+        if unit.startswith('day'):
+            start = tomorrow - timedelta(days=amount)
+        elif unit.startswith('week'):
+            start = tomorrow - timedelta(weeks=amount)
+        else:
+            start = _month_start(today.year, today.month - amount)
+            start = start.replace(day=min(today.day, calendar.monthrange(start.year, start.month)[1]))
+        return start, tomorrow, f"in the last {amount} {unit}", text.replace(match.group(0), ' ')
+
+    this_week = today - timedelta(days=today.weekday())
+    this_month = today.replace(day=1)
+    relative = [
+        ('today', today, tomorrow),
+        ('yesterday', today - timedelta(days=1), today),
+        ('this week', this_week, tomorrow),
+        ('last week', this_week - timedelta(weeks=1), this_week),
+        ('this month', this_month, tomorrow),
+        ('last month', _month_start(today.year, today.month - 1), this_month),
+        ('this year', date(today.year, 1, 1), tomorrow),
+        ('last year', date(today.year - 1, 1, 1), date(today.year, 1, 1)),
+    ]
+    for label, start, end in relative:
+        match = re.search(rf'\b{label}\b', text)
+        if match:
+            return start, end, label, text.replace(match.group(0), ' ')
+
+    # Month names only count after a preposition or before a year: "may I", "mar" are words too
+    match = (re.search(rf'\b(?:in|during|for)\s+({MONTH_PATTERN})(?:\s+(\d{{4}}))?\b', text)
+             or re.search(rf'\b({MONTH_PATTERN})\s+(\d{{4}})\b', text))
+    if match:
+        month = MONTHS[match.group(1)]
+        if match.group(2):
+            year = int(match.group(2))
+        else:
+            # A bare month name means its most recent occurrence
+            year = today.year if month <= today.month else today.year - 1
+        start = date(year, month, 1)
+        return (start, _month_start(year, month + 1), f"in {calendar.month_name[month]} {year}",
+                text.replace(match.group(0), ' '))
+
+    match = re.search(r'\b(?:in|during|for)\s+(\d{4})\b', text)
+    if match:
+        year = int(match.group(1))
+        return date(year, 1, 1), date(year + 1, 1, 1), f"in {year}", text.replace(match.group(0), ' ')
+
+    return None, None, '', text
+
+
+def parse_query(text, today=None):
+    text = ' '.join(text.lower().split())
+    if not text or COMPLEX_RE.search(text):
+        return None
+
+    today = today or timezone.localdate()
+    start, end, period, rest = parse_period(text, today)
+
+    if TOP_RE.search(rest):
+        intent = 'top_vendors'
+    elif BREAKDOWN_RE.search(rest):
+        intent = 'vendor_totals'
+    elif AVERAGE_RE.search(rest):
+        intent = 'average'
+    elif COUNT_RE.search(rest):
+        intent = 'count'
+    elif TOTAL_RE.search(rest):
+        intent = 'total'
+    else:
+        return None
+
+    vendor = None
+    leftover = rest
+    if intent in ('average', 'count', 'total'):
+        match = VENDOR_RE.search(rest)
+        if match:
+            leftover = leftover.replace(match.group(0), ' ')
+            vendor = match.group(1).strip(" '\"").removesuffix("'s").strip()
+            if vendor in GENERIC_VENDORS or not vendor:
+                vendor = None
+        # "How many vendors" or "which store" asks about vendors, not receipts
+        if VENDOR_WORDS_RE.search(leftover):
+            return None
+
+    limit_match = TOP_LIMIT_RE.search(rest)
+    limit = int(limit_match.group(1)) if limit_match else 5
+    if limit_match:
+        leftover = leftover.replace(limit_match.group(0), ' ')
+    if UNPARSED_RE.search(leftover):
+        return None
+    return ParsedQuery(intent, start, end, period, vendor, limit)
+
+
+def _money(amount):
+    return f"${(amount or 0):,.2f}"
+
+
+def _receipts(count):
+    return f"{count} receipt{'' if count == 1 else 's'}"
+
+
+def run_query(user, parsed):
+    receipts = Receipt.objects.filter(user=user)
+    if parsed.start:
+        receipts = receipts.filter(date__gte=parsed.start, date__lt=parsed.end)
+    if parsed.vendor:
+        vendor_id, _ = vendor_index.match(parsed.vendor)
+        if vendor_id is not None:
+            # Receipts saved before backfill_vendors ran have no vendor_ref yet
+            receipts = receipts.filter(Q(vendor_ref_id=vendor_id) |
+                                       Q(vendor_ref__isnull=True, vendor__icontains=parsed.vendor))
+        else:
+            receipts = receipts.filter(vendor__icontains=parsed.vendor)
+
+    scope = (f" at {parsed.vendor}" if parsed.vendor else '') + (f" {parsed.period}" if parsed.period else '')
+
+    if parsed.intent in ('top_vendors', 'vendor_totals'):
+        # Grouped by vendor id; unmatched receipts fall back to their raw name
+        rows = (receipts.exclude(vendor='')
+                .values('vendor_ref')
+                .annotate(name=Coalesce('vendor_ref__name', 'vendor'), total=Sum('total_amount'), count=Count('id'))
+                .order_by('-total'))
+        rows = list(rows[:parsed.limit] if parsed.intent == 'top_vendors' else rows[:20])
+        if not rows:
+            return f"I couldn't find any receipts{scope}."
+
+        title = f"Your top {len(rows)} vendors" if parsed.intent == 'top_vendors' else "Spending by vendor"
+        lines = [f"{title}{scope}:"]
+        for position, row in enumerate(rows, start=1):
+            lines.append(f"{position}. {row['name']}: {_money(row['total'])} ({_receipts(row['count'])})")
+        return '\n'.join(lines)
+
+    summary = receipts.aggregate(total=Sum('total_amount'), count=Count('id'), average=Avg('total_amount'))
+    if not summary['count']:
+        return f"I couldn't find any receipts{scope}."
+
+    if parsed.intent == 'count':
+        return f"You have {_receipts(summary['count'])}{scope}."
+    if parsed.intent == 'average':
+        return f"Your average receipt{scope} is {_money(summary['average'])} ({_receipts(summary['count'])})."
+    return f"You spent {_money(summary['total'])}{scope} across {_receipts(summary['count'])}."
+
+
+def answer_query(user, text):
+    parsed = parse_query(text or '')
+    if parsed is None:
+        return None
+    return run_query(user, parsed)
@@ -0,0 +1,287 @@
+"""
+Deadlines, hedged requests and circuit breakers around Gemini calls.
+
+The Gemini client has no timeout and retries failed calls itself with up to
+a minute of backoff, so a brownout can hold a call for many minutes. ``call``
+runs the client on a thread, at most ``GEMINI_MAX_CONCURRENCY`` at a time,
+and gives up after ``GEMINI_CALL_TIMEOUT`` seconds. An abandoned call keeps
+its slot until the client returns, which bounds how many calls a brownout
+can pin. When a call is still running after the p95 latency recently seen
+for its model, a second identical call is started and the first answer wins
+(``GEMINI_HEDGE``). ``acall`` does the same for coroutines and cancels the
+loser.
+
+Timeouts and provider errors feed a circuit breaker per model. After
+``GEMINI_BREAKER_FAILURES`` consecutive failures, calls fail at once with
+``CircuitOpen`` for ``GEMINI_BREAKER_RESET`` seconds. After that, one trial
+call is let through, and its result closes or reopens the circuit. Jobs that
+fail with ``Unavailable`` are retried once the circuit may have closed, and
+the user is told their message is queued.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from django.conf import settings
+
+from . import metrics
+from .metrics import propagate
+
+logger = logging.getLogger(__name__)
+
+LATENCY_SAMPLES = 200  # recent successful calls per model used for the hedge delay
+
+CALLS = metrics.Counter('gemini_calls_total', 'Gemini calls by model and outcome (ok, error, timeout, rejected)',
+                        ['model', 'outcome'])
+CALL_SECONDS = metrics.Histogram('gemini_call_seconds', 'Duration of successful Gemini calls, hedges included',
+                                 ['model'])
+CALL_P95 = metrics.Gauge('gemini_call_p95_seconds', 'p95 of recent successful Gemini calls (the hedge delay)',
+                         ['model'])
+HEDGES = metrics.Counter('gemini_hedges_total', 'Hedged Gemini calls by which request answered first (primary, hedge)',
+                         ['model', 'winner'])
+CIRCUIT_OPEN = metrics.Gauge('gemini_circuit_open', '1 while calls to the model are being rejected', ['model'])
+
+
+class Unavailable(Exception):
+    """The model could not answer in time; the job should be retried later."""
+
+
+class CallTimeout(Unavailable):
+    pass
+
+
+class CircuitOpen(Unavailable):
+    pass
+
+
+def is_provider_error(error):
+    from google.api_core.exceptions import GoogleAPIError
+
+    # Connection failures surface as OSError subclasses from requests, httpx and gRPC alike
+    return isinstance(error, (GoogleAPIError, OSError))
+
+
+class CircuitBreaker:
+    def __init__(self, model_name, failures, reset):
+        self.model_name = model_name
+        self.max_failures = failures
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise ``CircuitOpen`` unless a call may go through now."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            now = time.monotonic()
+            if now - self.opened_at < self.reset:
+                raise CircuitOpen(f"{self.model_name} is unavailable, retrying in {self.reset:.0f}s")
+            # Half-open: one trial at a time, replaced if it never reported back
+            if self.trial_at is not None and now - self.trial_at < self.reset:
+                raise CircuitOpen(f"{self.model_name} is unavailable, a trial call is in flight")
+            self.trial_at = now
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("Circuit for %s closed", self.model_name)
+            self.failures = 0
+            self.opened_at = self.trial_at = None
+        CIRCUIT_OPEN.set(0, model=self.model_name)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_at is None and self.failures < self.max_failures:
+                return
+            if self.opened_at is None:
+                logger.warning("Circuit for %s opened after %s failures", self.model_name, self.failures)
+            self.opened_at = time.monotonic()
+            self.trial_at = None
+        CIRCUIT_OPEN.set(1, model=self.model_name)
+
+
+_breakers = {}
+_latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+_lock = threading.Lock()
+_slots = None
+_slots_pid = None
+
+
+def get_breaker(model_name):
+    breaker = _breakers.get(model_name)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.setdefault(model_name, CircuitBreaker(
+                model_name, settings.GEMINI_BREAKER_FAILURES, settings.GEMINI_BREAKER_RESET))
+    return breaker
+
+
+def slots():
+    global _slots, _slots_pid
+    # Forked workers get their own limit rather than the parent's semaphore
+    if _slots is None or _slots_pid != os.getpid():
+        with _lock:
+            if _slots is None or _slots_pid != os.getpid():
+                _slots = threading.BoundedSemaphore(settings.GEMINI_MAX_CONCURRENCY)
+                _slots_pid = os.getpid()
+    return _slots
+
+
+def submit(fn, *args):
+    """
+    Run ``fn(*args)`` on a daemon thread once a slot is free and return its future.
+
+    Not a ``ThreadPoolExecutor``: its threads are joined at exit, and an
+    abandoned call can spend minutes in the client's retry loop.
+    """
+    future = Future()
+    fn = propagate(fn)
+
+    def run():
+        with slots():
+            # Cancelled while waiting for a slot
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    threading.Thread(target=run, name='gemini-call', daemon=True).start()
+    return future
+
+
+def hedge_delay(model_name):
+    """Seconds after which a second request is sent, or None until enough calls were seen."""
+    with _lock:
+        samples = sorted(_latencies[model_name])
+    if len(samples) < settings.GEMINI_HEDGE_MIN_SAMPLES:
+        return None
+    return samples[int(len(samples) * 0.95) - 1]
+
+
+def record_latency(model_name, seconds):
+    CALL_SECONDS.observe(seconds, model=model_name)
+    with _lock:
+        _latencies[model_name].append(seconds)
+    p95 = hedge_delay(model_name)
+    if p95 is not None:
+        CALL_P95.set(p95, model=model_name)
+
+
+class Attempt:
+    """Bookkeeping shared by ``call`` and ``acall`` for one logical call."""
+
+    def __init__(self, model_name, timeout, hedge):
+        self.model_name = model_name
+        self.timeout = timeout or settings.GEMINI_CALL_TIMEOUT
+        self.breaker = get_breaker(model_name)
+        try:
+            self.breaker.before_call()
+        except CircuitOpen:
+            CALLS.inc(model=model_name, outcome='rejected')
+            raise
+        self.started = time.monotonic()
+        self.delay = hedge_delay(model_name) if hedge and settings.GEMINI_HEDGE else None
+        self.hedge = None
+        self.error = None
+
+    def next_wait(self):
+        """Seconds to wait for an answer before hedging or giving up; None once the deadline passed."""
+        elapsed = time.monotonic() - self.started
+        if elapsed >= self.timeout:
+            return None
+        if self.hedge is None and self.delay is not None and self.delay < self.timeout:
+            return max(0.0, self.delay - elapsed)
+        return self.timeout - elapsed
+
+    def should_hedge(self):
+        return (self.hedge is None and self.delay is not None
+                and time.monotonic() - self.started >= self.delay)
+
+    def hedged(self, request):
+        self.hedge = request
+        logger.info("Hedging %s call after %.2fs", self.model_name, self.delay)
+
+    def succeeded(self, request):
+        if self.hedge is not None:
+            HEDGES.inc(model=self.model_name, winner='hedge' if request is self.hedge else 'primary')
+        record_latency(self.model_name, time.monotonic() - self.started)
+        CALLS.inc(model=self.model_name, outcome='ok')
+        self.breaker.success()
+
+    def failed(self, error):
+        self.error = error
+
+    def finish(self):
+        """Raise the error that ends the call: the last failure, or ``CallTimeout``."""
+        if self.error is not None and time.monotonic() - self.started < self.timeout:
+            CALLS.inc(model=self.model_name, outcome='error')
+            if is_provider_error(self.error):
+                self.breaker.failure()
+            else:
+                # The model answered; the caller just couldn't use the answer
+                self.breaker.success()
+            raise self.error
+        CALLS.inc(model=self.model_name, outcome='timeout')
+        self.breaker.failure()
+        raise CallTimeout(f"{self.model_name} did not answer within {self.timeout:.0f}s")
+
+
+def call(model_name, fn, *args, timeout=None, hedge=True):
+    """Run ``fn(*args)`` against ``model_name`` with a deadline, an optional hedge and the circuit breaker."""
+    attempt = Attempt(model_name, timeout, hedge)
+    pending = {submit(fn, *args)}
+    while pending:
+        remaining = attempt.next_wait()
+        if remaining is None:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for request in done:
+            if request.exception() is None:
+                attempt.succeeded(request)
+                return request.result()
+            attempt.failed(request.exception())
+        if pending and attempt.should_hedge():
+            request = submit(fn, *args)
+            attempt.hedged(request)
+            pending.add(request)
+    for request in pending:
+        # Requests still waiting for a slot never start; running ones are abandoned
+        request.cancel()
+    attempt.finish()
+
+
+async def acall(model_name, fn, *args, timeout=None, hedge=True):
+    """Async counterpart of ``call`` for a coroutine function ``fn``."""
+    attempt = Attempt(model_name, timeout, hedge)
+    pending = {asyncio.ensure_future(fn(*args))}
+    try:
+        while pending:
+            remaining = attempt.next_wait()
+            if remaining is None:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for request in done:
+                if request.exception() is None:
+                    attempt.succeeded(request)
+                    return request.result()
+                attempt.failed(request.exception())
+            if pending and attempt.should_hedge():
+                request = asyncio.ensure_future(fn(*args))
+                attempt.hedged(request)
+                pending.add(request)
+    finally:
+        for request in pending:
+            request.cancel()
+    attempt.finish()
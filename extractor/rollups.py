@@ -0,0 +1,55 @@
+"""
+Incremental maintenance of the per-user ``DailySpend`` rollup.
+"""
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .models import DailySpend, Receipt
+
+
+def apply_delta(user_id, day, amount, count):
+    amount = amount or Decimal('0')
+    if not amount and not count:
+        return
+
+    rows = DailySpend.objects.filter(user_id=user_id, date=day)
+    if not rows.update(total=F('total') + amount, count=F('count') + count):
+        try:
+            with transaction.atomic():
+                DailySpend.objects.create(user_id=user_id, date=day, total=amount, count=count)
+        except IntegrityError:
+            # Created concurrently by another worker
+            rows.update(total=F('total') + amount, count=F('count') + count)
+
+    if count < 0:
+        rows.filter(count__lte=0).delete()
+
+
+def add_receipt(receipt):
+    apply_delta(receipt.user_id, receipt.date, receipt.total_amount, 1)
+
+
+def remove_receipt(receipt):
+    apply_delta(receipt.user_id, receipt.date, -(receipt.total_amount or Decimal('0')), -1)
+
+
+def rebuild(user=None):
+    """Recompute the rollup from the receipts table."""
+    receipts = Receipt.objects.all()
+    rollups = DailySpend.objects.all()
+    if user is not None:
+        receipts = receipts.filter(user=user)
+        rollups = rollups.filter(user=user)
+
+    rows = (receipts.values('user', 'date')
+            .annotate(day_total=Sum('total_amount'), day_count=Count('id'))
+            .order_by())
+    with transaction.atomic():
+        rollups.delete()
+        DailySpend.objects.bulk_create([
+            DailySpend(user_id=row['user'], date=row['date'],
+                       total=row['day_total'] or 0, count=row['day_count'])
+            for row in rows
+        ], batch_size=1000)
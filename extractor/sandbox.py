@@ -0,0 +1,300 @@
+"""
+Sandboxed execution of the query agent's Python tool.
+
+The pandas code the agent writes runs in a small pool of worker processes
+instead of the Django process. Workers are forked from a forkserver that
+has only imported pandas and this module, never from the threaded Django
+process, and each one is started ahead of the first query. Each worker has these limits:
+
+- its address space is capped at ``QUERY_SANDBOX_MEMORY_MB`` with
+  ``RLIMIT_AS``;
+- each tool call gets ``QUERY_SANDBOX_CPU_SECONDS`` of CPU time with
+  ``RLIMIT_CPU``;
+- it is killed and replaced when a call outlives ``QUERY_SANDBOX_TIMEOUT``,
+  or once it has served ``QUERY_SANDBOX_MAX_TASKS`` queries.
+
+A query checks out one worker for all of its tool steps. On the first step,
+its DataFrame is pickled once with the column arrays out of band, in a
+shared memory block that the worker maps instead of receiving a copy.
+"""
+import logging
+import pickle
+import threading
+from multiprocessing import shared_memory
+
+from django.conf import settings
+
+from . import metrics
+from .metrics import span
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_LIMIT = 20000  # characters of a tool result sent back to the agent
+
+CALLS = metrics.Counter('query_sandbox_calls_total', 'Agent tool calls run in the sandbox by outcome '
+                        '(ok, timeout, killed, unavailable)', ['outcome'])
+
+TIMEOUT_MESSAGE = "TimeoutError: the code ran for more than {seconds:.0f}s and was stopped"
+KILLED_MESSAGE = "MemoryError: the code exceeded the sandbox's CPU time or memory limit and was stopped"
+CLOSED_MESSAGE = "RuntimeError: this query has already finished"
+UNAVAILABLE_MESSAGE = "RuntimeError: the sandbox could not start a worker to run the code"
+
+
+def run_code(code, namespace):
+    """Run ``code`` like ``PythonAstREPLTool`` does and return its output as text."""
+    import ast
+    from contextlib import redirect_stdout
+    from io import StringIO
+
+    try:
+        tree = ast.parse(code)
+        exec(ast.unparse(ast.Module(tree.body[:-1], type_ignores=[])), namespace)
+        last = ast.unparse(ast.Module(tree.body[-1:], type_ignores=[]))
+        output = StringIO()
+        try:
+            with redirect_stdout(output):
+                result = eval(last, namespace)
+        except Exception:
+            with redirect_stdout(output):
+                exec(last, namespace)
+            result = None
+        return output.getvalue() if result is None else str(result)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def serve(conn, memory_bytes, cpu_seconds):
+    """
+    Worker loop. ``('load', block_name, payload, sizes)`` maps a query's ``df``,
+    ``('run', code)`` runs code against it and ``('release',)`` drops it.
+    """
+    import gc
+    import resource
+
+    import pandas as pd
+
+    if memory_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    namespace, block = None, None
+    while True:
+        try:
+            op, *args = conn.recv()
+        except EOFError:
+            return
+
+        if op in ('load', 'release') and block is not None:
+            # Nothing of the previous query's frame stays mapped
+            namespace = None
+            gc.collect()
+            block.close()
+            block = None
+
+        if op == 'release':
+            conn.send(None)
+
+        elif op == 'load':
+            name, payload, sizes = args
+            block = shared_memory.SharedMemory(name=name)
+            buffers, offset = [], 0
+            for size in sizes:
+                buffers.append(block.buf[offset:offset + size])
+                offset += size
+            namespace = {'df': pickle.loads(payload, buffers=buffers), 'pd': pd}
+            del buffers
+            conn.send(None)
+
+        elif op == 'run':
+            if cpu_seconds:
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                # SIGXCPU ends the worker once this call has used its share of CPU time
+                limit = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+                resource.setrlimit(resource.RLIMIT_CPU, (limit, resource.RLIM_INFINITY))
+            output = run_code(args[0], namespace)
+            conn.send(output[:OUTPUT_LIMIT])
+
+
+class WorkerDied(Exception):
+    pass
+
+
+class Worker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=serve, name='query-sandbox', daemon=True, args=(
+            child, settings.QUERY_SANDBOX_MEMORY_MB * 1024 * 1024, settings.QUERY_SANDBOX_CPU_SECONDS))
+        self.process.start()
+        child.close()
+        self.tasks = 0
+
+    def request(self, message, timeout):
+        """Send ``message`` and return the reply; raises ``TimeoutError`` or ``WorkerDied``."""
+        try:
+            self.conn.send(message)
+            if self.conn.poll(timeout):
+                return self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise WorkerDied(str(e)) from e
+        raise TimeoutError
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._ctx = None
+
+    def context(self):
+        if self._ctx is None:
+            import multiprocessing
+
+            self._ctx = multiprocessing.get_context('forkserver')
+            self._ctx.set_forkserver_preload(['pandas', __name__])
+        return self._ctx
+
+    def start(self):
+        """Start the workers up front so the first query doesn't wait for them."""
+        with self._cond:
+            while self._size < settings.QUERY_SANDBOX_WORKERS:
+                self._idle.append(Worker(self.context()))
+                self._size += 1
+
+    def checkout(self):
+        with self._cond:
+            while not self._idle and self._size >= settings.QUERY_SANDBOX_WORKERS:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+        try:
+            return Worker(self.context())
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def checkin(self, worker, healthy=True):
+        worker.tasks += 1
+        if healthy and worker.tasks < settings.QUERY_SANDBOX_MAX_TASKS and worker.process.is_alive():
+            with self._cond:
+                self._idle.append(worker)
+                self._cond.notify()
+            return
+
+        worker.stop()
+        try:
+            # Replaced right away so the next query finds a worker ready
+            worker = Worker(self.context())
+        except Exception as e:
+            logger.warning("Error starting a sandbox worker: %s", e)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append(worker)
+            self._cond.notify()
+
+
+pool = SandboxPool()
+
+
+def share(df):
+    """Pickle ``df`` with its arrays out of band in a shared memory block; returns ``(block, payload, sizes)``."""
+    buffers = []
+    payload = pickle.dumps(df, protocol=5, buffer_callback=buffers.append)
+    raw = [buffer.raw() for buffer in buffers]
+    sizes = [view.nbytes for view in raw]
+    block = shared_memory.SharedMemory(create=True, size=max(1, sum(sizes)))
+    try:
+        offset = 0
+        for view in raw:
+            block.buf[offset:offset + view.nbytes] = view
+            offset += view.nbytes
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    return block, payload, sizes
+
+
+class Session:
+    """One query's worker and DataFrame; both are set up on the first tool call."""
+
+    def __init__(self, df):
+        self.df = df
+        self.worker = None
+        self.loaded = False
+        self.shared = None
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def run(self, code):
+        timeout = settings.QUERY_SANDBOX_TIMEOUT
+        with self._lock:
+            # An agent run abandoned after its deadline must not reach a worker serving another query
+            if self.closed:
+                return CLOSED_MESSAGE
+            if self.worker is None:
+                # Checked out before the frame is shared, so a worker that can't start leaves no block behind
+                try:
+                    self.worker = pool.checkout()
+                except Exception as e:
+                    CALLS.inc(outcome='unavailable')
+                    logger.error("Error starting a sandbox worker: %s", e)
+                    return UNAVAILABLE_MESSAGE
+                self.loaded = False
+            if self.shared is None:
+                self.shared = share(self.df)
+            with span('sandbox', bytes=self.shared[0].size):
+                try:
+                    if not self.loaded:
+                        block, payload, sizes = self.shared
+                        self.worker.request(('load', block.name, payload, sizes), timeout)
+                        self.loaded = True
+                    output = self.worker.request(('run', code), timeout)
+                except TimeoutError:
+                    CALLS.inc(outcome='timeout')
+                    logger.warning("Sandboxed code ran for more than %ss, stopping the worker", timeout)
+                    self.discard_worker()
+                    return TIMEOUT_MESSAGE.format(seconds=timeout)
+                except WorkerDied:
+                    CALLS.inc(outcome='killed')
+                    logger.warning("Sandbox worker died, probably on its CPU or memory limit")
+                    self.discard_worker()
+                    return KILLED_MESSAGE
+            CALLS.inc(outcome='ok')
+            return output
+
+    def discard_worker(self):
+        pool.checkin(self.worker, healthy=False)
+        self.worker = None
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            if self.worker is not None:
+                try:
+                    self.worker.request(('release',), settings.QUERY_SANDBOX_TIMEOUT)
+                except (TimeoutError, WorkerDied):
+                    self.discard_worker()
+                else:
+                    pool.checkin(self.worker)
+                    self.worker = None
+            if self.shared is not None:
+                # The worker's mapping outlives the name, so unlinking right away is safe
+                self.shared[0].close()
+                self.shared[0].unlink()
+                self.shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,62 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import dashboard, rollups
+from .frames import receipt_frames
+from .models import Receipt
+from .vendors import assign_vendor
+
+
+@receiver(pre_save, sender=Receipt)
+def remember_previous_receipt(sender, instance, **kwargs):
+    # Updates need the stored values to move the amount out of the old day
+    instance._rollup_previous = None
+    if instance.pk:
+        instance._rollup_previous = (Receipt.objects
+                                     .filter(pk=instance.pk)
+                                     .only('user', 'date', 'vendor', 'total_amount')
+                                     .first())
+
+
+@receiver(pre_save, sender=Receipt)
+def match_vendor(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_rollup_previous', None)
+    if instance.vendor_ref_id is None or previous is None or previous.vendor != instance.vendor:
+        assign_vendor(instance)
+
+
+@receiver(post_save, sender=Receipt)
+def update_rollup_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_rollup_previous', None)
+    if previous is not None:
+        if (previous.user_id, previous.date, previous.total_amount) == (instance.user_id, instance.date, instance.total_amount):
+            return
+        rollups.remove_receipt(previous)
+    rollups.add_receipt(instance)
+
+
+@receiver(post_delete, sender=Receipt)
+def update_rollup_on_delete(sender, instance, **kwargs):
+    rollups.remove_receipt(instance)
+
+
+@receiver(post_save, sender=Receipt)
+@receiver(post_delete, sender=Receipt)
+def bump_receipt_version(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+
+    # Only committed rows reach the dashboard and the cached query frames
+    def changed():
+        current = dashboard.bump(instance.user_id)
+        if created:
+            receipt_frames.append(instance, current)
+        else:
+            receipt_frames.invalidate(instance.user_id)
+
+    transaction.on_commit(changed)
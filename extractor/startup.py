@@ -0,0 +1,83 @@
+"""
+Cold-start cost of the Django processes.
+
+The extraction stack (PyMuPDF, pandas, Pillow, LangChain and the Gemini
+client) is imported on first use, so web workers serving login pages and
+``manage.py`` commands such as ``migrate`` never load it. Processes that will
+extract receipts anyway call ``preload`` up front: the job workers always do
+before starting (so forked workers share the pages), and web workers do when
+``PRELOAD_ON_STARTUP`` is set, e.g. under ``gunicorn --preload``.
+``manage.py benchmark_startup`` measures both in fresh interpreters.
+"""
+import importlib
+import json
+import logging
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+HEAVY_MODULES = [
+    'numpy',
+    'pandas',
+    'fitz',
+    'PIL.Image',
+    'langchain.agents',
+    'langchain_experimental.tools.python.tool',
+    'langchain_google_genai',
+    'extractor.utils',
+    'extractor.tasks',
+]
+
+PROBE = """
+import json, os, resource, time
+started = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+import django
+django.setup()
+from django.conf import settings
+__import__(settings.ROOT_URLCONF)
+if {preload}:
+    from extractor.startup import preload
+    preload()
+print(json.dumps({{
+    'ms': (time.perf_counter() - started) * 1000,
+    # ru_maxrss is in kilobytes on Linux
+    'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}}))
+"""
+
+
+def preload(modules=HEAVY_MODULES):
+    """Import ``modules`` now and return the milliseconds each one took."""
+    timings = {}
+    for name in modules:
+        started = time.perf_counter()
+        importlib.import_module(name)
+        timings[name] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info("Preloaded %s modules in %.0f ms", len(timings), sum(timings.values()))
+    return timings
+
+
+def parse_importtime(output):
+    """Sum ``-X importtime`` self times (microseconds) by top-level package."""
+    totals = defaultdict(int)
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line.split('|')
+        totals[name.strip().split('.', 1)[0]] += int(self_us.split(':')[1])
+    return totals
+
+
+def measure(preload_modules=False):
+    """Start a fresh interpreter that sets up Django and imports the URLconf; return its report."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-W', 'ignore', '-c',
+                             PROBE.format(preload=preload_modules)],
+                            capture_output=True, text=True, check=True)
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['packages_ms'] = {name: round(us / 1000, 1) for name, us in
+                             sorted(parse_importtime(result.stderr).items(), key=lambda item: -item[1])}
+    return report
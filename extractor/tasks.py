@@ -0,0 +1,191 @@
+import logging
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+from .batch import batch_result, discard_staged, ingest, is_supported, summary_message, unstage
+from .dedupe import find_duplicate, receipt_flights
+from .forms import ReceiptForm
+from .media import MediaTooLarge, download_media
+from .metrics import propagate, span
+from .models import ReceiptJob
+from .notifier import notifier
+from .utils import process_receipt, process_receipt_query
+
+logger = logging.getLogger(__name__)
+
+INVALID_RECEIPT_MESSAGE = "Error processing receipt data. Please try again with a clear image or PDF."
+MEDIA_TOO_LARGE_MESSAGE = "This file is too large to process. Please send a smaller image or PDF."
+NO_ANSWER_MESSAGE = 'Sorry I was not able to solve your query, can you try again'
+QUEUED_FOR_RETRY_MESSAGE = "Our receipt assistant is busy right now. Your message is queued and will be processed in a few minutes."
+
+FAILURE_MESSAGES = {
+    ReceiptJob.KIND_RECEIPT: "An error occurred while processing your receipt. Please try again.",
+    ReceiptJob.KIND_RECEIPT_BATCH: "An error occurred while processing your receipts. Please try again.",
+    ReceiptJob.KIND_QUERY: "An error occurred while processing your query. Please try again.",
+}
+
+
+def send_whatsapp(user_phone, body):
+    # Queued for the notifier's sender threads, which own rate limiting and retries
+    return notifier.notify(user_phone, body)
+
+
+def media_filename(media_url, mime_type):
+    media_sid = os.path.basename(urlparse(media_url).path)
+    return f'{media_sid}{mimetypes.guess_extension(mime_type) or ""}'
+
+
+def save_extracted_receipt(user, upload, media_hash, extracted_data):
+    """Validate and save an extraction result; returns ``(receipt, reply)`` with ``receipt`` None if invalid."""
+    if extracted_data is None:
+        return None, INVALID_RECEIPT_MESSAGE
+
+    form_data = {
+        'date': extracted_data.get("date"),
+        'vendor': extracted_data.get("vendor"),
+        'total_amount': extracted_data.get("total_amount")
+    }
+
+    with span('validate'):
+        form = ReceiptForm(form_data, files={'file': upload})
+        valid = form.is_valid()
+    if not valid:
+        logger.warning("Invalid receipt data: %s", form.errors.as_json())
+        return None, INVALID_RECEIPT_MESSAGE
+
+    with span('save', bytes=upload.size):
+        receipt = form.save(commit=False)
+        receipt.user = user
+        receipt.content_hash = media_hash
+        receipt.save()
+    return receipt, receipt_reply(receipt)
+
+
+def receipt_reply(receipt, duplicate=False):
+    formatted_data = f"Your receipt was processed !! \n" \
+                     f"Receipt Details:\n" \
+                     f"Date: {receipt.date.strftime('%d-%m-%Y') if receipt.date else ''}\n" \
+                     f"Vendor: {receipt.vendor}\n" \
+                     f"Total Amount: ${receipt.total_amount or 0:.2f}\n"
+    if duplicate:
+        formatted_data += "Note: you have sent this receipt before, so it was not saved again.\n"
+    return formatted_data
+
+
+def extract_and_save(user, upload, media_hash, mime_type):
+    existing = find_duplicate(user, media_hash)
+    if existing is not None:
+        return existing, receipt_reply(existing, duplicate=True)
+
+    extracted_data = process_receipt(upload.temporary_file_path(), mime_type)
+    logger.info("Extracted %s", extracted_data)
+    return save_extracted_receipt(user, upload, media_hash, extracted_data)
+
+
+def process_receipt_job(job):
+    media_url = job.payload['media_url']
+    mime_type = job.payload['mime_type']
+    user_phone = job.payload['user_phone']
+
+    # Download errors propagate so the job is retried with backoff
+    try:
+        with span('download', mime_type=mime_type) as fields:
+            upload, media_hash = download_media(media_url, mime_type, media_filename(media_url, mime_type))
+            fields['bytes'] = upload.size
+    except MediaTooLarge as e:
+        logger.warning(str(e))
+        send_whatsapp(user_phone, MEDIA_TOO_LARGE_MESSAGE)
+        return
+
+    try:
+        # A copy of this media already in flight for the user is waited for, not extracted again
+        (receipt, reply), shared = receipt_flights.do((job.user_id, media_hash), extract_and_save,
+                                                      job.user, upload, media_hash, mime_type)
+        if shared and receipt is not None:
+            reply = receipt_reply(receipt, duplicate=True)
+    finally:
+        # Removes the temporary file unless storage already moved it into MEDIA_ROOT
+        upload.close()
+
+    send_whatsapp(user_phone, reply)
+
+
+def process_receipt_batch_job(job):
+    if 'files' in job.payload:
+        return process_uploaded_batch_job(job)
+
+    user_phone = job.payload['user_phone']
+
+    def download(item):
+        try:
+            with span('download', mime_type=item['mime_type']) as fields:
+                upload, media_hash = download_media(item['media_url'], item['mime_type'],
+                                                    media_filename(item['media_url'], item['mime_type']))
+                fields['bytes'] = upload.size
+            return upload, media_hash
+        except MediaTooLarge as e:
+            logger.warning(str(e))
+            return None
+
+    # Numbered as the user sent them, before unsupported media is left out
+    media = [(f"file {index}", item) for index, item in enumerate(job.payload['media'], 1)]
+    skipped = [label for label, item in media if not is_supported(item['mime_type'])]
+    media = [(label, item) for label, item in media if is_supported(item['mime_type'])]
+    # Download errors propagate before anything is saved, so the whole batch is retried
+    with ThreadPoolExecutor(max_workers=settings.BULK_EXTRACTION_WORKERS) as pool:
+        downloads = list(pool.map(propagate(download), [item for _, item in media]))
+
+    receipts, unreadable = ingest(job.user, [result for result in downloads if result is not None])
+    failed = [label for (label, _), result in zip(media, downloads) if result is None or result[0].name in unreadable]
+
+    send_whatsapp(user_phone, summary_message(receipts, failed, skipped))
+
+
+def process_uploaded_batch_job(job):
+    """Ingest files staged by the bulk upload API and keep the outcome on the job for its status endpoint."""
+    staged = job.payload['files']
+    try:
+        receipts, failed = ingest(job.user, [unstage(item) for item in staged])
+    except Exception:
+        # Kept for the retry, unless this was the last attempt
+        if job.attempts >= settings.RECEIPT_JOB_MAX_ATTEMPTS:
+            discard_staged(staged)
+        raise
+    discard_staged(staged)
+
+    result = batch_result(receipts, failed, job.payload.get('skipped', []))
+    ReceiptJob.objects.filter(pk=job.pk).update(payload={**job.payload, 'result': result})
+
+
+def process_query_job(job):
+    user_phone = job.payload['user_phone']
+
+    result = process_receipt_query(user=job.user, query=job.payload['message'])
+    logger.info("Query answer: %s", result)
+
+    if not result:
+        result = NO_ANSWER_MESSAGE
+
+    send_whatsapp(user_phone, result)
+
+
+def notify_job_failed(job):
+    # Bulk uploads through the API have no WhatsApp number; their status endpoint shows the failure
+    if job.payload.get('user_phone'):
+        send_whatsapp(job.payload['user_phone'], FAILURE_MESSAGES[job.kind])
+
+
+def notify_job_deferred(job):
+    if job.payload.get('user_phone'):
+        send_whatsapp(job.payload['user_phone'], QUEUED_FOR_RETRY_MESSAGE)
+
+
+HANDLERS = {
+    ReceiptJob.KIND_RECEIPT: process_receipt_job,
+    ReceiptJob.KIND_RECEIPT_BATCH: process_receipt_batch_job,
+    ReceiptJob.KIND_QUERY: process_query_job,
+}
@@ -1,3 +1,911 @@
-from django.test import TestCase
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import dashboard, dedupe, jobs, metrics, resilience, rollups, sandbox
+from .batch import STAGING_DIR, to_temporary_upload
+from .cache import ResultCache, content_hash
+from .cascade import aextract, extract, extraction_problems
+from .charts import lttb
+from .frames import receipt_frames
+from .media import MediaTooLarge
+from .microbatch import split_batch
+from .models import CustomUser, DailySpend, ExtractionCache, InboundMessage, Receipt, ReceiptJob, Vendor, VendorAlias
+from .notifier import NotificationFailed, Notifier, retry_after
+from .pagination import decode_cursor, encode_cursor, receipt_page
+from .queries import parse_query
+from .tasks import FAILURE_MESSAGES, QUEUED_FOR_RETRY_MESSAGE, process_receipt_batch_job
+from .vendors import vendor_index
+
+TODAY = date(2026, 10, 18)
+
+
+class ParseQueryTests(SimpleTestCase):
+    def parse(self, text):
+        return parse_query(text, today=TODAY)
+
+    def test_total_for_period(self):
+        parsed = self.parse("How much did I spend this month?")
+        self.assertEqual(parsed.intent, 'total')
+        self.assertEqual((parsed.start, parsed.end), (date(2026, 10, 1), date(2026, 10, 19)))
+
+    def test_month_with_preposition_or_year(self):
+        parsed = self.parse("total in march")
+        self.assertEqual((parsed.start, parsed.end), (date(2026, 3, 1), date(2026, 4, 1)))
+        parsed = self.parse("total may 2025")
+        self.assertEqual((parsed.start, parsed.end), (date(2025, 5, 1), date(2025, 6, 1)))
+
+    def test_month_words_without_preposition_are_not_periods(self):
+        parsed = self.parse("may I know my total")
+        self.assertEqual(parsed.intent, 'total')
+        self.assertIsNone(parsed.start)
+        parsed = self.parse("how much at mar")
+        self.assertEqual((parsed.vendor, parsed.start), ('mar', None))
+
+    def test_vendor_and_top_limit(self):
+        parsed = self.parse("how many receipts at Starbucks last year")
+        self.assertEqual((parsed.intent, parsed.vendor), ('count', 'starbucks'))
+        self.assertEqual(parsed.start, date(2025, 1, 1))
+        parsed = self.parse("top 3 vendors in 2025")
+        self.assertEqual((parsed.intent, parsed.limit), ('top_vendors', 3))
+
+    def test_unparsed_conditions_go_to_the_agent(self):
+        for text in ("total over 100",
+                     "how much more than 50 dollars",
+                     "how much at starbucks on 2026-01-05",
+                     "what is the total amount on my last receipt",
+                     "how many vendors have I visited",
+                     "average receipt under $20"):
+            with self.subTest(text=text):
+                self.assertIsNone(self.parse(text))
+
+
+class MetricsAccessTests(SimpleTestCase):
+    @override_settings(METRICS_ALLOWED_IPS=['127.0.0.1', '10.0.0.0/8'], METRICS_TOKEN='secret')
+    def test_allowed_addresses_or_token(self):
+        self.assertTrue(metrics.authorized('127.0.0.1', None))
+        self.assertTrue(metrics.authorized('10.1.2.3', None))
+        self.assertTrue(metrics.authorized('203.0.113.5', 'Bearer secret'))
+        self.assertFalse(metrics.authorized('203.0.113.5', 'Bearer wrong'))
+        self.assertFalse(metrics.authorized('203.0.113.5', None))
+
+    @override_settings(METRICS_ALLOWED_IPS=[], METRICS_TOKEN='')
+    def test_empty_token_never_matches(self):
+        self.assertFalse(metrics.authorized('127.0.0.1', 'Bearer '))
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.users = [CustomUser.objects.create_user(f'+1555000010{index}') for index in range(2)]
+
+    def enqueue(self, user, **fields):
+        return ReceiptJob.objects.create(kind=ReceiptJob.KIND_QUERY, user=user,
+                                         payload={'user_phone': user.phone_number, 'message': 'total'}, **fields)
+
+    def test_claims_in_run_after_order(self):
+        now = timezone.now()
+        later = self.enqueue(self.users[0], run_after=now - timedelta(seconds=1))
+        sooner = self.enqueue(self.users[1], run_after=now - timedelta(seconds=5))
+        self.enqueue(self.users[1], run_after=now + timedelta(hours=1))
+        self.assertEqual(jobs.claim_next(), sooner)
+        self.assertEqual(jobs.claim_next(), later)
+        # The remaining job isn't due yet
+        self.assertIsNone(jobs.claim_next())
+
+    @override_settings(RECEIPT_JOBS_PER_USER=1)
+    def test_users_at_their_limit_are_skipped(self):
+        first = self.enqueue(self.users[0])
+        self.enqueue(self.users[0])
+        other = self.enqueue(self.users[1])
+        self.assertEqual(jobs.claim_next(), first)
+        self.assertEqual(jobs.claim_next(), other)
+        self.assertIsNone(jobs.claim_next())
+
+        jobs.job_done(first)
+        claimed = jobs.claim_next()
+        self.assertEqual((claimed.user, claimed.status, claimed.attempts),
+                         (self.users[0], ReceiptJob.STATUS_RUNNING, 1))
+
+    def test_job_won_by_another_worker_is_skipped(self):
+        taken = self.enqueue(self.users[0])
+        free = self.enqueue(self.users[1])
+        real_f = jobs.F
+
+        def other_worker_claims_first(name):
+            # Runs between listing the candidates and the conditional update
+            ReceiptJob.objects.filter(pk=taken.pk).update(status=ReceiptJob.STATUS_RUNNING)
+            return real_f(name)
+
+        with mock.patch.object(jobs, 'F', side_effect=other_worker_claims_first):
+            self.assertEqual(jobs.claim_next(), free)
+        taken.refresh_from_db()
+        self.assertEqual(taken.attempts, 0)
+
+    @override_settings(RECEIPT_JOB_MAX_ATTEMPTS=3, RECEIPT_JOB_RETRY_DELAY=5)
+    def test_retries_back_off_then_fail_with_one_notification(self):
+        self.enqueue(self.users[0])
+        with mock.patch('extractor.tasks.send_whatsapp') as send:
+            for attempt, delay in ((1, 5), (2, 10)):
+                job = jobs.claim_next()
+                before = timezone.now()
+                jobs.job_failed(job, ValueError('boom'))
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.attempts), (ReceiptJob.STATUS_QUEUED, attempt))
+                self.assertAlmostEqual((job.run_after - before).total_seconds(), delay, delta=1)
+                ReceiptJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            send.assert_not_called()
+
+            job = jobs.claim_next()
+            jobs.job_failed(job, ValueError('boom'))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts, job.last_error), (ReceiptJob.STATUS_FAILED, 3, 'boom'))
+            send.assert_called_once_with(self.users[0].phone_number, FAILURE_MESSAGES[ReceiptJob.KIND_QUERY])
+
+    @override_settings(RECEIPT_JOB_MAX_ATTEMPTS=3, RECEIPT_JOB_RETRY_DELAY=5, GEMINI_BREAKER_RESET=60)
+    def test_unavailable_is_deferred_past_the_breaker_reset(self):
+        self.enqueue(self.users[0])
+        with mock.patch('extractor.tasks.send_whatsapp') as send:
+            job = jobs.claim_next()
+            before = timezone.now()
+            jobs.job_failed(job, resilience.Unavailable('gemini'))
+            job.refresh_from_db()
+            self.assertEqual(job.status, ReceiptJob.STATUS_QUEUED)
+            self.assertAlmostEqual((job.run_after - before).total_seconds(), 60, delta=1)
+            send.assert_called_once_with(self.users[0].phone_number, QUEUED_FOR_RETRY_MESSAGE)
+
+    @override_settings(RECEIPT_JOB_TIMEOUT=900)
+    def test_stale_running_jobs_are_requeued(self):
+        stale = self.enqueue(self.users[0], status=ReceiptJob.STATUS_RUNNING,
+                             locked_at=timezone.now() - timedelta(seconds=1000))
+        fresh = self.enqueue(self.users[1], status=ReceiptJob.STATUS_RUNNING, locked_at=timezone.now())
+        self.assertEqual(jobs.requeue_stale(), 1)
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, stale.locked_at), (ReceiptJob.STATUS_QUEUED, None))
+        self.assertEqual(fresh.status, ReceiptJob.STATUS_RUNNING)
+
+
+@override_settings(EXTRACTION_CACHE_ENABLED=True, EXTRACTION_CACHE_LRU_SIZE=2,
+                   EXTRACTION_CACHE_MAX_ENTRIES=2, EXTRACTION_CACHE_TTL=3600)
+class ExtractionCacheTests(TestCase):
+    def setUp(self):
+        self.cache = ResultCache()
+
+    def test_version_is_part_of_the_key(self):
+        self.assertEqual(content_hash(b'pdf', 'application/pdf', 'v1'), content_hash(b'pdf', 'application/pdf', 'v1'))
+        self.assertNotEqual(content_hash(b'pdf', 'application/pdf', 'v1'), content_hash(b'pdf', 'application/pdf', 'v2'))
+        self.assertNotEqual(content_hash([b'a', b'b'], 'image/png'), content_hash([b'ab'], 'image/png'))
+
+    def test_hits_from_memory_then_database(self):
+        self.cache.set('a', {'vendor': 'Cafe'})
+        self.assertEqual(self.cache.get('a'), {'vendor': 'Cafe'})
+        self.assertEqual(self.cache.stats['memory_hits'], 1)
+
+        self.cache.clear()
+        self.assertEqual(self.cache.get('a'), {'vendor': 'Cafe'})
+        self.assertEqual((self.cache.stats['db_hits'], ExtractionCache.objects.get().hits), (1, 1))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_rows_past_the_ttl_are_misses(self):
+        self.cache.set('a', {'vendor': 'Cafe'})
+        self.cache.clear()
+        ExtractionCache.objects.update(last_hit_at=timezone.now() - timedelta(hours=2))
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_eviction_keeps_the_most_recently_hit_rows_and_is_throttled(self):
+        for index, key in enumerate('abc'):
+            self.cache.set(key, {'n': index})
+            ExtractionCache.objects.filter(content_hash=key).update(
+                last_hit_at=timezone.now() - timedelta(minutes=10 - index))
+        # Only the first store evicted; 'c' pushed the table past the limit afterwards
+        self.assertEqual(ExtractionCache.objects.count(), 3)
+        self.assertEqual(self.cache.stats['evictions'], 0)
+
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertQuerysetEqual(ExtractionCache.objects.order_by('content_hash').values_list('content_hash', flat=True),
+                                 ['b', 'c'])
+
+        self.cache.clear()
+        with mock.patch.object(ExtractionCache.objects, 'order_by', wraps=ExtractionCache.objects.order_by) as scan:
+            self.cache.set('d', {'n': 3})
+        scan.assert_called_once()
+        self.assertEqual(ExtractionCache.objects.count(), 2)
+
+
+class DailySpendRollupTests(TestCase):
+    def setUp(self):
+        vendor_index.clear()
+        self.user = CustomUser.objects.create_user('+15550000003')
+
+    def rollup(self):
+        return list(DailySpend.objects.filter(user=self.user).order_by('date').values_list('date', 'total', 'count'))
+
+    def receipt(self, day, amount):
+        return Receipt.objects.create(user=self.user, file='r.png', date=day, vendor='Cafe', total_amount=amount)
+
+    def test_saves_and_deletes_keep_the_rollup_in_step(self):
+        first = self.receipt(date(2026, 1, 5), 4)
+        self.receipt(date(2026, 1, 5), 6)
+        self.assertEqual(self.rollup(), [(date(2026, 1, 5), 10, 2)])
+
+        first.total_amount = 5
+        first.save()
+        self.assertEqual(self.rollup(), [(date(2026, 1, 5), 11, 2)])
+
+        # Moving a receipt to another day moves its amount with it
+        first.date = date(2026, 1, 6)
+        first.save()
+        self.assertEqual(self.rollup(), [(date(2026, 1, 5), 6, 1), (date(2026, 1, 6), 5, 1)])
+
+        first.delete()
+        self.assertEqual(self.rollup(), [(date(2026, 1, 5), 6, 1)])
+
+    def test_rebuild_matches_the_signals(self):
+        self.receipt(date(2026, 1, 5), 4)
+        self.receipt(date(2026, 1, 7), None)
+        expected = self.rollup()
+        self.assertEqual(expected, [(date(2026, 1, 5), 4, 1), (date(2026, 1, 7), 0, 1)])
+
+        DailySpend.objects.filter(user=self.user).delete()
+        rollups.rebuild(self.user)
+        self.assertEqual(self.rollup(), expected)
+
+
+class ReceiptPageTests(TestCase):
+    def setUp(self):
+        vendor_index.clear()
+        self.user = CustomUser.objects.create_user('+15550000004')
+        other = CustomUser.objects.create_user('+15550000005')
+        Receipt.objects.create(user=other, file='x.png', date=date(2026, 1, 5), vendor='Cafe', total_amount=1)
+        for day in (date(2026, 1, 5), None, date(2026, 1, 7), date(2026, 1, 5), None, date(2026, 1, 6)):
+            Receipt.objects.create(user=self.user, file='r.png', date=day, vendor='Cafe', total_amount=1)
+
+    def test_cursor_round_trips(self):
+        for receipt in Receipt.objects.filter(user=self.user):
+            self.assertEqual(decode_cursor(encode_cursor(receipt)), (receipt.date, receipt.pk))
+
+    def test_pages_walk_newest_first_with_undated_last(self):
+        expected = sorted(Receipt.objects.filter(user=self.user),
+                          key=lambda receipt: (receipt.date is not None, receipt.date or date.min, receipt.pk),
+                          reverse=True)
+        seen, cursor = [], None
+        while True:
+            page, cursor = receipt_page(self.user, cursor, page_size=2)
+            self.assertLessEqual(len(page), 2)
+            seen += page
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+        self.assertEqual([receipt.date for receipt in seen[-2:]], [None, None])
+
+
+def twilio_response(status_code, retry_after=None, sid='SM1'):
+    response = mock.Mock(status_code=status_code, text='error',
+                         headers={'Retry-After': retry_after} if retry_after else {})
+    response.json.return_value = {'sid': sid}
+    return response
+
+
+@override_settings(TWILIO_SEND_RATE=0, TWILIO_SEND_BURST=10, TWILIO_SEND_POOLS=1, TWILIO_SEND_MAX_ATTEMPTS=3,
+                   TWILIO_SEND_RETRY_DELAY=1, TWILIO_SEND_TIMEOUT=10, TWILIO_SENDER_THREADS=2)
+class NotifierTests(SimpleTestCase):
+    def setUp(self):
+        self.notifier = Notifier()
+        self.session = mock.Mock()
+        # Sender threads reset _session, so stub the accessor rather than the attribute
+        self.notifier.session = lambda: self.session
+        sleep = mock.patch('extractor.notifier.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_throttled_and_server_errors_are_retried(self):
+        self.session.post.side_effect = [twilio_response(429, retry_after='3'), twilio_response(503),
+                                                   twilio_response(201, sid='SM7')]
+        self.assertEqual(self.notifier.send('+15550000006', 'hi'), 'SM7')
+        # Retry-After when given, otherwise backoff doubling from TWILIO_SEND_RETRY_DELAY
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list], [3, 2])
+
+    def test_retry_after_is_capped(self):
+        self.assertEqual(retry_after(twilio_response(429, retry_after='86400'), 1), 30)
+        self.assertEqual(retry_after(twilio_response(429, retry_after='soon'), 3), 4)
+
+    def test_rejections_are_not_retried_and_failures_give_up(self):
+        self.session.post.return_value = twilio_response(400)
+        with self.assertRaises(NotificationFailed):
+            self.notifier.send('+15550000006', 'hi')
+        self.assertEqual(self.session.post.call_count, 1)
+
+        self.session.post.reset_mock()
+        self.session.post.return_value = twilio_response(500)
+        with self.assertRaises(NotificationFailed):
+            self.notifier.send('+15550000006', 'hi')
+        self.assertEqual(self.session.post.call_count, 3)
+
+    @override_settings(TWILIO_SEND_RATE=80, TWILIO_SEND_BURST=80, TWILIO_SEND_POOLS=2)
+    def test_rate_is_split_between_pools_and_workers(self):
+        self.notifier.split_rate(4)
+        self.assertEqual((self.notifier.bucket.rate, self.notifier.bucket.burst), (10, 10))
+
+    def test_notify_queues_for_the_sender_threads(self):
+        self.session.post.return_value = twilio_response(201, sid='SM9')
+        futures = [self.notifier.notify('+15550000006', f'message {index}') for index in range(5)]
+        self.assertTrue(self.notifier.flush(timeout=5))
+        self.assertEqual([future.result() for future in futures], ['SM9'] * 5)
+
+
+class DeduplicationTests(TestCase):
+    def setUp(self):
+        dedupe._last_purge = float('-inf')
+
+    def webhook(self, sid):
+        return self.client.post(reverse('process_whatsapp_receipt'),
+                                {'From': 'whatsapp:+15550000008', 'Body': 'total this month', 'MessageSid': sid})
+
+    def test_redelivered_webhook_queues_one_job(self):
+        first = self.webhook('SM1')
+        again = self.webhook('SM1')
+        self.webhook('SM2')
+        self.assertEqual(first.content, again.content)
+        self.assertEqual(list(ReceiptJob.objects.order_by('id').values_list('payload__message_sid', flat=True)),
+                         ['SM1', 'SM2'])
+
+    @override_settings(MESSAGE_DEDUPE_WINDOW=60)
+    def test_message_ids_are_forgotten_after_the_window(self):
+        self.assertTrue(dedupe.claim_message('SM1'))
+        self.assertFalse(dedupe.claim_message('SM1'))
+        InboundMessage.objects.update(created_at=timezone.now() - timedelta(seconds=120))
+        self.assertEqual(dedupe.purge_messages(force=True), 1)
+        self.assertTrue(dedupe.claim_message('SM1'))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_callers_during_a_flight_share_its_result(self):
+        flights, started, release = dedupe.SingleFlight(), threading.Event(), threading.Event()
+        calls = []
+
+        def extract():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'receipt'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.do('key', extract)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(flights.do('key', extract)))
+        follower.start()
+        time.sleep(0.05)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(sorted(results), [('receipt', False), ('receipt', True)])
+        self.assertEqual(len(calls), 1)
+        # The flight is over, so the next call runs again
+        self.assertEqual(flights.do('key', lambda: 'again'), ('again', False))
+
+    def test_errors_reach_the_caller(self):
+        flights = dedupe.SingleFlight()
+        with self.assertRaises(ValueError):
+            flights.do('key', lambda: int('x'))
+        self.assertEqual(flights.do('key', lambda: 1), (1, False))
+
+    def test_async_callers_share_one_task(self):
+        flights = dedupe.AsyncSingleFlight()
+        calls = []
+
+        async def extract():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'receipt'
+
+        async def main():
+            return await asyncio.gather(flights.do('key', extract), flights.do('key', extract))
+
+        self.assertEqual(asyncio.run(main()), [('receipt', False), ('receipt', True)])
+        self.assertEqual(len(calls), 1)
+
+
+def temporary_upload(name, mime_type, content=b'receipt'):
+    return to_temporary_upload(SimpleUploadedFile(name, content, content_type=mime_type))
+
+
+class BulkReceiptJobTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        vendor_index.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        storage = override_settings(MEDIA_ROOT=media_root)
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.media_root = media_root
+        self.user = CustomUser.objects.create_user('+15550000009')
+
+    def extracted(self, path, mime_type):
+        with open(path, 'rb') as file:
+            content = file.read()
+        if content == b'unreadable':
+            return None
+        return {'date': '05-01-2026', 'vendor': 'Cafe', 'total_amount': len(content)}
+
+    def staged_files(self):
+        staging = os.path.join(self.media_root, STAGING_DIR)
+        return sorted(os.listdir(staging)) if os.path.isdir(staging) else []
+
+    def test_upload_is_queued_and_reported_by_the_job(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('bulk_receipt_upload'), {'files': [
+            SimpleUploadedFile('a.png', b'receipt', content_type='image/png'),
+            SimpleUploadedFile('notes.txt', b'hello', content_type='text/plain'),
+            SimpleUploadedFile('b.png', b'unreadable', content_type='image/png'),
+        ]})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((response.json()['files'], response.json()['skipped']), (2, ['notes.txt']))
+        self.assertEqual(len(self.staged_files()), 2)
+        self.assertEqual(Receipt.objects.count(), 0)
+
+        status_url = response.json()['status_url']
+        self.assertEqual(self.client.get(status_url).json()['status'], ReceiptJob.STATUS_QUEUED)
+        with mock.patch('extractor.utils.process_receipt', side_effect=self.extracted):
+            jobs.run_job(jobs.claim_next())
+
+        body = self.client.get(status_url).json()
+        self.assertEqual(body['status'], ReceiptJob.STATUS_DONE)
+        self.assertEqual({key: body['result'][key] for key in ('created', 'failed', 'skipped')},
+                         {'created': 1, 'failed': ['b.png'], 'skipped': ['notes.txt']})
+        self.assertEqual(body['result']['receipts'][0]['total_amount'], '7')
+        self.assertEqual(self.staged_files(), [])
+
+    def test_other_users_jobs_are_not_found(self):
+        job = ReceiptJob.objects.create(kind=ReceiptJob.KIND_RECEIPT_BATCH, user=self.user, payload={'files': []})
+        self.client.force_login(CustomUser.objects.create_user('+15550000010'))
+        self.assertEqual(self.client.get(reverse('bulk_receipt_job', args=[job.pk])).status_code, 404)
+
+    def test_whatsapp_batch_reports_files_by_the_position_they_were_sent_in(self):
+        def download(media_url, mime_type, filename):
+            if media_url.endswith('big'):
+                raise MediaTooLarge(media_url)
+            return temporary_upload(filename, mime_type, b'unreadable' if media_url.endswith('bad') else b'receipt')
+
+        media = [{'media_url': f'https://api.twilio.com/Media/{name}', 'mime_type': mime_type}
+                 for name, mime_type in (('ME1', 'image/png'), ('ME2', 'text/vcard'), ('ME3big', 'image/png'),
+                                         ('ME4bad', 'image/jpeg'), ('ME5', 'application/pdf'))]
+        job = ReceiptJob.objects.create(kind=ReceiptJob.KIND_RECEIPT_BATCH, user=self.user,
+                                        payload={'user_phone': self.user.phone_number, 'media': media})
+        with mock.patch('extractor.tasks.download_media', side_effect=download), \
+                mock.patch('extractor.utils.process_receipt', side_effect=self.extracted), \
+                mock.patch('extractor.tasks.send_whatsapp') as send:
+            process_receipt_batch_job(job)
+
+        message = send.call_args.args[1]
+        self.assertIn("2 saved, 2 failed", message)
+        self.assertIn("Could not read: file 3, file 4", message)
+        self.assertIn("Skipped (not an image or PDF, or over the limit): file 2", message)
+
+
+class PurgeDoneTests(TestCase):
+    def setUp(self):
+        jobs._last_purge = float('-inf')
+        self.user = CustomUser.objects.create_user('+15550000001')
+
+    @override_settings(RECEIPT_JOB_RETENTION=3600)
+    def test_only_old_done_jobs_are_deleted(self):
+        old = timezone.now() - timedelta(hours=2)
+        kept = [
+            ReceiptJob.objects.create(kind=ReceiptJob.KIND_QUERY, user=self.user, status=ReceiptJob.STATUS_DONE),
+            ReceiptJob.objects.create(kind=ReceiptJob.KIND_QUERY, user=self.user, status=ReceiptJob.STATUS_FAILED),
+        ]
+        purged = ReceiptJob.objects.create(kind=ReceiptJob.KIND_QUERY, user=self.user, status=ReceiptJob.STATUS_DONE)
+        ReceiptJob.objects.filter(pk__in=[kept[1].pk, purged.pk]).update(updated_at=old)
+
+        self.assertEqual(jobs.purge_done(), 1)
+        self.assertQuerysetEqual(ReceiptJob.objects.order_by('pk'), kept)
+        # At most once per PURGE_INTERVAL
+        self.assertEqual(jobs.purge_done(), 0)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   DASHBOARD_CACHE='default', QUERY_FRAME_CACHE_SIZE=8)
+class ReceiptFrameTests(TransactionTestCase):
+    def setUp(self):
+        receipt_frames.clear()
+        # Vendor ids cached by an earlier test point at rows that were flushed
+        vendor_index.clear()
+        self.user = CustomUser.objects.create_user('+15550000002')
+        Receipt.objects.create(user=self.user, file='a.png', date=date(2026, 1, 5), vendor='Cafe', total_amount=4)
+
+    def test_new_receipts_are_appended(self):
+        self.assertEqual(len(receipt_frames.get(self.user.pk)), 1)
+        loads = receipt_frames.stats['loads']
+        Receipt.objects.create(user=self.user, file='b.png', date=date(2026, 1, 6), vendor='Cafe', total_amount=6)
+        self.assertEqual(receipt_frames.get(self.user.pk)['total_amount'].sum(), 10)
+        self.assertEqual(receipt_frames.stats['loads'], loads)
+
+    def test_changes_without_signals_reload_after_a_bump(self):
+        receipt_frames.get(self.user.pk)
+        # What another process, or backfill_vendors' update(), does
+        Receipt.objects.filter(user=self.user).update(total_amount=9)
+        dashboard.bump(self.user.pk)
+        self.assertEqual(receipt_frames.get(self.user.pk)['total_amount'].sum(), 9)
+
+    def test_append_skips_rows_the_load_already_has(self):
+        receipt = Receipt.objects.create(user=self.user, file='b.png', date=date(2026, 1, 6), vendor='Cafe',
+                                         total_amount=6)
+        # The load ran after the commit but before the signal's append
+        receipt_frames.invalidate(self.user.pk)
+        self.assertEqual(len(receipt_frames.get(self.user.pk)), 2)
+        loads = receipt_frames.stats['loads']
+        receipt_frames.append(receipt, dashboard.bump(self.user.pk))
+        self.assertEqual(len(receipt_frames.get(self.user.pk)), 2)
+        self.assertEqual(receipt_frames.stats['loads'], loads)
+
+    def test_a_concurrent_change_drops_the_entry(self):
+        receipt_frames.get(self.user.pk)
+        # Another process changes a receipt between this entry's read and the next local bump
+        Receipt.objects.filter(user=self.user).update(total_amount=9)
+        dashboard.bump(self.user.pk)
+        Receipt.objects.create(user=self.user, file='b.png', date=date(2026, 1, 6), vendor='Cafe', total_amount=6)
+        self.assertNotIn(self.user.pk, receipt_frames._entries)
+        self.assertEqual(receipt_frames.get(self.user.pk)['total_amount'].sum(), 15)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   DASHBOARD_CACHE='default')
+class DashboardCacheTests(TestCase):
+    def setUp(self):
+        vendor_index.clear()
+        dashboard.cache().clear()
+        self.user = CustomUser.objects.create_user('+15550000007')
+        self.client.force_login(self.user)
+
+    def add_receipt(self, amount):
+        with self.captureOnCommitCallbacks(execute=True):
+            Receipt.objects.create(user=self.user, file='r.png', date=date(2026, 1, 5), vendor='Cafe Nero',
+                                   total_amount=amount)
+
+    def test_unchanged_dashboard_is_not_modified(self):
+        self.add_receipt(4)
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, 'Cafe Nero')
+        etag = response['ETag']
+
+        response = self.client.get(reverse('index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.add_receipt(6)
+        response = self.client.get(reverse('index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, '10.0')
+
+    def test_rendered_page_is_reused_until_a_change(self):
+        self.client.get(reverse('index'))
+        with self.assertNumQueries(1):
+            # Only the session's user lookup; the page comes from the cache
+            self.client.get(reverse('index'))
+
+    def test_chart_etag_depends_on_the_query(self):
+        self.add_receipt(4)
+        day = self.client.get(reverse('chart_data'), {'granularity': 'day'})
+        month = self.client.get(reverse('chart_data'), {'granularity': 'month'})
+        self.assertNotEqual(day['ETag'], month['ETag'])
+        response = self.client.get(reverse('chart_data'), {'granularity': 'day'}, HTTP_IF_NONE_MATCH=day['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class VendorMatchingTests(TestCase):
+    def setUp(self):
+        vendor_index.clear()
+
+    def assertDistinct(self, *names):
+        vendor_ids = [vendor_index.resolve(name) for name in names]
+        self.assertEqual(len(set(vendor_ids)), len(names), names)
+
+    def test_names_containing_another_vendor_stay_separate(self):
+        self.assertDistinct("Pizza", "Pizza Hut", "Pizza Express")
+        self.assertDistinct("Cafe", "Cafe Nero", "Cafe Rio")
+        self.assertDistinct("Bank", "Bank of America")
+        self.assertDistinct("Shell", "Shell Beach Cafe")
+
+    def test_variants_of_one_vendor_match(self):
+        vendor_id = vendor_index.resolve("STARBUCKS #123")
+        self.assertEqual(vendor_index.resolve("Starbucks"), vendor_id)
+        self.assertEqual(vendor_index.resolve("Starbuck"), vendor_id)
+        self.assertEqual(vendor_index.resolve("Starbucks Inc."), vendor_id)
+
+    def test_fuzzy_aliases_do_not_chain(self):
+        for reload in (False, True):
+            with self.subTest(reload=reload):
+                vendor_id = vendor_index.resolve("Starbucks")
+                self.assertEqual(vendor_index.resolve("Starbuck"), vendor_id)
+                if reload:
+                    vendor_index.clear()
+                # Close to the alias "starbuck" but not to the vendor's own name
+                self.assertNotEqual(vendor_index.resolve("Starbuk"), vendor_id)
+                Vendor.objects.filter(name='Starbuk').delete()
+                vendor_index.clear()
+
+    def test_vendors_created_by_another_process_are_matched(self):
+        self.assertDistinct("Cafe Nero", "Starbucks")
+        # Rows this index never saw, as another worker process would have written them
+        vendor = Vendor.objects.create(name="The Dunkin Donuts")
+        VendorAlias.objects.create(vendor=vendor, alias='dunkin donuts')
+        self.assertEqual(vendor_index.resolve("Dunkin Donut"), vendor.pk)
+        self.assertEqual(vendor_index.resolve("DUNKIN' DONUTS #12"), vendor.pk)
+
+
+class DownsamplingTests(SimpleTestCase):
+    def test_lttb_never_returns_more_than_max_points(self):
+        xs = list(range(1500))
+        ys = [x % 7 for x in xs]
+        for max_points in (-1, 0, 1, 2, 3, 365):
+            with self.subTest(max_points=max_points):
+                kept = lttb(xs, ys, max_points)
+                self.assertEqual(len(kept), max(max_points, 0))
+                self.assertEqual(kept, sorted(set(kept)))
+        self.assertEqual(lttb(xs, ys, 2), [0, 1499])
+
+
+@override_settings(EXTRACTION_REQUIRED_FIELDS=['date', 'vendor', 'total_amount'])
+class CascadeTests(SimpleTestCase):
+    GOOD = '{"date": "05-01-2026", "vendor": "Cafe", "total_amount": 4.5}'
+
+    def invoker(self, answers):
+        calls = []
+
+        def invoke(model_name, messages):
+            calls.append(model_name)
+            answer = answers[model_name]
+            if isinstance(answer, Exception):
+                raise answer
+            return mock.Mock(content=answer)
+        return invoke, calls
+
+    def test_valid_answer_stops_at_the_fast_tier(self):
+        invoke, calls = self.invoker({'fast': self.GOOD, 'slow': self.GOOD})
+        result, problems = extract(['fast', 'slow'], 'receipt', invoke)
+        self.assertEqual((result['vendor'], problems, calls), ('Cafe', [], ['fast']))
+
+    def test_missing_fields_and_errors_escalate(self):
+        invoke, calls = self.invoker({'fast': '{"vendor": "Cafe"}', 'mid': ValueError('quota'), 'slow': self.GOOD})
+        result, problems = extract(['fast', 'mid', 'slow'], 'receipt', invoke)
+        self.assertEqual((problems, calls), ([], ['fast', 'mid', 'slow']))
+
+    def test_best_answer_is_kept_when_every_tier_has_problems(self):
+        invoke, calls = self.invoker({'fast': '{"vendor": "Cafe", "total_amount": 3}', 'slow': 'not json'})
+        result, problems = extract(['fast', 'slow'], 'receipt', invoke)
+        self.assertEqual((result, problems), ({'vendor': 'Cafe', 'total_amount': 3}, ['missing date']))
+
+    def test_invalid_values_are_problems(self):
+        self.assertEqual(extraction_problems({'date': 'yesterday', 'vendor': 'Cafe', 'total_amount': 'four'}),
+                         ['invalid date', 'invalid total_amount'])
+        self.assertEqual(extraction_problems(['Cafe']), ['not a JSON object'])
+
+    def test_all_errors_raise_the_last(self):
+        invoke, _ = self.invoker({'fast': ValueError('one'), 'slow': ValueError('two')})
+        with self.assertRaisesMessage(ValueError, 'two'):
+            extract(['fast', 'slow'], 'receipt', invoke)
+
+    def test_async_cascade_escalates_too(self):
+        invoke, calls = self.invoker({'fast': '{}', 'slow': self.GOOD})
+
+        async def ainvoke(model_name, messages):
+            return invoke(model_name, messages)
+
+        result, problems = asyncio.run(aextract(['fast', 'slow'], 'receipt', ainvoke))
+        self.assertEqual((problems, calls), ([], ['fast', 'slow']))
+
+
+class SplitBatchTests(SimpleTestCase):
+    def test_entries_are_put_back_in_receipt_order(self):
+        content = '[{"receipt": 2, "vendor": "B"}, {"receipt": 1, "vendor": "A"}]'
+        self.assertEqual(split_batch(content, 2), [{'vendor': 'A'}, {'vendor': 'B'}])
+
+    def test_answers_that_dont_number_every_receipt_are_rejected(self):
+        for content in ('[{"vendor": "A"}, {"vendor": "B"}]',
+                        '[{"receipt": 1, "vendor": "A"}, {"receipt": 1, "vendor": "B"}]',
+                        '[{"receipt": 1, "vendor": "A"}, {"receipt": 3, "vendor": "B"}]',
+                        '[{"receipt": 1, "vendor": "A"}]'):
+            with self.subTest(content=content):
+                with self.assertRaises(ValueError):
+                    split_batch(content, 2)
+
+
+def run_in_sandbox(results):
+    import pandas as pd
+
+    with sandbox.Session(pd.DataFrame({'total_amount': [4.0, 6.0]})) as session:
+        results.put(session.run("df['total_amount'].sum()"))
+
+
+@override_settings(QUERY_SANDBOX_WORKERS=1, QUERY_SANDBOX_TIMEOUT=30)
+class SandboxTests(SimpleTestCase):
+    def test_runs_inside_a_process_mode_job_worker(self):
+        # Started the way run_pool starts process-mode workers, which start sandbox workers of their own
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        process = jobs.worker_process(ctx, run_in_sandbox, (results,))
+        process.start()
+        try:
+            self.assertEqual(results.get(timeout=60), '10.0')
+        finally:
+            process.join(60)
+        self.assertEqual(process.exitcode, 0)
+
+    def test_worker_that_cannot_start_leaves_no_shared_block(self):
+        import pandas as pd
+
+        session = sandbox.Session(pd.DataFrame({'total_amount': [4.0]}))
+        with mock.patch.object(sandbox.pool, 'checkout', side_effect=AssertionError('no children')):
+            self.assertEqual(session.run("df.sum()"), sandbox.UNAVAILABLE_MESSAGE)
+        self.assertIsNone(session.shared)
+        session.close()
+
+
+def render_pdf(results, file_path):
+    from . import pdf
+
+    content, mime_type = pdf.load_pdf(file_path, max_pages=5, dpi=30, min_text_chars=10, workers=2)
+    results.put((mime_type, [page[:8] for page in content], pdf._pool is not None))
+    pdf.shutdown()
+
+
+class ScannedPdfTests(SimpleTestCase):
+    def setUp(self):
+        import tempfile
+
+        import fitz
+
+        handle, self.file_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(handle)
+        self.addCleanup(os.remove, self.file_path)
+        with fitz.open() as document:
+            for _ in range(2):
+                # A page with a drawing and no text layer, like a scan
+                document.new_page().draw_rect(fitz.Rect(20, 20, 120, 120), fill=(0, 0, 0))
+            document.save(self.file_path)
+
+    def render_in_worker(self, daemon):
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        process = jobs.worker_process(ctx, render_pdf, (results, self.file_path))
+        process.daemon = daemon
+        process.start()
+        try:
+            return results.get(timeout=60)
+        finally:
+            process.join(60)
+
+    def test_pages_render_on_the_pool_in_a_process_mode_job_worker(self):
+        self.assertEqual(self.render_in_worker(daemon=False), ('image/png', [b'\x89PNG\r\n\x1a\n'] * 2, True))
+
+    def test_daemonic_processes_render_in_process(self):
+        self.assertEqual(self.render_in_worker(daemon=True), ('image/png', [b'\x89PNG\r\n\x1a\n'] * 2, False))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.breaker = resilience.CircuitBreaker('test-model', failures=2, reset=0.05)
+
+    def open(self):
+        self.breaker.failure()
+        self.breaker.before_call()
+        self.breaker.failure()
+        with self.assertRaises(resilience.CircuitOpen):
+            self.breaker.before_call()
+
+    def test_opens_after_consecutive_failures(self):
+        self.open()
+
+    def test_success_resets_the_failure_count(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.breaker.before_call()
+
+    def test_half_open_trial_success_closes(self):
+        self.open()
+        time.sleep(0.06)
+        self.breaker.before_call()
+        # Only one trial call at a time
+        with self.assertRaises(resilience.CircuitOpen):
+            self.breaker.before_call()
+        self.breaker.success()
+        self.breaker.before_call()
+        self.breaker.before_call()
+
+    def test_half_open_trial_failure_reopens(self):
+        self.open()
+        time.sleep(0.06)
+        self.breaker.before_call()
+        self.breaker.failure()
+        with self.assertRaises(resilience.CircuitOpen):
+            self.breaker.before_call()
+
+
+@override_settings(GEMINI_HEDGE=True, GEMINI_HEDGE_MIN_SAMPLES=5, GEMINI_BREAKER_FAILURES=2,
+                   GEMINI_BREAKER_RESET=60, GEMINI_MAX_CONCURRENCY=8)
+class ResilientCallTests(SimpleTestCase):
+    def setUp(self):
+        # Breakers and latency samples are per model name, so each test gets its own
+        self.model = f"test-{self.id()}"
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def seed_latency(self, seconds):
+        for _ in range(5):
+            resilience.record_latency(self.model, seconds)
+
+    def test_deadline_raises_call_timeout_and_opens_the_circuit(self):
+        for _ in range(2):
+            with self.assertRaises(resilience.CallTimeout):
+                resilience.call(self.model, self.release.wait, 5, timeout=0.05, hedge=False)
+        with self.assertRaises(resilience.CircuitOpen):
+            resilience.call(self.model, lambda: 'ok')
+
+    def test_provider_errors_count_as_failures(self):
+        def fail():
+            raise ConnectionError("reset by peer")
+
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                resilience.call(self.model, fail)
+        with self.assertRaises(resilience.CircuitOpen):
+            resilience.call(self.model, lambda: 'ok')
+
+    def test_slow_call_is_hedged_and_the_first_answer_wins(self):
+        self.seed_latency(0.01)
+        calls = []
+
+        def answer():
+            calls.append(None)
+            if len(calls) == 1:
+                self.release.wait(5)
+                return 'primary'
+            return 'hedge'
+
+        self.assertEqual(resilience.call(self.model, answer, timeout=2), 'hedge')
+        self.assertEqual(len(calls), 2)
+
+    def test_no_hedge_before_enough_samples(self):
+        calls = []
+
+        def answer():
+            calls.append(None)
+            time.sleep(0.05)
+            return 'primary'
+
+        self.assertEqual(resilience.call(self.model, answer, timeout=2), 'primary')
+        self.assertEqual(len(calls), 1)
+
+    def test_async_hedge_cancels_the_loser(self):
+        self.seed_latency(0.01)
+        cancelled = []
+
+        async def answer(number):
+            try:
+                await asyncio.sleep(5 if number() == 1 else 0)
+            except asyncio.CancelledError:
+                cancelled.append(None)
+                raise
+            return 'answer'
+
+        counter = iter(range(1, 10))
+        result = asyncio.run(resilience.acall(self.model, answer, lambda: next(counter), timeout=2))
+        self.assertEqual(result, 'answer')
+        self.assertEqual(len(cancelled), 1)
@@ -1,12 +1,17 @@
 from django.urls import path
 
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('api/receipts/', views.receipt_list, name='receipt_list'),
+    path('api/receipts/bulk/', api.BulkReceiptUploadView.as_view(), name='bulk_receipt_upload'),
+    path('api/receipts/bulk/<int:job_id>/', api.BulkReceiptJobView.as_view(), name='bulk_receipt_job'),
+    path('api/chart/', views.chart_data, name='chart_data'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('register/', views.register_user, name='register'),
     path('verify_otp/', views.verify_otp, name='verify_otp'),
     path('process_whatsapp_receipt/', views.process_whatsapp_receipt, name='process_whatsapp_receipt'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
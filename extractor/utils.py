@@ -1,20 +1,23 @@
 import base64
+import logging
 import os
-import io
 
-import fitz
 import pandas as pd
-from PIL import Image
 
-from langchain.agents import initialize_agent, AgentType
-from langchain.prompts import PromptTemplate
+from django.conf import settings
 from langchain.schema import HumanMessage
-from langchain_core.output_parsers import JsonOutputParser
-from langchain_experimental.tools.python.tool import PythonAstREPLTool
-from langchain_google_genai import ChatGoogleGenerativeAI
 
-from .models import Receipt
+from . import microbatch, resilience, sandbox
+from .cache import content_hash, extraction_cache
+from .frames import receipt_frames
+from .llm import (BATCH_RECEIPT_PROMPT, QUERY_PROMPT, RECEIPT_PROMPT, discard_query_agent,
+                  get_query_agent, invoke_chat)
+from .metrics import span
+from .pdf import load_pdf
+from .preprocess import prepare_image
+from .queries import answer_query
 
+logger = logging.getLogger(__name__)
 
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 if not GEMINI_API_KEY:
@@ -29,14 +32,12 @@ def load_document(file_path, mime_type=None):
             content = f.read()
 
     elif mime_type == 'application/pdf':
-        pdf_document = fitz.open(file_path)
-        first_page = pdf_document.load_page(0)
-        pix = first_page.get_pixmap()
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        content = img_byte_arr.getvalue()
-        mime_type = 'image/png'
+        # Text pages come back as str, scanned pages as PNG bytes
+        content, mime_type = load_pdf(file_path,
+                                      max_pages=settings.PDF_MAX_PAGES,
+                                      dpi=settings.PDF_RENDER_DPI,
+                                      min_text_chars=settings.PDF_MIN_TEXT_CHARS,
+                                      workers=settings.PDF_RENDER_WORKERS)
 
     elif mime_type.startswith('text/'):
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -47,89 +48,108 @@ def load_document(file_path, mime_type=None):
     return content, mime_type
 
 
-def process_receipt(file_path, mime_type=None):
-    try:
-        content, mime_type = load_document(file_path, mime_type)
-        llm = ChatGoogleGenerativeAI(model="gemini-pro-vision" if mime_type.startswith('image/') else "gemini-pro", 
-                                     google_api_key=GEMINI_API_KEY)
+def receipt_request(content, mime_type):
+    """Return the model cascade, the parts describing ``content`` and the message used to extract it."""
+    if mime_type.startswith('image/'):
+        parts = []
+        for page in (content if isinstance(content, list) else [content]):
+            if isinstance(page, str):
+                parts.append({"type": "text", "text": page})
+            else:
+                image, image_mime_type = prepare_image(page, mime_type)
+                base64_image = base64.b64encode(image).decode('utf-8')
+                parts.append({"type": "image_url", "image_url": f"data:{image_mime_type};base64,{base64_image}"})
+        message = HumanMessage(content=[{"type": "text", "text": RECEIPT_PROMPT.format(content="")}] + parts)
+        return settings.EXTRACTION_VISION_MODELS, parts, message
 
-    
-        template = """You are a receipt processing expert. Please extract the following information from the receipt content and provide the output in JSON format:
-        
-            "date": "date on the receipt",
-            "vendor": "vendor or store name",
-            "total_amount": "total amount"
-        
-            return Date in the format DD-MM-YYYY, Vendor/Store Name as a string, and Total Amount as a number.
-            Always return a single valid JSON object.
-            Receipt Content:{content}
-        """
-        prompt = PromptTemplate(input_variables=["content"], template=template)
+    parts = [{"type": "text", "text": content}]
+    return settings.EXTRACTION_TEXT_MODELS, parts, HumanMessage(content=RECEIPT_PROMPT.format(content=content))
+
+
+def extractor_version(mime_type):
+    """The model cascade and prompts a result of ``mime_type`` comes from; part of its cache key."""
+    models = settings.EXTRACTION_VISION_MODELS if mime_type.startswith('image/') else settings.EXTRACTION_TEXT_MODELS
+    return '\0'.join([*models, RECEIPT_PROMPT.template, BATCH_RECEIPT_PROMPT.template])
 
-    
-        if mime_type.startswith('image/'):
-            base64_image = base64.b64encode(content).decode('utf-8')
-            message = HumanMessage(
-                content=[
-                    {"type": "text", "text": prompt.format(content="")},
-                    {"type": "image_url", "image_url": f"data:{mime_type};base64,{base64_image}"}
-                ]
-            )
-        else:
-            message = HumanMessage(content=prompt.format(content=content))
-
-        response = llm.invoke([message])
-        parser = JsonOutputParser()
-    
-        return parser.parse(response.content)
 
+def content_size(content):
+    parts = content if isinstance(content, list) else [content]
+    return sum(len(part) for part in parts)
+
+
+def process_receipt(file_path, mime_type=None):
+    try:
+        with span('load_document', mime_type=mime_type) as fields:
+            content, mime_type = load_document(file_path, mime_type)
+            fields['bytes'] = content_size(content)
+
+        # Forwarded duplicates of a receipt are answered from the cache without a model call
+        with span('cache_lookup') as fields:
+            cache_key = content_hash(content, mime_type, extractor_version(mime_type))
+            cached = extraction_cache.get(cache_key)
+            fields['hit'] = cached is not None
+        if cached is not None:
+            return cached
+
+        models, parts, message = receipt_request(content, mime_type)
+        # The first model call may be shared with other receipts being extracted at the same time
+        result, problems = microbatch.extract(models, parts, message, invoke_chat)
+        # Results that still fail validation are not cached, so a resend gets another try
+        if not problems:
+            extraction_cache.set(cache_key, result)
+        return result
+
+    except resilience.Unavailable:
+        # Retried by the job queue once the model is reachable again
+        raise
     except Exception as e:
-        print(f"An error occurred: {str(e)}")
+        logger.error("Error extracting receipt: %s", e)
         return {}
 
 
+QUERY_ERROR_MESSAGE = f"I encountered an error while processing your query. Here are some tips:\n" \
+                      f"1. Try rephrasing your question.\n" \
+                      f"2. Make sure you're asking about receipt data (date, vendor, total amount).\n" \
+                      f"3. If you're looking for specific calculations, be clear about what you need.\n\n"
+
+
+def receipt_frame(user):
+    return receipt_frames.get(user.pk)
+
 
 def process_receipt_query(user, query):
 
-    llm = ChatGoogleGenerativeAI(model="gemini-pro", google_api_key=GEMINI_API_KEY)
-    user_receipts = Receipt.objects.filter(user=user)
-    df = pd.DataFrame(list(user_receipts.values('date', 'vendor', 'total_amount')))
-    python_tool = PythonAstREPLTool(locals={"df": df, "pd": pd})
-
-    agent = initialize_agent(
-        [python_tool],
-        llm,
-        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-        verbose=True
-    )
-
-    prompt_template = PromptTemplate(
-        input_variables=["query"],
-        template="""
-        You are an AI assistant analyzing receipt data for a user. The data is in a pandas DataFrame named 'df' with columns: date, vendor, and total_amount.
-
-        User query: {query}
-
-        To answer this query:
-        1. Analyze the 'df' DataFrame using pandas operations.
-        2. Provide a detailed response based on your analysis.
-        3. If needed, perform calculations, find patterns, or create summaries.
-        4. Present the results in a clear, user-friendly format.
-
-        Remember to use pandas functions like df.groupby(), df.sum(), df.mean(), etc., as needed.
-        """
-    )
+    # Common questions are answered straight from database aggregates without an LLM call
+    if settings.QUERY_FAST_PATH_ENABLED:
+        with span('query_fast_path') as fields:
+            answer = answer_query(user, query)
+            fields['hit'] = answer is not None
+        if answer is not None:
+            return answer
+
+    df = receipt_frame(user)
+    agent, python_tool = get_query_agent()
+    python_tool.globals = {}
+    python_tool.locals = {"df": df, "pd": pd}
+    # The model's code runs in a sandbox worker process rather than in this one
+    session = python_tool.sandbox = sandbox.Session(df) if settings.QUERY_SANDBOX_ENABLED else None
+
     try:
     
-        result = agent.invoke(prompt_template.format(query=query))
-        # print(result)
+        with span('query_agent'):
+            # Agents keep REPL state, so a run is never hedged
+            result = resilience.call(settings.GEMINI_TEXT_MODEL, agent.invoke, QUERY_PROMPT.format(query=query),
+                                     timeout=settings.GEMINI_AGENT_TIMEOUT, hedge=False)
         response_content = result.get('output', '')
         return response_content
     
+    except resilience.Unavailable:
+        # The abandoned run may still be using the REPL tool
+        discard_query_agent()
+        raise
     except Exception as e:
-        error_message = f"I encountered an error while processing your query. Here are some tips:\n" \
-                        f"1. Try rephrasing your question.\n" \
-                        f"2. Make sure you're asking about receipt data (date, vendor, total amount).\n" \
-                        f"3. If you're looking for specific calculations, be clear about what you need.\n\n" 
-        print(f"Error details: {str(e)}")
-        return error_message
+        logger.error("Error answering query: %s", e)
+        return QUERY_ERROR_MESSAGE
+    finally:
+        if session is not None:
+            session.close()
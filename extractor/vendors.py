@@ -0,0 +1,177 @@
+"""
+Vendor name normalization and matching.
+
+Raw names from the model are normalized (case, accents, punctuation, store
+numbers, legal suffixes) to an alias key, so "STARBUCKS #123" and "Starbucks"
+share the key "starbucks". A key seen before maps straight to its vendor; a
+new key is fuzzy-matched with rapidfuzz only against the vendors' own names
+in the same block (the first letters of the first token), so a lookup
+compares a handful of names instead of every vendor. Aliases recorded from
+fuzzy hits are never matched against, so one close name can't pull in the
+next ("starbuck" -> "starbuk" -> ...). The score is ``token_sort_ratio``, not
+``token_set_ratio``, so "Pizza" and "Pizza Hut" stay different vendors.
+A name with no match in memory reloads its block from the database and is
+scored again, so vendors created by other processes since the index was
+loaded are found. Names still unmatched create a new vendor.
+"""
+import logging
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from rapidfuzz import fuzz, process
+
+from .models import Vendor, VendorAlias
+
+logger = logging.getLogger(__name__)
+
+STORE_NUMBER_RE = re.compile(r'#\s*\d+|\b(?:store|no|unit|branch)\.?\s*\d+\b')
+NOISE_WORDS = {'the', 'inc', 'llc', 'ltd', 'limited', 'co', 'corp', 'corporation', 'company', 'plc', 'gmbh'}
+
+
+def normalize(name):
+    text = unicodedata.normalize('NFKD', name or '').encode('ascii', 'ignore').decode('ascii').lower()
+    text = STORE_NUMBER_RE.sub(' ', text.replace('&', ' and '))
+    text = re.sub(r"(?<=\w)-(?=\w)|['`]", '', text)
+    tokens = [token for token in re.sub(r'[^a-z0-9]+', ' ', text).split() if token not in NOISE_WORDS]
+    while len(tokens) > 1 and tokens[-1].isdigit():
+        tokens.pop()
+    return ' '.join(tokens)
+
+
+def display_name(name):
+    return ' '.join(STORE_NUMBER_RE.sub(' ', name).split()).strip(' -,.') or name.strip()
+
+
+def block_key(key):
+    return key.split(' ', 1)[0][:settings.VENDOR_BLOCK_PREFIX]
+
+
+class VendorIndex:
+    """In-process view of the alias table, grouped into blocks for fuzzy matching."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._aliases = None
+        self._blocks = defaultdict(dict)
+        self._names = {}
+
+    def _ensure_loaded(self):
+        if self._aliases is not None:
+            return
+        self._aliases = {}
+        for vendor_id, name in Vendor.objects.values_list('id', 'name').iterator():
+            self._remember(normalize(name), vendor_id, name)
+        for alias, vendor_id in VendorAlias.objects.values_list('alias', 'vendor_id').iterator():
+            self._aliases[alias] = vendor_id
+
+    def _remember(self, key, vendor_id, name=None):
+        """Record an exact alias; with ``name``, also the vendor's own key that fuzzy matches compare to."""
+        self._aliases[key] = vendor_id
+        if name is not None:
+            self._names[vendor_id] = name
+            if key:
+                self._blocks[block_key(key)][key] = vendor_id
+
+    def _refresh_block(self, block):
+        """Load the vendors and aliases in ``block`` that other processes may have added."""
+        vendors = list(Vendor.objects
+                       .filter(Q(name__istartswith=block) | Q(aliases__alias__startswith=block))
+                       .distinct()
+                       .values_list('id', 'name'))
+        aliases = list(VendorAlias.objects.filter(alias__startswith=block).values_list('alias', 'vendor_id'))
+        with self._lock:
+            self._ensure_loaded()
+            for vendor_id, name in vendors:
+                key = normalize(name)
+                if block_key(key) == block:
+                    self._remember(key, vendor_id, name)
+            self._aliases.update(aliases)
+
+    def _lookup(self, key):
+        vendor_id = self._aliases.get(key)
+        if vendor_id is not None:
+            return vendor_id
+        candidates = self._blocks.get(block_key(key))
+        if not candidates:
+            return None
+        best = process.extractOne(key, list(candidates), scorer=fuzz.token_sort_ratio,
+                                  score_cutoff=settings.VENDOR_MATCH_THRESHOLD)
+        return candidates[best[0]] if best else None
+
+    def match(self, name):
+        """Return ``(vendor_id, key)``; ``vendor_id`` is None when nothing is close enough."""
+        key = normalize(name)
+        if not key:
+            return None, key
+
+        with self._lock:
+            self._ensure_loaded()
+            vendor_id = self._lookup(key)
+        if vendor_id is None:
+            self._refresh_block(block_key(key))
+            with self._lock:
+                vendor_id = self._lookup(key)
+        return vendor_id, key
+
+    def resolve(self, name):
+        """Return the vendor id for ``name``, recording a new alias or creating the vendor as needed."""
+        vendor_id, key = self.match(name)
+        if not key:
+            return None
+
+        if vendor_id is None:
+            try:
+                with transaction.atomic():
+                    vendor = Vendor.objects.create(name=display_name(name))
+                    VendorAlias.objects.create(vendor=vendor, alias=key)
+                vendor_id = vendor.pk
+                with self._lock:
+                    self._remember(key, vendor_id, vendor.name)
+                return vendor_id
+            except IntegrityError:
+                vendor_id = VendorAlias.objects.get(alias=key).vendor_id
+
+        with self._lock:
+            known = self._aliases.get(key) == vendor_id
+        if not known:
+            try:
+                with transaction.atomic():
+                    VendorAlias.objects.get_or_create(alias=key, defaults={'vendor_id': vendor_id})
+            except IntegrityError:
+                pass
+            with self._lock:
+                self._remember(key, vendor_id)
+        return vendor_id
+
+    def name(self, vendor_id):
+        with self._lock:
+            name = self._names.get(vendor_id)
+        if name is None:
+            name = Vendor.objects.filter(pk=vendor_id).values_list('name', flat=True).first()
+            with self._lock:
+                self._names[vendor_id] = name
+        return name
+
+    def clear(self):
+        with self._lock:
+            self._aliases = None
+            self._blocks = defaultdict(dict)
+            self._names = {}
+
+
+vendor_index = VendorIndex()
+
+
+def assign_vendor(receipt):
+    """Point ``receipt.vendor_ref`` at the canonical vendor for ``receipt.vendor``."""
+    try:
+        receipt.vendor_ref_id = vendor_index.resolve(receipt.vendor) if receipt.vendor else None
+    except Exception as e:
+        # Matching must never block saving the receipt; backfill_vendors can fill it in later
+        logger.warning("Vendor matching failed for %r: %s", receipt.vendor, e)
+        receipt.vendor_ref_id = None
@@ -1,40 +1,37 @@
-import base64
-import mimetypes
-import os
-from io import BytesIO
-from urllib.parse import urlparse
+import logging
+from datetime import date
 
-import requests
+import orjson
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
-from django.core.files.temp import NamedTemporaryFile
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.db import transaction
 from django.db.models import Sum
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
-from django.views.decorators.csrf import csrf_exempt
+from django.template.loader import render_to_string
+from django.utils.formats import date_format
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
 from twilio.base.exceptions import TwilioException, TwilioRestException
-from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 
-from .forms import (OTPVerificationForm, PhoneVerificationForm, ReceiptForm,
+from .forms import (OTPVerificationForm, PhoneVerificationForm,
                     UserRegistrationForm)
-from .models import CustomUser, Receipt
-from .utils import process_receipt, process_receipt_query
-from core.settings import (TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN,
-                           TWILIO_NUMBER, TWILIO_VERIFY_SERVICE_SID)
-
-import threading
-from django.db import connection
+from . import dashboard, metrics
+from .charts import GRANULARITIES, chart_payload
+from .dedupe import claim_message
+from .jobs import QueueFull, enqueue
+from .models import CustomUser, DailySpend, ReceiptJob
+from .notifier import twilio_client
+from .pagination import receipt_page
+from core.settings import TWILIO_NUMBER, TWILIO_VERIFY_SERVICE_SID
 
-client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-auth_string = f"{TWILIO_ACCOUNT_SID}:{TWILIO_AUTH_TOKEN}"
-auth_header = {
-    'Authorization': f'Basic {base64.b64encode(auth_string.encode()).decode()}'
-}
+logger = logging.getLogger(__name__)
 
 def create_resp(to_number, body_text):
 
@@ -53,7 +50,7 @@ def login_view(request):
             phone_number = form.cleaned_data['phone_number']
 
             try:
-                client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+                client = twilio_client()
 
                 
                 phone_number_info = client.lookups.v2.phone_numbers(phone_number).fetch()
@@ -84,7 +81,7 @@ def verify_otp(request):
 
             if phone_number:
                 try:
-                    client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+                    client = twilio_client()
                     verification_check = client.verify.services(
                         TWILIO_VERIFY_SERVICE_SID
                     ).verification_checks.create(to=phone_number, code=otp)
@@ -114,7 +111,7 @@ def register_user(request):
             print(phone_number, name, email)
             try:
                 
-                client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+                client = twilio_client()
                 phone_number_info = client.lookups.v2.phone_numbers(phone_number).fetch()
 
                 if not phone_number_info.valid:
@@ -154,7 +151,7 @@ def verify_otp_registration(request):
             otp = form.cleaned_data['otp']
 
             try:
-                client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+                client = twilio_client()
                 verification_check = client.verify \
                                      .services(TWILIO_VERIFY_SERVICE_SID) \
                                      .verification_checks \
@@ -188,162 +185,138 @@ def logout_view(request):
     return redirect("index")
 
 @login_required(login_url="login")
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=dashboard.etag)
 def index(request):
     user = request.user
+    version = dashboard.request_version(request)
+    html = dashboard.get_page(user.pk, version)
+    if html is not None:
+        return HttpResponse(html)
+
+    recent_receipts, next_cursor = receipt_page(user)
+
+    # Totals come from the per-day rollup, not the receipts table; the chart loads from chart_data
+    summary = DailySpend.objects.filter(user=user).aggregate(total_receipts=Sum('count'), total_expense=Sum('total'))
+    total_receipts = summary['total_receipts'] or 0
+    total_expense = round(float(summary['total_expense'] or 0), 2)
 
-    recent_receipts = Receipt.objects.filter(user=user).order_by('date')
-    print(recent_receipts)
-    total_receipts = Receipt.objects.filter(user=user).count()
-    total_expense = Receipt.objects.filter(user=user).aggregate(Sum('total_amount'))['total_amount__sum'] or 0
-    total_expense = round(float(total_expense), 2)
-    chart_data = (Receipt.objects.filter(user=user)
-                  .values('date')
-                  .annotate(total=Sum('total_amount'))
-                  .order_by('date'))
-    
-    
-    # for data in chart_data:
-    #     print(f"Date: {data['date']}, Total: {data['total']}")
-
-    dates = [data['date'].isoformat() for data in chart_data]
-    totals = [round(float(data['total']), 2) if data['total'] is not None else 0.0 for data in chart_data]
-
-    return render(request, 'extractor/index.html', {
+    # The page has no per-request content (CSRF token, flash messages), so the HTML itself is cached
+    html = render_to_string('extractor/index.html', {
         'recent_receipts': recent_receipts,
+        'next_cursor': next_cursor,
         'total_receipts': total_receipts,
         'total_expense': total_expense,
-        'chart_data': chart_data,
-        'dates': dates,
-        'totals': totals
-    })
-
+    }, request)
+    dashboard.set_page(user.pk, version, html)
+    return HttpResponse(html)
 
 
 
-@csrf_exempt
-def process_whatsapp_receipt(request):
-    if request.method == 'POST':
-        message = request.POST.get('Body')
-        media_url = request.POST.get('MediaUrl0')
-        mime_type = request.POST.get('MediaContentType0')
-        user_phone = request.POST.get("From").split(":")[1]
-
-        user, _ = CustomUser.objects.get_or_create(phone_number=user_phone)
-
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+@login_required(login_url="login")
+def receipt_list(request):
+    try:
+        receipts, next_cursor = receipt_page(request.user, cursor=request.GET.get('cursor'))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    return JsonResponse({
+        'results': [{
+            'id': receipt.pk,
+            'date': date_format(receipt.date) if receipt.date else None,
+            'vendor': receipt.vendor,
+            'total_amount': str(receipt.total_amount) if receipt.total_amount is not None else None,
+            'user': str(receipt.user),
+            'file_url': receipt.file.url if receipt.file else None,
+        } for receipt in receipts],
+        'next': next_cursor,
+    })
 
-        if media_url:
-            threading.Thread(target=process_receipt_thread, args=(media_url, mime_type, user, client, user_phone)).start()
-            return HttpResponse(create_resp(user_phone,'Let me extract the data for you!! Processing receipt...'))
-        else:
-            threading.Thread(target=process_query_thread, args=(user, message, client, user_phone)).start()
-            return HttpResponse(create_resp(user_phone,'Let me process the query for you!! Processing query...'))
 
-    return HttpResponse('Invalid method. Use POST')
+def chart_etag(request):
+    # The series only changes with the user's receipts, like the dashboard itself
+    tag = dashboard.etag(request)
+    return tag and f'{tag[:-1]}-{request.GET.urlencode()}"'
 
-import os
-import tempfile
 
-def process_receipt_thread(media_url, mime_type, user, client, user_phone):
-    temp_file_path = None
+@login_required(login_url="login")
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=chart_etag)
+def chart_data(request):
+    granularity = request.GET.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        return JsonResponse({'error': f"granularity must be one of {', '.join(GRANULARITIES)}"}, status=400)
     try:
-        connection.close()
-
-        media_sid = os.path.basename(urlparse(media_url).path)
-        file_extension = mimetypes.guess_extension(mime_type)
-        filename = f'{media_sid}{file_extension}'
-
-        response = requests.get(media_url, headers=auth_header, stream=True)
-
-        # Create a temporary file
-        fd, temp_file_path = tempfile.mkstemp(suffix=file_extension)
-        with os.fdopen(fd, 'wb') as temp_file:
-            temp_file.write(response.content)
-
-
-        extracted_data = process_receipt(temp_file_path, mime_type)
-        print(extracted_data)
-
-        if extracted_data is None:
-            client.messages.create(
-                from_=f"whatsapp:{TWILIO_NUMBER}",
-                body="Error processing receipt data. Please try again with a clear image or PDF.",
-                to=f"whatsapp:{user_phone}"
-            )
-            return
-
-        form_data = {
-            'date': extracted_data.get("date"),
-            'vendor': extracted_data.get("vendor"),
-            'total_amount': extracted_data.get("total_amount")
-        }
-
-        file_temp_in_memory = InMemoryUploadedFile(
-            file=BytesIO(response.content),
-            field_name='file',
-            name=filename,
-            content_type=mime_type,
-            size=len(response.content),
-            charset=None
-        )
-
-        form = ReceiptForm(form_data, files={'file': file_temp_in_memory})
-        if form.is_valid():
-            receipt = form.save(commit=False)
-            receipt.user = user
-            receipt.save()
-            formatted_data = f"Your receipt was processed !! \n" \
-                             f"Receipt Details:\n" \
-                             f"Date: {form_data['date']}\n" \
-                             f"Vendor: {form_data['vendor']}\n" \
-                             f"Total Amount: ${form_data['total_amount']:.2f}\n"
-
-            client.messages.create(
-                from_=f"whatsapp:{TWILIO_NUMBER}",
-                body=formatted_data,
-                to=f"whatsapp:{user_phone}"
-            )
-        else:
-            print(form.errors.as_json())
-            client.messages.create(
-                from_=f"whatsapp:{TWILIO_NUMBER}",
-                body="Error processing receipt data. Please try again with a clear image or PDF.",
-                to=f"whatsapp:{user_phone}"
-            )
-
-    except Exception as e:
-        print(f"Error in process_receipt_thread: {str(e)}")
-        client.messages.create(
-            from_=f"whatsapp:{TWILIO_NUMBER}",
-            body="An error occurred while processing your receipt. Please try again.",
-            to=f"whatsapp:{user_phone}"
-        )
-    finally:
-        # Clean up the temporary file
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.unlink(temp_file_path)
-
+        start = date.fromisoformat(request.GET['start']) if request.GET.get('start') else None
+        end = date.fromisoformat(request.GET['end']) if request.GET.get('end') else None
+        # At least the two ends and one bucket between them, so every request is downsampled
+        max_points = max(3, min(int(request.GET.get('points') or settings.CHART_MAX_POINTS),
+                                settings.CHART_MAX_POINTS))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid start, end or points'}, status=400)
+
+    payload = chart_payload(request.user, granularity, start, end, max_points)
+    return HttpResponse(orjson.dumps(payload), content_type='application/json')
+
+
+def enqueue_whatsapp_message(data, user_phone):
+    """Queue the job for an incoming WhatsApp message and return the immediate reply."""
+    message = data.get('Body')
+    media_url = data.get('MediaUrl0')
+    mime_type = data.get('MediaContentType0')
+    message_sid = metrics.correlation_id.get()
+
+    user, _ = CustomUser.objects.get_or_create(phone_number=user_phone)
+
+    num_media = int(data.get('NumMedia') or 0)
+    if num_media > 1:
+        kind = ReceiptJob.KIND_RECEIPT_BATCH
+        payload = {'media': [{'media_url': data.get(f'MediaUrl{index}'),
+                              'mime_type': data.get(f'MediaContentType{index}')}
+                             for index in range(num_media)]}
+        reply = f'Let me extract the data for you!! Processing {num_media} receipts...'
+    elif media_url:
+        kind = ReceiptJob.KIND_RECEIPT
+        payload = {'media_url': media_url, 'mime_type': mime_type}
+        reply = 'Let me extract the data for you!! Processing receipt...'
+    else:
+        kind = ReceiptJob.KIND_QUERY
+        payload = {'message': message}
+        reply = 'Let me process the query for you!! Processing query...'
 
-def process_query_thread(user, message, client, user_phone):
     try:
-        connection.close()
+        # The message id and its job are committed together, so a redelivery either sees both or neither
+        with transaction.atomic():
+            twilio_sid = data.get('MessageSid') or data.get('SmsMessageSid')
+            if twilio_sid and not claim_message(twilio_sid):
+                logger.info("Ignoring redelivered message %s", twilio_sid)
+                return reply
+            enqueue(kind, user, user_phone=user_phone, message_sid=message_sid, **payload)
+        return reply
+    except QueueFull as e:
+        logger.warning(str(e))
+        return 'We are receiving a lot of messages right now. Please try again in a few minutes.'
+
+
+async def process_whatsapp_receipt(request):
+    if request.method == 'POST':
+        user_phone = request.POST.get("From").split(":")[1]
+        # Twilio's MessageSid follows the message through the job logs and spans
+        with metrics.correlation(request.POST.get('MessageSid')):
+            with metrics.span('webhook', num_media=request.POST.get('NumMedia') or 0):
+                reply = await sync_to_async(enqueue_whatsapp_message)(request.POST, user_phone)
+        return HttpResponse(create_resp(user_phone, reply))
 
-        result = process_receipt_query(user=user, query=message)
-        print(result)
+    return HttpResponse('Invalid method. Use POST')
 
-        if not result:
-            result = 'Sorry I was not able to solve your query, can you try again'
 
-        client.messages.create(
-            from_=f"whatsapp:{TWILIO_NUMBER}",
-            body=result,
-            to=f"whatsapp:{user_phone}"
-        )
+# csrf_exempt is not async-aware in Django 4.2, so the flag is set directly
+process_whatsapp_receipt.csrf_exempt = True
+
 
-    except Exception as e:
-        print(f"Error in process_query_thread: {str(e)}")
-        client.messages.create(
-            from_=f"whatsapp:{TWILIO_NUMBER}",
-            body="An error occurred while processing your query. Please try again.",
-            to=f"whatsapp:{user_phone}"
-        )
\ No newline at end of file
+def metrics_view(request):
+    if not settings.METRICS_ENABLED:
+        return HttpResponse(status=404)
+    if not metrics.authorized(request.META.get('REMOTE_ADDR', ''), request.headers.get('Authorization')):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)